@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""
+    import_time.py
+    ~~~~~~~~~~~~~~
+
+    Checks that `import bgp` stays within its startup budget and doesn't
+    import heavy dependencies (which bgp only loads on first use).
+
+    usage: python benchmarks/import_time.py [--budget SECONDS] [--runs N]
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Dependencies bgp must not import until they're used
+DEFERRED_MODULES = ['internetarchive', 'requests', 'lxml', 'isbnlib', 'bs4']
+
+MEASURE = '''
+import json, sys, time
+tic = time.perf_counter()
+import bgp
+toc = time.perf_counter()
+print(json.dumps({
+    'seconds': toc - tic,
+    'imported': [m for m in %r if m in sys.modules],
+}))
+''' % DEFERRED_MODULES
+
+
+def measure(runs=5):
+    """
+    Imports bgp in fresh interpreters
+    :return: (fastest import in seconds, deferred modules imported)
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    results = [
+        json.loads(subprocess.check_output([sys.executable, '-c', MEASURE], env=env))
+        for _ in range(runs)
+    ]
+    return min(r['seconds'] for r in results), results[0]['imported']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark `import bgp`')
+    parser.add_argument('--budget', type=float, default=0.1,
+                        help='max seconds `import bgp` may take (default 0.1)')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='fresh interpreters to time, keeping the fastest (default 5)')
+    args = parser.parse_args()
+
+    seconds, imported = measure(runs=args.runs)
+    print('import bgp: %.1fms (budget %.1fms)' % (seconds * 1000, args.budget * 1000))
+    if imported:
+        print('imported at startup: ' + ', '.join(imported))
+    if seconds > args.budget or imported:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
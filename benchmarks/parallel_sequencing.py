@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+    parallel_sequencing.py
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Times running the default pipeline's processors over one large,
+    synthetic book (no network) one by one, in threads and in worker
+    processes, and checks that all three give the same results.
+
+    usage: python benchmarks/parallel_sequencing.py [--chars N] [--runs N] [--workers N]
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bgp  # noqa: E402
+
+MODES = [None, 'threads', 'processes']
+
+
+class Book:
+    """A fetched book, as run_processors sees it"""
+
+    xml_content = property(bgp._memoize_xml_content)
+    pages = property(bgp._memoize_pages)
+    plaintext = property(bgp._memoize_plaintext)
+
+    def __init__(self, plaintext, xml_content):
+        self.identifier = 'synthetic'
+        self.metadata = {}
+        self._plaintext = plaintext
+        self._xml_content = xml_content
+        self.plaintext_bytes = sys.getsizeof(plaintext)
+        self.xml_bytes = sys.getsizeof(xml_content)
+
+
+def synthetic_book(chars, seed=0):
+    """
+    :return: (plaintext of about chars characters, its Djvu XML), drawn
+        from a Zipf-like vocabulary so n-gram tables are realistically sized
+    """
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 9)))
+                  for _ in range(20000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    words = []
+    length = 0
+    while length < chars:
+        batch = rng.choices(vocabulary, weights, k=10000)
+        words.extend(batch)
+        length += sum(map(len, batch)) + len(batch)
+    lines = [' '.join(words[i:i + 12]) + '.' for i in range(0, len(words), 12)]
+    pages = [lines[i:i + 40] for i in range(0, len(lines), 40)]
+    xml = ['<DjVuXML><BODY>']
+    for number, page in enumerate(pages):
+        xml.append('<OBJECT><PARAM name="PAGE" value="synthetic_%04d.djvu"/>' % number)
+        for line in page:
+            xml.append('<LINE>' + ''.join('<WORD>%s</WORD>' % w for w in line.split(' ')) + '</LINE>')
+        xml.append('</OBJECT>')
+    xml.append('</BODY></DjVuXML>')
+    return '\n'.join(lines), ''.join(xml).encode('utf-8')
+
+
+def without_times(results):
+    """:return: results without their (run to run varying) timings"""
+    if isinstance(results, dict):
+        return {k: without_times(v) for k, v in results.items() if not k.endswith('time')}
+    return results
+
+
+def measure(sequencer, plaintext, xml_content, runs=3):
+    """
+    :return: (fastest run_processors, and collection of its processors'
+        results, in seconds; those results)
+    """
+    timings = []
+    for _ in range(runs):
+        book = Book(plaintext, xml_content)
+        pipeline = sequencer.spawn_pipeline()
+        tic = time.perf_counter()
+        sequencer.run_processors(book, pipeline)
+        results = {p: pipeline[p].results for p in pipeline}
+        timings.append(time.perf_counter() - tic)
+    results = {p: without_times(results[p]) for p in results}
+    return min(timings), json.loads(json.dumps(results, sort_keys=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parallel run_processors')
+    parser.add_argument('--chars', type=int, default=1200000,
+                        help='size of the synthetic book in characters (default 1.2M)')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='runs per mode, keeping the fastest (default 3)')
+    parser.add_argument('--workers', type=int,
+                        help='max concurrent processors (default CPU count)')
+    args = parser.parse_args()
+
+    plaintext, xml_content = synthetic_book(args.chars)
+    print('book: %d chars, %d bytes of Djvu XML, %d CPUs' % (
+        len(plaintext), len(xml_content), os.cpu_count()))
+    baseline = None
+    for mode in MODES:
+        sequencer = bgp._default_sequencer()
+        sequencer.parallel = mode
+        sequencer.workers = args.workers
+        if mode == 'processes':
+            sequencer.process_pool()
+        seconds, results = measure(sequencer, plaintext, xml_content, runs=args.runs)
+        sequencer.close()
+        baseline = results if baseline is None else baseline
+        print('%-9s %.3fs%s' % (mode or 'serial', seconds,
+                                '' if results == baseline else ' (results differ!)'))
+        if results != baseline:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,19 +10,23 @@ __title__ = 'bgp'
 __author__ = 'OBGP'
 __version__ = '0.0.42'
 
-import copy
+import io
 import json
 import logging
+import multiprocessing
 import os
-import requests
 import sys
 import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import closing
+from functools import lru_cache, partial
 
-import internetarchive as ia
-from bs4 import BeautifulSoup
-from internetarchive.config import get_config
-
+from bgp import djvu
+from bgp.cache import CacheMissError
+from bgp.genome import GENOME_FILENAMES, encode_genome, genome_filename, write_genome
+from bgp.ngrams import numpy_installed
+from bgp.prefetch import Prefetcher
 from bgp.modules.terms import (
     FulltextProcessor,
     IsbnExtractorModule,
@@ -33,35 +37,105 @@ from bgp.modules.terms import (
     CopyrightPageDetectorModule,
     ChapterPageDetectorModule,
     PageTypeProcessor,
-    BackpageIsbnExtractorModule
+    BackpageIsbnExtractorModule,
+    spawn
 )
 from bgp.utils import STOP_WORDS
-from subprocess import PIPE, Popen, STDOUT
 
-logging.basicConfig(
-    format='%(asctime)s %(levelname)-8s %(message)s',
-    level=logging.INFO,
-    datefmt='%Y-%m-%d %H:%M:%S',
-    filename='obgp_errors.log')
+# `internetarchive` (and with it requests) and lxml are imported on first
+# use, and DEFAULT_SEQUENCER and MINIMAL_SEQUENCER built on first access,
+# so importing bgp stays cheap for short-lived workers and tools
 
-def _memoize_xml(self):
-    if not hasattr(self, '_xml'):
+
+def configure_logging(filename='obgp_errors.log', level=logging.INFO):
+    """Logs sequencing errors to filename (called by pipeline.py)"""
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=level,
+        datefmt='%Y-%m-%d %H:%M:%S',
+        filename=filename)
+
+def _source_cache_key(self, fmt):
+    source_file = list(self.get_files(formats=[fmt]))[0]
+    key = self.content_cache.key(
+        self.identifier, source_file.name, md5=source_file.md5, mtime=source_file.mtime)
+    return source_file, key
+
+def _request_source(self, fmt, source_file=None):
+    """
+    Requests the item's file of format fmt through the item's session.
+    (`internetarchive`'s downloads remount the session's adapters, which
+    would drop the pooled, retrying one bgp mounts.)
+    :return: the streamed response
+    """
+    source_file = source_file or list(self.get_files(formats=[fmt]))[0]
+    response = self.session.get(source_file.url, stream=True, params={'cnt': '0'},
+                                auth=getattr(source_file, 'auth', None))
+    response.raise_for_status()
+    return response
+
+def _download_source(self, fmt):
+    """
+    :param str fmt: an archive.org file format, e.g. 'DjVuTXT'
+    :return: bytes of the item's file of format fmt, read through the
+        item's content_cache if one has been configured
+    """
+    if getattr(self, 'content_cache', None) is None:
+        return _request_source(self, fmt).content
+    source_file, key = _source_cache_key(self, fmt)
+    content = self.content_cache.get(key)
+    if content is None:
+        if self.content_cache.offline:
+            raise CacheMissError(fmt + ' for item - ' + self.identifier + ' is not cached')
+        content = _request_source(self, fmt, source_file=source_file).content
+        self.content_cache.put(key, content)
+    return content
+
+def _open_cached_source(self, fmt):
+    """
+    :return: a binary file object of the cached file of format fmt, or
+        None if there's no content_cache or the file isn't in it
+    """
+    if getattr(self, 'content_cache', None) is None:
+        return None
+    _, key = _source_cache_key(self, fmt)
+    cached = self.content_cache.open(key)
+    if cached is None and self.content_cache.offline:
+        raise CacheMissError(fmt + ' for item - ' + self.identifier + ' is not cached')
+    return cached
+
+def _memoize_xml_content(self):
+    import requests
+
+    if not hasattr(self, '_xml_content'):
         _memoize_xml_tic = time.perf_counter()
         try:
-            self._xml = self.download(formats=['Djvu XML'], return_responses=True)[0].text
+            self._xml_content = _download_source(self, 'Djvu XML')
         except requests.exceptions.Timeout as e:
             logging.error('Timeout getting xml for item - ' + self.identifier + ' | ' + str(e))
             raise Exception('Timeout getting xml for item - ' + self.identifier)
         _memoize_xml_toc = time.perf_counter()
         self.xml_time = round(_memoize_xml_toc - _memoize_xml_tic, 3)
-        self.xml_bytes = sys.getsizeof(self._xml)
+        self.xml_bytes = sys.getsizeof(self._xml_content)
+    return self._xml_content
+
+def _memoize_xml(self):
+    if not hasattr(self, '_xml'):
+        self._xml = self.xml_content.decode('utf-8', errors='replace')
     return self._xml
 
+def _memoize_pages(self):
+    if not hasattr(self, '_pages'):
+        self._pages = list(djvu.iter_pages(io.BytesIO(self.xml_content)))
+    return self._pages
+
 def _memoize_plaintext(self):
+    import requests
+
     if not hasattr(self, '_plaintext'):
         _memoize_plaintext_tic = time.perf_counter()
         try:
-            self._plaintext = self.download(formats=['DjVuTXT'], return_responses=True)[0].text
+            self._plaintext = _download_source(self, 'DjVuTXT').decode('utf-8', errors='replace')
         except requests.exceptions.Timeout as e:
             logging.error('Timeout getting txt for item - ' + self.identifier + ' | ' + str(e))
             raise Exception('Timeout getting txt for item - ' + self.identifier)
@@ -70,36 +144,381 @@ def _memoize_plaintext(self):
         self.plaintext_bytes = sys.getsizeof(self._plaintext)
     return self._plaintext
 
-ia.Item.xml = property(_memoize_xml)
-ia.Item.plaintext = property(_memoize_plaintext)
+def _iter_plaintext(self, chunk_size=1024 * 1024):
+    """
+    Yields the book's plaintext in pieces of about chunk_size characters,
+    streaming DjVuTXT from archive.org unless it's already been memoized
+    or cached (streamed downloads aren't added to the content cache)
+    """
+    import requests
+
+    if hasattr(self, '_plaintext'):
+        for i in range(0, len(self._plaintext), chunk_size):
+            yield self._plaintext[i:i + chunk_size]
+        return
+    cached = _open_cached_source(self, 'DjVuTXT')
+    if cached:
+        with io.TextIOWrapper(cached, encoding='utf-8', errors='replace') as text:
+            yield from iter(lambda: text.read(chunk_size), '')
+        return
+    _iter_plaintext_tic = time.perf_counter()
+    try:
+        response = _request_source(self, 'DjVuTXT')
+        # requests yields bytes rather than str if it can't guess an encoding
+        response.encoding = response.encoding or 'utf-8'
+        plaintext_bytes = 0
+        with closing(response):
+            for chunk in response.iter_content(chunk_size=chunk_size, decode_unicode=True):
+                plaintext_bytes += len(chunk)
+                yield chunk
+    except requests.exceptions.Timeout as e:
+        logging.error('Timeout getting txt for item - ' + self.identifier + ' | ' + str(e))
+        raise Exception('Timeout getting txt for item - ' + self.identifier)
+    _iter_plaintext_toc = time.perf_counter()
+    self.plaintext_time = round(_iter_plaintext_toc - _iter_plaintext_tic, 3)
+    self.plaintext_bytes = plaintext_bytes
 
-def get_book_items(query, rows=100, page=1, scope_all=False):
+def _iter_pages(self):
+    """
+    Yields the book's pages, incrementally parsing Djvu XML as it streams
+    from archive.org unless it's already been memoized. Closing the
+    generator early stops the download.
+    """
+    import requests
+
+    if hasattr(self, '_pages'):
+        yield from self._pages
+        return
+    if hasattr(self, '_xml_content'):
+        yield from djvu.iter_pages(io.BytesIO(self._xml_content))
+        return
+    cached = _open_cached_source(self, 'Djvu XML')
+    if cached:
+        with cached:
+            yield from djvu.iter_pages(cached)
+        return
+    _iter_pages_tic = time.perf_counter()
+    try:
+        response = _request_source(self, 'Djvu XML')
+    except requests.exceptions.Timeout as e:
+        logging.error('Timeout getting xml for item - ' + self.identifier + ' | ' + str(e))
+        raise Exception('Timeout getting xml for item - ' + self.identifier)
+    # Have urllib3 undo any gzip/deflate transfer encoding
+    response.raw.decode_content = True
+    try:
+        with closing(response):
+            yield from djvu.iter_pages(response.raw)
+    finally:
+        self.xml_time = round(time.perf_counter() - _iter_pages_tic, 3)
+
+def _memoize_last_page(self, tail_bytes=64 * 1024):
+    """
+    The book's last page. Unless the Djvu XML has already been fetched,
+    only its tail is requested (via HTTP Range), growing the range until
+    it reaches back to the start of the last page.
+    """
+    if not hasattr(self, '_last_page'):
+        if hasattr(self, '_pages'):
+            self._last_page = self._pages[-1]
+        elif hasattr(self, '_xml_content'):
+            self._last_page = djvu.parse_last_page(self._xml_content)
+        else:
+            cached = _open_cached_source(self, 'Djvu XML')
+            if cached:
+                with cached:
+                    self._last_page = djvu.parse_last_page(cached.read())
+                return self._last_page
+            xml_file = list(self.get_files(formats=['Djvu XML']))[0]
+            while True:
+                response = self.session.get(xml_file.url, headers={'Range': 'bytes=-%d' % tail_bytes})
+                response.raise_for_status()
+                self._last_page = djvu.parse_last_page(response.content)
+                # 200 rather than 206 means the server sent the whole file
+                if self._last_page or response.status_code != 206 or len(response.content) < tail_bytes:
+                    break
+                tail_bytes *= 4
+    return self._last_page
+
+# Item properties that fetch each source processors may declare they read
+SOURCE_PROPERTIES = {
+    'plaintext': 'plaintext',
+    'xml': 'xml_content',
+}
+
+# Archive.org file format of each source
+SOURCE_FORMATS = {
+    'plaintext': 'DjVuTXT',
+    'xml': 'Djvu XML',
+}
+
+def source_fingerprint(book, sources):
+    """
+    :param book: an `internetarchive` Item
+    :param [str] sources: e.g. a processor's inputs
+    :return: {source: md5 of the book's file of that source (or None)},
+        from the item's metadata without downloading anything
+    """
+    if not hasattr(book, '_fingerprints'):
+        book._fingerprints = {}
+    for source in sources:
+        if source not in book._fingerprints:
+            files = list(book.get_files(formats=[SOURCE_FORMATS[source]]))
+            book._fingerprints[source] = files[0].md5 if files else None
+    return {source: book._fingerprints[source] for source in sources}
+
+def merge_genomes(genome, update):
+    """
+    :param dict genome: a book's genome
+    :param dict update: results of resequencing some of its modules
+    :return: a copy of genome with update's modules' results and metadata
+        added or replacing its own, and update's top level metadata. A
+        processor's own metadata (e.g. total_tokens) is update's only if
+        all of its modules were resequenced.
+    """
+    merged = dict(genome)
+    merged.update((k, v) for k, v in update.items() if k != 'metadata')
+    meta = dict(genome.get('metadata', {}))
+    processors = dict(meta.get('processors', {}))
+    for p, processor_meta in update['metadata']['processors'].items():
+        base_meta = processors.get(p, {})
+        modules = dict(base_meta.get('modules', {}))
+        modules.update(processor_meta['modules'])
+        if set(modules) == set(processor_meta['modules']):
+            processors[p] = dict(processor_meta, modules=modules)
+        else:
+            # The rerun's totals would describe only some of its modules
+            processors[p] = dict(base_meta, modules=modules)
+    source = dict(meta.get('source', {}))
+    for s, source_meta in update['metadata'].get('source', {}).items():
+        # Keep the original timings of sources which weren't refetched
+        if source_meta.get('time') is not None or s not in source:
+            source[s] = source_meta
+    meta.update(update['metadata'])
+    meta['processors'] = processors
+    meta['source'] = source
+    merged['metadata'] = meta
+    return merged
+
+def _load_ia():
+    """
+    Imports `internetarchive`, on first use adding bgp's source properties
+    to its Item
+    :return: the `internetarchive` module
+    """
+    import internetarchive as ia
+
+    if not hasattr(ia.Item, 'iter_pages'):
+        ia.Item.xml_content = property(_memoize_xml_content)
+        ia.Item.xml = property(_memoize_xml)
+        ia.Item.pages = property(_memoize_pages)
+        ia.Item.last_page = property(_memoize_last_page)
+        ia.Item.plaintext = property(_memoize_plaintext)
+        ia.Item.iter_plaintext = _iter_plaintext
+        ia.Item.iter_pages = _iter_pages
+    return ia
+
+@lru_cache()
+def _s3_config():
+    from internetarchive.config import get_config
+
+    return get_config().get('s3', {})
+
+def get_book_items(query, rows=100, page=1, scope_all=False, session=None):
     """
     :param str query: an search query for selecting/faceting books
     :param int rows: limit how many results returned
     :param int page: starting page to offset search results
+    :param session: the `internetarchive` ArchiveSession to search (and
+        fetch the items) with, e.g. a Sequencer's `ia`; default a new
+        pooled, retrying one
     :return: An `internetarchive` Item
     :rtype: `internetarchive` Item
     """
+    from bgp import sessions
+
     params = {'page': page, 'rows': rows}
     if scope_all:
         params['scope'] = 'all'
-    # this may need to get run as a session (priv'd access)
-    return ia.search_items(query, params=params).iter_as_items()
+    if session is None:
+        session = sessions.mount(_load_ia().get_session())
+    search = session.search_items(query, params=params)
+    # A Search mounts `internetarchive`'s own adapter over the pooled one
+    sessions.mount(session)
+    return search.iter_as_items()
 
 def get_software_version():  # -> str:
     return __version__
 
+def upload_genome(session, results, access=None, secret=None, encoded=None,
+                  compression=None, filename=None, item=None):
+    """
+    Uploads a book's genome to its Archive.org item, as book_genome.json
+    or in the compressed format (see bgp.genome)
+    :param session: an `internetarchive` ArchiveSession
+    :param dict results: a Sequence's results
+    :param bytes encoded: results already encoded (by encode_genome)
+    :param str compression: None, 'gzip' or 'zstd'
+    :param str filename: a file results were already written to, in the
+        compression's format, to upload as is
+    :param item: the book's `internetarchive` Item, if already fetched
+        (default: fetched through session)
+    """
+    from bgp import sessions
+
+    itemid = results.get('metadata').get('identifier')
+    name = genome_filename(compression)
+    with tempfile.TemporaryDirectory() as tmp:
+        if filename is None:
+            filename = os.path.join(tmp, name)
+            write_genome(filename, results, encoded=encoded)
+        # The session's adapter doesn't retry uploads; internetarchive
+        # retries them itself (on 503 Slow Down)
+        item = item or session.get_item(itemid)
+        item.upload({name: filename},
+                    access_key=access,
+                    secret_key=secret,
+                    retries=sessions.SETTINGS['retries'])
+
+
+def _unavailable_reason(e):
+    """:return: why a processor's streamed source couldn't be read"""
+    if isinstance(e, CacheMissError):
+        return 'a source is not cached'
+    return 'a source is forbidden'
+
+
+def _share_sources(book, sources):
+    """
+    Writes the book's fetched sources once to shared memory, from which
+    processors run in worker processes read them
+    :param [str] sources: those read by processors to be run in workers
+    :return: (the SharedMemory, which the caller must unlink once they've
+        run, {attribute: (start, end)} of each source within it)
+    """
+    from multiprocessing import shared_memory
+
+    parts = {}
+    if 'plaintext' in sources:
+        parts['_plaintext'] = book.plaintext.encode('utf-8')
+    if 'xml' in sources and not hasattr(book, '_pages'):
+        parts['_xml_content'] = book.xml_content
+    segment = shared_memory.SharedMemory(create=True, size=max(sum(map(len, parts.values())), 1))
+    spans = {}
+    offset = 0
+    for attr, content in parts.items():
+        segment.buf[offset:offset + len(content)] = content
+        spans[attr] = (offset, offset + len(content))
+        offset += len(content)
+    return segment, spans
+
+
+# The book whose sources a worker process last read from shared memory,
+# reused (with the tokens derived from them) by every processor of that
+# book the worker runs
+_worker_book = None
+
+
+class BookSources:
+    """
+    What a processor run in a worker process reads of a book: its
+    identifier, metadata and its sources as fetched in this process. Only
+    where they are in shared memory (see _share_sources) is pickled to the
+    worker, along with the book's pages if already parsed.
+    """
+
+    xml_content = property(_memoize_xml_content)
+    xml = property(_memoize_xml)
+    pages = property(_memoize_pages)
+    last_page = property(_memoize_last_page)
+    plaintext = property(_memoize_plaintext)
+
+    def __init__(self, book, sources, segment, spans):
+        """
+        :param book: an `internetarchive` Item whose sources are fetched
+        :param [str] sources: e.g. a processor's inputs
+        :param segment, spans: as returned by _share_sources
+        """
+        self.identifier = book.identifier
+        self.metadata = getattr(book, 'metadata', {})
+        self._segment = segment.name
+        attrs = set()
+        if 'plaintext' in sources:
+            attrs.add('_plaintext')
+        if 'xml' in sources:
+            attrs.add('_xml_content')
+            # The pages, once parsed, are what's read of the XML
+            if hasattr(book, '_pages'):
+                self._pages = book._pages
+        self._spans = {attr: span for attr, span in spans.items() if attr in attrs}
+
+    def load(self):
+        """
+        Reads this book's sources from shared memory, in a worker process
+        :return: the worker's BookSources for this book
+        """
+        from multiprocessing import shared_memory
+
+        global _worker_book
+        if _worker_book is None or _worker_book._segment != self._segment:
+            _worker_book = self
+        book = _worker_book
+        if hasattr(self, '_pages') and not hasattr(book, '_pages'):
+            book._pages = self._pages
+        missing = {attr: span for attr, span in self._spans.items() if not hasattr(book, attr)}
+        if missing:
+            segment = shared_memory.SharedMemory(name=self._segment)
+            try:
+                for attr, (start, end) in missing.items():
+                    content = bytes(segment.buf[start:end])
+                    setattr(book, attr, content if attr == '_xml_content' else content.decode('utf-8'))
+            finally:
+                segment.close()
+        return book
+
+
+def _run_processor(processor, book):
+    """Runs a processor in a worker process, returning its results"""
+    processor.run(book.load())
+    return processor.results
+
+
+class _ProcessedProcessor:
+    """
+    Stands in for a processor which was run in a worker process, serving
+    the results the worker sent back (anything else is the processor's own)
+    """
+
+    def __init__(self, processor, results):
+        self.processor = processor
+        self.results = results
+
+    def __getattr__(self, name):
+        return getattr(self.processor, name)
+
 
 class Sequencer:
 
     class Sequence:
-        def __init__(self, pipeline, book, access=None, secret=None):
+        def __init__(self, pipeline, book, access=None, secret=None, session=None, base=None,
+                     compression=None):
+            """
+            :param dict base: an existing genome (results) which this
+                Sequence's results are merged into, e.g. when resequencing
+            :param str compression: save and upload the genome in the
+                compressed format (see bgp.genome), with 'gzip' or 'zstd'
+            """
             self.pipeline = pipeline
             self.sequence_time = 0
             self.book = book
             self.access = access
             self.secret = secret
+            self.session = session or book.session
+            self.base = base
+            self.skipped = {}
+            self.compression = compression
+            self._results = None
+            self._encoded = None
+            self._saved = None
 
         def save(self, path=''):
             item_path = path + self.book.identifier + '/'
@@ -107,35 +526,62 @@ class Sequencer:
             if getattr(self, 'book'):
                 if item_path and not os.path.exists(item_path):
                     os.makedirs(item_path)
-                with open(item_path + 'book_genome.json', 'w') as txt:
-                    txt.write(json.dumps(self.results))
+                filename = item_path + genome_filename(self.compression)
+                write_genome(filename, self.results,
+                             encoded=None if self.compression else self.encoded)
+                # Leave no genome saved in another format to be reloaded
+                for other in GENOME_FILENAMES.values():
+                    if item_path + other != filename and os.path.exists(item_path + other):
+                        os.remove(item_path + other)
+                self._saved = filename
 
         def upload(self):
-            itemid = self.results.get('metadata').get('identifier')
-            with tempfile.NamedTemporaryFile() as tmp:
-                tmp.write(json.dumps(self.results).encode())
-                tmp.flush()
-                self.ia.upload(itemid, {'book_genome.json': tmp},
-                               access_key=self.access,
-                               secret_key=self.secret)
+            # The saved file, if any, is uploaded rather than encoded again
+            upload_genome(self.session, self.results,
+                          access=self.access, secret=self.secret,
+                          encoded=None if self.compression else self.encoded,
+                          compression=self.compression, filename=self._saved,
+                          item=self.book)
 
         @property
         def results(self):
+            """The genome, built once (by finalize); not to be modified"""
+            if self._results is None:
+                self.finalize()
+            return self._results
+
+        @property
+        def encoded(self):
+            """The genome encoded as JSON (see encode_genome), encoded once"""
+            if self._encoded is None:
+                self._encoded = encode_genome(self.results)
+            return self._encoded
+
+        def finalize(self):
+            """
+            Builds the genome from the processors' results, once they've
+            run. Later changes to the processors aren't reflected in it.
+            """
             data = {}
             meta = {}
             processors = {}
             for processor in self.pipeline:
-                processor_meta = self.pipeline[processor].results
-                # Remove module results from processor metadata dict
-                processor_meta.update({'modules': {}})
-                processors.update({processor: processor_meta})
+                processor_results = self.pipeline[processor].results
+                # Module results go at the root level of the genome, the
+                # rest of the processor's results into its metadata
+                processor_meta = dict(processor_results, modules={})
+                processor_meta['version'] = getattr(self.pipeline[processor], 'version', 1)
+                processors[processor] = processor_meta
+                fingerprint = source_fingerprint(
+                    self.book, getattr(self.pipeline[processor], 'inputs', ()))
                 for module in self.pipeline[processor].modules:
-                    # Add module results to root level of dict
-                    data[module] = self.pipeline[processor].results['modules'][module]['results']
-                    module_meta = self.pipeline[processor].results['modules'][module]
-                    # Remove module results from module metadata dict
-                    module_meta.pop('results')
-                    processors[processor]['modules'].update({module: module_meta})
+                    module_results = processor_results['modules'][module]
+                    data[module] = module_results['results']
+                    module_meta = {k: v for k, v in module_results.items() if k != 'results'}
+                    module_meta['version'] = getattr(
+                        self.pipeline[processor].modules[module], 'version', 1)
+                    module_meta['fingerprint'] = fingerprint
+                    processor_meta['modules'][module] = module_meta
             meta['processors'] = processors
             meta['sequence_time'] = self.sequence_time
             meta['source'] = {
@@ -151,93 +597,432 @@ class Sequencer:
             meta['version'] = get_software_version()
             meta['timestamp'] = time.time()
             meta['identifier'] = self.book.identifier
+            if self.skipped:
+                meta['skipped'] = self.skipped
             data['metadata'] = meta
+            if self.base:
+                data = merge_genomes(self.base, data)
+            self._results = data
+            self._encoded = None
             return data
 
-    def __init__(self, pipeline, access=None, secret=None):
+    def __init__(self, pipeline, access=None, secret=None, cache=None,
+                 parallel=None, workers=None, parallel_min_bytes=0, genome_compression=None):
         """
-        :param dict pipeline
+        :param dict pipeline: {'name': processor}, used as a template from
+            which fresh processors are spawned for every book; or a callable
+            returning such a dict (a pipeline factory)
+        :param bgp.cache.ContentCache cache: optional on-disk cache through
+            which books' source files are fetched
+        :param str parallel: run a book's processors concurrently, in
+            'threads' (for work which releases the GIL, e.g. lxml parsing,
+            lexile requests) or worker 'processes' (see process_pool);
+            default one by one
+        :param int workers: max concurrent processors (default CPU count)
+        :param int parallel_min_bytes: only run books whose fetched sources
+            are at least this large in parallel
+        :param str genome_compression: save and upload genomes in the
+            compressed format (see bgp.genome), with 'gzip' or 'zstd'
         """
         self.pipeline = pipeline
-        self.configure(
-            access=access or get_config().get('s3', {}).get('access'),
-            secret=secret or get_config().get('s3', {}).get('secret')
-        )
+        self.cache = cache
+        self.parallel = parallel
+        self.workers = workers
+        self.parallel_min_bytes = parallel_min_bytes
+        self.genome_compression = genome_compression
+        self._pool = None
+        self.configure(access=access, secret=secret)
 
     def configure(self, access=None, secret=None):
-        self.access = access
-        self.secret = secret
-        self.ia = ia.get_session({'s3': {'access': access, 'secret': secret}})
-        self.ia.get_book_items = get_book_items
+        """
+        Credentials not given default to those in the `internetarchive`
+        config file, read on first use
+        """
+        self._access = access
+        self._secret = secret
+        self._ia = None
 
-    def sequence(self, book):
+    @property
+    def access(self):
+        return self._access or _s3_config().get('access')
+
+    @property
+    def secret(self):
+        return self._secret or _s3_config().get('secret')
+
+    @property
+    def ia(self):
+        """
+        This process's pooled (keep-alive, retrying) ArchiveSession, used
+        for metadata, source downloads and uploads
+        """
+        from bgp import sessions
+
+        if self._ia is None or self._ia_pid != os.getpid():
+            self._ia = sessions.mount(
+                _load_ia().get_session({'s3': {'access': self.access, 'secret': self.secret}}))
+            self._ia.get_book_items = partial(get_book_items, session=self._ia)
+            self._ia_pid = os.getpid()
+        return self._ia
+
+    def process_pool(self):
+        """
+        This process's pool of worker processes for parallel='processes'.
+        Its workers are all forked when it's first used, before any book is
+        fetched, so it must be created while this process runs no other
+        threads (sequence_many creates it before it starts prefetching).
+        Books' sources reach the workers through shared memory (see
+        BookSources).
         """
-        :param [NGramProcessor] pipeline: a list of NGramProcessors that run modules
+        from multiprocessing import resource_tracker
+
+        if self._pool is None or self._pool_pid != os.getpid():
+            # Workers inherit this process's tracker of shared memory, rather
+            # than each starting its own, which would warn of (and unlink)
+            # every book's sources as leaked when the worker exits
+            resource_tracker.ensure_running()
+            self._pool = ProcessPoolExecutor(
+                self.workers or os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context('fork'))
+            # A fork pool forks all its workers on its first task
+            self._pool.submit(int).result()
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def close(self):
+        """Shuts down this process's worker process pool, if any"""
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.shutdown()
+        self._pool = None
+
+    def upload(self, results):
+        """
+        Uploads a genome's results (e.g. reloaded from book_genome.json)
+        :param dict results: a Sequence's results
+        """
+        upload_genome(self.ia, results, access=self.access, secret=self.secret,
+                      compression=self.genome_compression)
+
+    def spawn_pipeline(self):
+        if callable(self.pipeline):
+            return self.pipeline()
+        return {p: spawn(self.pipeline[p]) for p in self.pipeline}
+
+    def get_book(self, book):
+        # possible conflict since ia.Item not from ia.get_session
+        _book = book if type(book) is _load_ia().Item else self.ia.get_item(book)
+        if self.cache and not getattr(_book, 'content_cache', None):
+            _book.content_cache = self.cache
+        return _book
+
+    def prefetch(self, book):
+        """
+        Fetches a book's metadata and every source its processors will
+        read, so sequencing it afterwards is purely CPU-bound. Errors are
+        left for sequence() to encounter (and report) again.
         :param  [str|ia.Item] book: an Archive.org book Item or Item.identifier
-        :param int rows: limit how many results returned
-        :param int page: starting page to offset search results
+        :rtype: ia.Item or, if its metadata couldn't be fetched, book
         """
         try:
-            sequence_tic = time.perf_counter()
+            _book = self.get_book(book)
+        except Exception:
+            return book
+        pipeline = self.pipeline() if callable(self.pipeline) else self.pipeline
+        try:
+            self.fetch_sources(_book, pipeline)
+        except Exception:
+            pass
+        return _book
+
+    def fetch_sources(self, book, pipeline):
+        """
+        Plans a book's downloads: each source the pipeline's processors
+        read is checked for in the item's files, and every one they don't
+        stream is fetched once, in parallel, before any processor runs
+        :param book: an `internetarchive` Item
+        :param dict pipeline: {'name': processor}
+        :return: {source: reason} for sources which are missing or can't be
+            fetched; other errors (e.g. timeouts) are raised
+        """
+        import requests
+
+        inputs = {s for p in pipeline.values() for s in getattr(p, 'inputs', ())}
+        unavailable = {}
+        for source in sorted(inputs):
+            if not list(book.get_files(formats=[SOURCE_FORMATS[source]])):
+                unavailable[source] = 'does not have ' + SOURCE_FORMATS[source]
+        sources = sorted({s for p in pipeline.values() for s in getattr(p, 'sources', ())}
+                         - set(unavailable))
+
+        def fetch(source):
+            getattr(book, SOURCE_PROPERTIES[source])
+
+        with ThreadPoolExecutor(max(len(sources), 1)) as executor:
+            fetches = {s: executor.submit(fetch, s) for s in sources}
+        for source in sources:
             try:
-                # possible conflict since ia.Item not from ia.get_session
-                _book = book if type(book) is ia.Item else self.ia.get_item(book)
-                sq = self.Sequence(
-                    copy.deepcopy(self.pipeline),
-                    _book,
-                    access=self.access,
-                    secret=self.secret
-                )
-            except requests.exceptions.ConnectionError:
-                raise Exception('Connection error retrieving metadata for - ' + book)
-                logging.error('Connection error retrieving metadata for - ' + book)
-            if sq.book.exists:
-                for processor in sq.pipeline:
-                    sq.pipeline[processor].run(sq.book)
-                sequence_toc = time.perf_counter()
-                sq.sequence_time = round(sequence_toc - sequence_tic, 3)
-                return sq
-            else:
-                raise Exception(sq.book.identifier + ' - Item cannot be found.')
-                logging.error(sq.book.identifier + ' - Item cannot be found.')
-        except IndexError:
+                fetches[source].result()
+            except requests.exceptions.HTTPError:
+                unavailable[source] = SOURCE_FORMATS[source] + ' is forbidden'
+            except CacheMissError:
+                unavailable[source] = SOURCE_FORMATS[source] + ' is not cached'
+        return unavailable
+
+    def run_sequence(self, sq):
+        """
+        Fetches the sources of a Sequence's processors then runs them.
+        Processors whose sources are unavailable are dropped from the
+        Sequence and recorded in its `skipped` ({processor: reason}); only
+        if every processor is skipped, and there's no base genome to fall
+        back on, is the book's sequencing failed.
+        """
+        import requests
+
+        unavailable = self.fetch_sources(sq.book, sq.pipeline)
+        for processor in list(sq.pipeline):
+            reasons = [unavailable[s] for s in getattr(sq.pipeline[processor], 'inputs', ())
+                       if s in unavailable]
+            if reasons:
+                sq.skipped[processor] = '; '.join(reasons)
+                del sq.pipeline[processor]
+        for processor, reason in self.run_processors(sq.book, sq.pipeline).items():
+            # A source the processor streams
+            sq.skipped[processor] = reason
+            del sq.pipeline[processor]
+        if sq.skipped and not sq.pipeline and not sq.base:
+            if all('forbidden' in reason for reason in sq.skipped.values()):
+                raise Exception(sq.book.identifier + ' - DjvuXML and/or DjvuTXT is forbidden and can\'t be sequenced!')
             raise Exception(sq.book.identifier + ' - does not have DjvuXML and/or DjvuTXT to be sequenced!')
-            logging.error(sq.book.identifier + ' - does not have DjvuXML and/or DjvuTXT to be sequenced!')
-        except requests.exceptions.HTTPError:
-            raise Exception(sq.book.identifier + ' - DjvuXML and/or DjvuTXT is forbidden and can\'t be sequenced!')
-            logging.error(sq.book.identifier + ' - DjvuXML and/or DjvuTXT is forbidden and can\'t be sequenced!')
-
-
-DEFAULT_SEQUENCER = Sequencer({
-    '3gram': NGramProcessor(modules={
-        '3grams': WordFreqModule()
-    }, n=3, threshold=2, stop_words=None),
-    '2gram': NGramProcessor(modules={
-        '2grams': WordFreqModule()
-    }, n=2, threshold=3, stop_words=STOP_WORDS),
-    '1gram': NGramProcessor(modules={
-        '1grams': WordFreqModule(),
-        'urls': UrlExtractorModule()
-    }, n=1, stop_words=None),
-    'fulltext': FulltextProcessor(modules={
-        'readinglevel': ReadingLevelModule()
-    }),
-    'pagetypes': PageTypeProcessor(modules={
-        'copyright_page': CopyrightPageDetectorModule(),
-        'backpage_isbn': BackpageIsbnExtractorModule()
+
+    def run_processors(self, book, pipeline):
+        """
+        Runs a book's processors one by one or, if this Sequencer is
+        parallel (and the book large enough), concurrently. Either way the
+        pipeline's processors end up serving the same results.
+        :return: {processor: reason} for processors whose (streamed) source
+            was forbidden or, offline, isn't cached
+        """
+        import requests
+
+        size = sum(getattr(book, attr, None) or 0 for attr in ('plaintext_bytes', 'xml_bytes'))
+        if not self.parallel or len(pipeline) < 2 or size < self.parallel_min_bytes:
+            unavailable = {}
+            for processor in pipeline:
+                try:
+                    pipeline[processor].run(book)
+                except (requests.exceptions.HTTPError, CacheMissError) as e:
+                    unavailable[processor] = _unavailable_reason(e)
+            return unavailable
+
+        workers = min(len(pipeline), self.workers or os.cpu_count() or 1)
+        if self.parallel == 'processes':
+            executor = self.process_pool()
+            # Streaming its source needs the book's session
+            streaming = [p for p in pipeline if not set(getattr(pipeline[p], 'inputs', ()))
+                         <= set(getattr(pipeline[p], 'sources', ()))]
+            pooled = [p for p in pipeline if p not in streaming]
+            # Each worker reads the sources from shared memory, and computes
+            # what its processors share (e.g. tokens) once, as they run
+            segment, spans = _share_sources(
+                book, {s for p in pooled for s in getattr(pipeline[p], 'inputs', ())})
+            try:
+                runs = {p: executor.submit(_run_processor, pipeline[p], BookSources(
+                    book, getattr(pipeline[p], 'inputs', ()), segment, spans)) for p in pooled}
+                with ThreadPoolExecutor(max(len(streaming), 1)) as threads:
+                    runs.update((p, threads.submit(pipeline[p].run, book)) for p in streaming)
+                    wait(runs.values())
+            finally:
+                segment.close()
+                segment.unlink()
+        elif self.parallel == 'threads':
+            # Whatever processors share (e.g. tokens) is computed once, up
+            # front, so that while running concurrently they only read the book
+            for processor in pipeline.values():
+                if hasattr(processor, 'prepare'):
+                    processor.prepare(book)
+            with ThreadPoolExecutor(workers) as executor:
+                runs = {p: executor.submit(pipeline[p].run, book) for p in pipeline}
+        else:
+            raise ValueError('parallel must be one of: threads, processes')
+        unavailable = {}
+        for processor, run in runs.items():
+            try:
+                results = run.result()
+            except (requests.exceptions.HTTPError, CacheMissError) as e:
+                unavailable[processor] = _unavailable_reason(e)
+                continue
+            if self.parallel == 'processes' and processor not in streaming:
+                pipeline[processor] = _ProcessedProcessor(pipeline[processor], results)
+        return unavailable
+
+    def stale_modules(self, book, genome):
+        """
+        Modules of the pipeline which are missing from genome, or whose
+        results in it came from another version of the module or its
+        processor, or from different source files. Genomes predating
+        versions and fingerprints are taken to be from version 1 and from
+        the current source files. Modules whose sources the item doesn't
+        have (e.g. Djvu XML) can't be rerun, so aren't stale.
+        :param book: an `internetarchive` Item
+        :param dict genome: a Sequence's results, e.g. from book_genome.json
+        :rtype: {processor: [module]}
+        """
+        pipeline = self.pipeline() if callable(self.pipeline) else self.pipeline
+        processors = genome.get('metadata', {}).get('processors', {})
+        stale = {}
+        for p in pipeline:
+            processor_meta = processors.get(p, {})
+            fingerprint = source_fingerprint(book, getattr(pipeline[p], 'inputs', ()))
+            if None in fingerprint.values():
+                continue
+            for m in pipeline[p].modules:
+                module_meta = processor_meta.get('modules', {}).get(m)
+                if (m not in genome or module_meta is None
+                        or processor_meta.get('version', 1) != getattr(pipeline[p], 'version', 1)
+                        or module_meta.get('version', 1) != getattr(pipeline[p].modules[m], 'version', 1)
+                        or module_meta.get('fingerprint', fingerprint) != fingerprint):
+                    stale.setdefault(p, []).append(m)
+        return stale
+
+    def resequence(self, book, genome):
+        """
+        Runs only the modules which are stale in genome (see
+        stale_modules), fetching only the sources they read
+        :param  [str|ia.Item] book: an Archive.org book Item or Item.identifier
+        :param dict genome: the book's existing genome (a Sequence's results)
+        :return: a Sequence whose results are genome with the rerun modules'
+            results merged in; its `rerun` is {processor: [module]} (empty
+            if genome was up to date, or no stale module could be rerun)
+        """
+        import requests
+
+        sequence_tic = time.perf_counter()
+        try:
+            _book = self.get_book(book)
+        except requests.exceptions.ConnectionError:
+            raise Exception('Connection error retrieving metadata for - ' + str(book))
+        if not _book.exists:
+            raise Exception(_book.identifier + ' - Item cannot be found.')
+        stale = self.stale_modules(_book, genome)
+        pipeline = self.spawn_pipeline()
+        pipeline = {p: pipeline[p] for p in pipeline if p in stale}
+        for p in pipeline:
+            pipeline[p].modules = {m: pipeline[p].modules[m] for m in stale[p]}
+        sq = self.Sequence(
+            pipeline,
+            _book,
+            access=self.access,
+            secret=self.secret,
+            session=self.ia,
+            base=genome,
+            compression=self.genome_compression
+        )
+        self.run_sequence(sq)
+        # Less any processors skipped for want of a source
+        sq.rerun = {p: stale[p] for p in sq.pipeline}
+        sq.sequence_time = round(time.perf_counter() - sequence_tic, 3)
+        return sq
+
+    def sequence_many(self, books, prefetch=4, workers=None):
+        """
+        Sequences books one after another while background threads
+        prefetch the next `prefetch` books' metadata and sources
+        :param iterable books: Archive.org book Items or identifiers
+        :return: (book, Sequence or the Exception raised sequencing it)
+            for each book, in order; stats are logged once done
+        """
+        if self.parallel == 'processes':
+            # Fork the workers before any prefetching thread starts
+            self.process_pool()
+        prefetcher = Prefetcher(self.prefetch, books, depth=prefetch, workers=workers)
+        for book, _book, error in prefetcher:
+            try:
+                yield book, self.sequence(_book if _book is not None else book)
+            except Exception as e:
+                yield book, e
+        logging.info('Prefetch stats - ' + json.dumps(prefetcher.stats))
+        self.prefetch_stats = prefetcher.stats
+
+    def sequence(self, book):
+        """
+        :param  [str|ia.Item] book: an Archive.org book Item or Item.identifier
+        :return: the book's Sequence; processors whose sources are missing
+            are skipped (see run_sequence)
+        """
+        import requests
+
+        sequence_tic = time.perf_counter()
+        try:
+            _book = self.get_book(book)
+            sq = self.Sequence(
+                self.spawn_pipeline(),
+                _book,
+                access=self.access,
+                secret=self.secret,
+                session=self.ia,
+                compression=self.genome_compression
+            )
+        except requests.exceptions.ConnectionError:
+            raise Exception('Connection error retrieving metadata for - ' + str(book))
+        if not sq.book.exists:
+            raise Exception(sq.book.identifier + ' - Item cannot be found.')
+        self.run_sequence(sq)
+        sequence_toc = time.perf_counter()
+        sq.sequence_time = round(sequence_toc - sequence_tic, 3)
+        return sq
+
+
+def _default_sequencer():
+    return Sequencer({
+        '3gram': NGramProcessor(modules={
+            '3grams': WordFreqModule(compact=numpy_installed())
+        }, n=3, threshold=2, stop_words=None),
+        '2gram': NGramProcessor(modules={
+            '2grams': WordFreqModule(compact=numpy_installed())
+        }, n=2, threshold=3, stop_words=STOP_WORDS),
+        '1gram': NGramProcessor(modules={
+            '1grams': WordFreqModule(),
+            'urls': UrlExtractorModule()
+        }, n=1, stop_words=None),
+        'fulltext': FulltextProcessor(modules={
+            'readinglevel': ReadingLevelModule()
+        }),
+        'pagetypes': PageTypeProcessor(modules={
+            'copyright_page': CopyrightPageDetectorModule(),
+            'backpage_isbn': BackpageIsbnExtractorModule()
+        })
     })
-})
-
-MINIMAL_SEQUENCER = Sequencer({
-    '2gram': NGramProcessor(modules={
-        '2grams': WordFreqModule()
-    }, n=2, threshold=2, stop_words=STOP_WORDS),
-    '1gram': NGramProcessor(modules={
-        '1grams': WordFreqModule(),
-        'urls': UrlExtractorModule()
-    }, n=1, stop_words=None),
-    'pagetypes': PageTypeProcessor(modules={
-        'copyright_page': CopyrightPageDetectorModule(),
-        'backpage_isbn': BackpageIsbnExtractorModule()
+
+def _minimal_sequencer():
+    return Sequencer({
+        '2gram': NGramProcessor(modules={
+            '2grams': WordFreqModule(compact=numpy_installed())
+        }, n=2, threshold=2, stop_words=STOP_WORDS),
+        '1gram': NGramProcessor(modules={
+            '1grams': WordFreqModule(),
+            'urls': UrlExtractorModule()
+        }, n=1, stop_words=None),
+        'pagetypes': PageTypeProcessor(modules={
+            'copyright_page': CopyrightPageDetectorModule(),
+            'backpage_isbn': BackpageIsbnExtractorModule()
+        })
     })
-})
+
+
+_LAZY_SEQUENCERS = {
+    'DEFAULT_SEQUENCER': _default_sequencer,
+    'MINIMAL_SEQUENCER': _minimal_sequencer,
+}
+
+def __getattr__(name):
+    """Builds the default sequencers and imports `ia` on first access"""
+    if name in _LAZY_SEQUENCERS:
+        globals()[name] = _LAZY_SEQUENCERS[name]()
+        return globals()[name]
+    if name == 'ia':
+        return _load_ia()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+if 'internetarchive' in sys.modules:
+    # Already paid for, so patch Item for code using internetarchive directly
+    _load_ia()
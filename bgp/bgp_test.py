@@ -1,8 +1,11 @@
+import re
+import subprocess
+import sys
 import unittest
 
 from bgp import ia
 from bgp.utils import STOP_WORDS
-from bgp.modules.terms import NGramProcessor
+from bgp.modules.terms import NGramProcessor, WordFreqModule
 
 try:  # TODO: create bgp.runner
     from bgp import DEFAULT_SEQUENCER
@@ -34,3 +37,944 @@ class TestSequencer(unittest.TestCase):
         book = "be be water be a small a any anyhow anyone 2 3 4 5 anything anyway anywhere are around at back be became because become becomes becoming been before beforehand behind being below beside besides between beyond both bottom but by call can cannot could did do does doing melon be"
         ngrams = NGramProcessor.fulltext_to_ngrams(book, n=2, stop_words=STOP_WORDS)
         assert ngrams == ['water small', 'small melon'], ngrams
+
+    def test_compact_ngram_counts(self):
+        class book:
+            plaintext = "the cat, the cat sat. on the mat the cat sat on the mat - the"
+        for n in (1, 2, 3):
+            results = []
+            for compact in (False, True):
+                p = NGramProcessor(modules={'f': WordFreqModule(compact=compact)}, n=n, threshold=2)
+                p.run(book())
+                results.append(p.results['modules']['f']['results'])
+            assert results[0] == results[1], results
+
+    def test_heavy_hitters(self):
+        import random
+        from collections import Counter
+        from bgp.sketch import CountMinSketch, HeavyHitters
+
+        rng = random.Random(5)
+        words = ['w%d' % int(rng.paretovariate(1)) for _ in range(20000)]
+        exact = Counter(words)
+        # Narrow enough that terms collide
+        sketch = CountMinSketch(width=64, depth=3)
+        for word in words:
+            sketch.add(word)
+        assert all(sketch[word] >= count for word, count in exact.items())
+        # With few collisions, conservative updates keep counts exact
+        sketch = CountMinSketch(width=2 ** 16, depth=3)
+        for word, count in exact.items():
+            sketch.add(word, count)
+        assert all(sketch[word] == count for word, count in exact.items())
+        assert CountMinSketch(width=64)['missing'] == 0
+
+        hitters = HeavyHitters(10, threshold=50, width=4096)
+        hitters.update(Counter(words[:10000]).items())
+        hitters.update(Counter(words[10000:]).items())
+        assert len(hitters.counts) <= 10
+        assert all(count >= 50 for count in hitters.counts.values())
+        top = [word for word, _ in exact.most_common(5)]
+        assert all(hitters.counts[word] >= exact[word] for word in top), hitters.counts
+
+        # Streamed and approximate counts of a book, thresholded as they're counted
+        class book:
+            plaintext = ' '.join(words[:3000])
+
+            def iter_plaintext(self, chunk_size):
+                for i in range(0, len(self.plaintext), chunk_size):
+                    yield self.plaintext[i:i + chunk_size]
+
+        results = []
+        for chunk_size, max_terms in ((None, None), (100, None), (100, 1000)):
+            p = NGramProcessor(modules={'f': WordFreqModule(max_terms=max_terms)},
+                               n=2, threshold=3, chunk_size=chunk_size)
+            p.run(book())
+            results.append(dict(p.results['modules']['f']['results']))
+        assert results[0] == results[1]
+        assert results[2].keys() >= results[0].keys()
+        assert all(results[2][term] >= count for term, count in results[0].items())
+
+    def test_content_cache(self):
+        import os
+        import tempfile
+        import time
+        from bgp.cache import ContentCache
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for compression in (None, 'gzip'):
+                cache = ContentCache(os.path.join(tmp, str(compression)), compression=compression)
+                key = cache.key('book', 'book_djvu.txt', md5='abc')
+                assert key != cache.key('book', 'book_djvu.txt', md5='abd')
+                assert cache.get(key) is None
+                cache.put(key, b'the cat sat' * 100)
+                assert cache.get(key) == b'the cat sat' * 100
+                with cache.open(key) as f:
+                    assert f.read(7) == b'the cat'
+                if compression:
+                    assert os.path.getsize(cache.filename(key)) < 1100
+
+            # Offline caches read but never write
+            offline = ContentCache(os.path.join(tmp, 'None'), offline=True)
+            assert offline.get(key) == b'the cat sat' * 100
+            offline.put(offline.key('other', 'x'), b'x')
+            assert offline.get(offline.key('other', 'x')) is None
+
+            # Least recently used entries are evicted beyond max_bytes, and
+            # overwriting an entry doesn't count it twice
+            cache = ContentCache(os.path.join(tmp, 'lru'), max_bytes=1000)
+            keys = [cache.key('book%d' % n, 'x') for n in range(4)]
+            for n, key in enumerate(keys[:2]):
+                cache.put(key, b'x' * 100)
+                os.utime(cache.filename(key), (time.time() + n, time.time() + n))
+            for _ in range(10):
+                cache.put(keys[1], b'x' * 100)
+            assert cache._size == 200
+            cache.max_bytes = 250
+            os.utime(cache.filename(keys[0]), (time.time() + 10, time.time() + 10))
+            cache.put(keys[2], b'x' * 100)
+            assert cache._size == 200
+            assert [cache.get(key) is not None for key in keys] == [True, False, True, False]
+
+    def test_lexile_client(self):
+        import os
+        import tempfile
+        import threading
+        import time
+        from bgp.lexile import LexileClient
+
+        class Response:
+            def __init__(self, status_code, data=None):
+                self.status_code = status_code
+                self.data = data
+
+            def json(self):
+                if self.data is None:
+                    raise ValueError('No JSON')
+                return self.data
+
+        class Session:
+            def __init__(self):
+                self.requests = []
+                self.lock = threading.Lock()
+
+            def get(self, url, headers=None):
+                isbn = url.rsplit('/', 1)[1]
+                with self.lock:
+                    self.requests.append(isbn)
+                    retried = self.requests.count(isbn) > 1
+                if isbn.startswith('978'):
+                    return Response(200, {'isbn': isbn, 'lexile': 800})
+                if isbn == 'busy' and not retried:
+                    return Response(503)
+                return Response(404, {'error': 'not found'})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            session = Session()
+            client = LexileClient(os.path.join(tmp, 'lexile.sqlite3'), rate=1000, burst=1000,
+                                  session=session)
+            assert client.get('9780262517638') == (200, {'isbn': '9780262517638', 'lexile': 800})
+            assert client.get('0000000000') == (404, {'error': 'not found'})
+            assert client.get('busy') == (503, None)
+            # Found and not found results are cached, transient failures aren't
+            assert client.get('9780262517638')[0] == 200 and client.get('0000000000')[0] == 404
+            assert client.get('busy')[0] == 404
+            assert session.requests == ['9780262517638', '0000000000', 'busy', 'busy']
+            assert set(client.cached_many(['9780262517638', 'busy', 'other'])) == {
+                '9780262517638', 'busy'}
+            client.negative_ttl = 0
+            assert client.cached('0000000000') is None and client.cached('9780262517638')
+
+            isbns = ['9780262517638', '9781000000001', '', None, '9781000000001', 123]
+            results = dict(client.iter_many(isbns, concurrency=2, chunk_size=2))
+            assert sorted(results) == ['123', '9780262517638', '9781000000001']
+            assert results['123'][0] == 404 and results['9781000000001'][0] == 200
+            assert session.requests[4:] in (['9781000000001', '123'], ['123', '9781000000001'])
+
+            # The token bucket allows burst requests at once, then rate a second
+            client = LexileClient(os.path.join(tmp, 'bucket.sqlite3'), rate=20, burst=2)
+            tic = time.monotonic()
+            for _ in range(6):
+                client.acquire()
+            assert 0.15 < time.monotonic() - tic < 1, time.monotonic() - tic
+
+    def test_lexile_pipeline_retries_transient_failures(self):
+        import csv
+        import os
+        import tempfile
+        from functools import partial
+        from bgp.lexile import LexileClient
+        from bgp.pipelines import lexile
+
+        class Response:
+            def __init__(self, status_code, data):
+                self.status_code = status_code
+                self.data = data
+
+            def json(self):
+                return self.data
+
+        class Session:
+            busy = True
+
+            def get(self, url, headers=None):
+                isbn = url.rsplit('/', 1)[1]
+                if isbn == '9780262517638':
+                    return Response(200, {'success': True, 'isbn': isbn})
+                if self.busy:
+                    return Response(503, None)
+                return Response(404, {'success': False, 'error_msg': 'not found'})
+
+        cwd = os.getcwd()
+        get_isbn_items, client = lexile.get_isbn_items, lexile.LexileClient
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                os.chdir(tmp)
+                session = Session()
+                lexile.get_isbn_items = lambda query: [
+                    {'isbn': ['9780262517638']}, {'isbn': ['0262517639']}, {'isbn': ['9780306406157']}]
+                lexile.LexileClient = partial(LexileClient, os.path.join(tmp, 'lexile.sqlite3'),
+                                              rate=1000, burst=1000, session=session)
+                lexile.main()
+                with open('log.csv') as f:
+                    assert [row['isbn'] for row in csv.DictReader(f)] == ['9780262517638']
+                session.busy = False
+                lexile.main()
+                with open('log.csv') as f:
+                    rows = list(csv.DictReader(f))
+                assert sorted(row['isbn'] for row in rows) == ['9780262517638', '9780306406157']
+                assert [row['error_msg'] for row in rows if row['success'] == 'False'] == ['not found']
+                with open('successes.jsonl') as f:
+                    assert len(f.readlines()) == 1
+            finally:
+                os.chdir(cwd)
+                lexile.get_isbn_items, lexile.LexileClient = get_isbn_items, client
+
+    def test_scheduler(self):
+        import os
+        import signal
+        from bgp.scheduler import Scheduler, WorkerDied
+
+        # The costliest of the next processes + lookahead items starts first
+        # (ties in input order)
+        scheduler = Scheduler(lambda item: item * 10, processes=1, lookahead=2,
+                              cost=lambda item: item)
+        finished = list(scheduler.run(iter([3, 1, 4, 1, 5, 9, 2, 6])))
+        assert [item for item, _, _ in finished] == [4, 3, 5, 9, 2, 6, 1, 1]
+        assert all(result == item * 10 and error is None for item, result, error in finished)
+        scheduler = Scheduler(lambda item: item, processes=1, cost=lambda item: item)
+        assert [item for item, _, _ in scheduler.run([3, 1, 4])] == [3, 1, 4]
+
+        # Workers are replaced after max_tasks_per_worker tasks, or once too large
+        scheduler = Scheduler(lambda item: os.getpid(), max_tasks_per_worker=2)
+        pids = [pid for _, pid, _ in scheduler.run(range(5))]
+        assert pids[0] == pids[1] != pids[2] == pids[3] != pids[4], pids
+        assert os.getpid() not in pids
+        assert scheduler.stats == {'completed': 5, 'failed': 0, 'recycled': 2, 'died': 0}
+        scheduler = Scheduler(lambda item: os.getpid(), max_rss_bytes=1)
+        assert len(set(pid for _, pid, _ in scheduler.run(range(3)))) == 3
+
+        # A killed worker fails its task, and the rest run on a new worker
+        def run(item):
+            if item == 'kill':
+                os.kill(os.getpid(), signal.SIGKILL)
+            if item == 'raise':
+                raise ValueError(item)
+            return item
+
+        scheduler = Scheduler(run, processes=2)
+        finished = {item: (result, error)
+                    for item, result, error in scheduler.run(['a', 'kill', 'b', 'raise', 'c', 'd'])}
+        assert isinstance(finished.pop('kill')[1], WorkerDied)
+        assert isinstance(finished.pop('raise')[1], ValueError)
+        assert finished == {item: (item, None) for item in 'abcd'}
+        assert scheduler.stats == {'completed': 4, 'failed': 2, 'recycled': 0, 'died': 1}
+
+    def test_prefetcher(self):
+        import json
+        import threading
+        import time
+        from bgp import Sequencer
+        from bgp.prefetch import Prefetcher
+
+        started = []
+        lock = threading.Lock()
+
+        def fetch(book):
+            with lock:
+                started.append(book)
+            # Every third book's fetch finishes after the next ones'
+            time.sleep(0.05 if book % 3 == 0 else 0)
+            if book == 4:
+                raise ValueError(book)
+            return book * 10
+
+        prefetcher = Prefetcher(fetch, range(10), depth=3)
+        taken = []
+        for book, fetched, error in prefetcher:
+            # No more than depth books are fetched ahead of the one taken
+            assert len(started) <= book + 1 + 3, (book, started)
+            taken.append(book)
+            if book == 4:
+                assert fetched is None and isinstance(error, ValueError)
+            else:
+                assert fetched == book * 10 and error is None
+        assert taken == list(range(10))
+        assert sorted(started) == list(range(10))
+        stats = prefetcher.stats
+        assert stats['fetched'] == 10 and stats['queue_depth'] == 0
+        assert stats['max_queue_depth'] == 3
+        # The consumer waited on the slow (concurrent) fetches
+        assert stats['consumer_wait_time'] > 0.09, stats
+
+        # CPU bound: fetches are done well before the consumer takes them
+        prefetcher = Prefetcher(lambda book: book, range(6), depth=2)
+        for _ in prefetcher:
+            time.sleep(0.02)
+        assert prefetcher.stats['fetched'] == 6
+        assert prefetcher.stats['backpressure'] >= 3, prefetcher.stats
+        assert prefetcher.stats['consumer_wait_time'] < 0.02, prefetcher.stats
+
+        # sequence_many logs its prefetcher's stats once every book is taken
+        sequencer = Sequencer({})
+        sequencer.prefetch = lambda book: book + '!'
+        sequencer.sequence = lambda book: book.upper()
+        with self.assertLogs(level='INFO') as logs:
+            sequenced = list(sequencer.sequence_many(['a', 'b', 'c'], prefetch=2))
+        assert sequenced == [('a', 'A!'), ('b', 'B!'), ('c', 'C!')]
+        message, = [m.split(' - ', 1)[1] for m in logs.output if 'Prefetch stats' in m]
+        assert json.loads(message) == sequencer.prefetch_stats
+        assert sequencer.prefetch_stats['fetched'] == 3
+
+    def test_downloads_keep_the_pooled_adapter(self):
+        import io
+        import requests
+        from requests.adapters import HTTPAdapter
+        from bgp import _load_ia, get_book_items, sessions
+
+        session = sessions.mount(_load_ia().get_session())
+        adapter = session.get_adapter('https://archive.org/')
+        sent = []
+
+        def send(self, request, **kwargs):
+            sent.append((self, request.url, kwargs.get('timeout')))
+            response = requests.Response()
+            response.status_code = 200
+            response.url = request.url
+            response.request = request
+            response.raw = io.BytesIO(b'the cat sat on the mat')
+            return response
+
+        files = [{'name': 'b_djvu.txt', 'format': 'DjVuTXT', 'md5': 'a', 'mtime': '1'}]
+        original_send = HTTPAdapter.send
+        HTTPAdapter.send = send
+        try:
+            for n in range(2):
+                book = session.get_item('b%d' % n, item_metadata={
+                    'metadata': {'identifier': 'b%d' % n}, 'files': files})
+                if n:  # streamed
+                    assert ''.join(book.iter_plaintext(chunk_size=4)) == 'the cat sat on the mat'
+                else:
+                    assert book.plaintext == 'the cat sat on the mat'
+            get_book_items('the cat', session=session)
+        finally:
+            HTTPAdapter.send = original_send
+        assert session.get_adapter('https://archive.org/') is adapter
+        assert [url for _, url, _ in sent] == [
+            'https://archive.org/download/b0/b_djvu.txt?cnt=0',
+            'https://archive.org/download/b1/b_djvu.txt?cnt=0']
+        # Every download went through the pooled adapter, with its timeout
+        assert all(a is adapter and timeout == sessions.SETTINGS['timeout']
+                   for a, _, timeout in sent), sent
+
+    def test_genome_encoded_once(self):
+        import json
+        import os
+        import tempfile
+        import bgp
+        from bgp import Sequencer, genome
+        from bgp.genome import load_genome
+
+        class File:
+            md5 = 'md5'
+
+        class Session:
+            def get_item(self, identifier):
+                raise AssertionError('the book Item is uploaded through')
+
+        class Item:
+            session = Session()
+            exists = True
+            plaintext = 'the cat sat on the mat. the cat sat.'
+
+            def __init__(self, identifier):
+                self.identifier = identifier
+                self.uploads = []
+
+            def get_files(self, formats):
+                return [File()]
+
+            def upload(self, files, **kwargs):
+                for name, filename in files.items():
+                    with open(filename, 'rb') as f:
+                        self.uploads.append((name, f.read()))
+
+        calls = []
+
+        def counted(name, fn):
+            def wrapper(*args, **kwargs):
+                calls.append(name)
+                return fn(*args, **kwargs)
+            return wrapper
+
+        originals = bgp.encode_genome, genome.encode_genome, genome.iter_genome_lines
+        bgp.encode_genome = counted('encode', bgp.encode_genome)
+        genome.encode_genome = counted('genome.encode', genome.encode_genome)
+        genome.iter_genome_lines = counted('lines', genome.iter_genome_lines)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = tmp + '/'
+                for compression, upload_first in ((None, False), (None, True), ('gzip', False)):
+                    del calls[:]
+                    book = Item('%s%s' % (compression, upload_first))
+                    sequencer = Sequencer({'1gram': NGramProcessor(
+                        modules={'1grams': WordFreqModule()}, n=1)},
+                        genome_compression=compression)
+                    sequencer.get_book = lambda book: book
+                    sq = sequencer.sequence(book)
+                    if upload_first:
+                        sq.upload()
+                    sq.save(path=path)
+                    if not upload_first:
+                        sq.upload()
+                    if compression:
+                        # Lines encode their own values
+                        assert [c for c in calls if c != 'genome.encode'] == ['lines'], calls
+                    else:
+                        assert calls == ['encode'], (upload_first, calls)
+                    name, uploaded = book.uploads[0]
+                    assert len(book.uploads) == 1
+                    with open(os.path.join(path, book.identifier, name), 'rb') as f:
+                        assert f.read() == uploaded
+                    results = json.loads(json.dumps(sq.results))
+                    assert load_genome(path + book.identifier) == results
+                    if not compression:
+                        assert json.loads(uploaded) == results
+        finally:
+            bgp.encode_genome, genome.encode_genome, genome.iter_genome_lines = originals
+
+    def test_lazy_imports(self):
+        imported = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, bgp; print(" ".join(m for m in ("internetarchive", "requests", "lxml", "isbnlib") if m in sys.modules))'
+        ]).decode().strip()
+        assert imported == '', imported
+
+    def test_merge_genomes_keeps_processor_totals(self):
+        from bgp import merge_genomes
+        genome = {'1grams': [['cat', 2]], 'urls': [], 'metadata': {'processors': {'1gram': {
+            'total_tokens': 6490, 'modules': {'1grams': {'version': 1}, 'urls': {'version': 1}}}}}}
+        update = {'urls': ['http://x.org'], 'metadata': {'processors': {'1gram': {
+            'total_tokens': 3245, 'modules': {'urls': {'version': 2}}}}}}
+        merged = merge_genomes(genome, update)
+        processor = merged['metadata']['processors']['1gram']
+        assert processor['total_tokens'] == 6490, processor
+        assert processor['modules'] == {'1grams': {'version': 1}, 'urls': {'version': 2}}, processor
+        assert merged['urls'] == ['http://x.org'] and merged['1grams'] == [['cat', 2]]
+        update['metadata']['processors']['1gram']['modules']['1grams'] = {'version': 2}
+        processor = merge_genomes(genome, update)['metadata']['processors']['1gram']
+        assert processor['total_tokens'] == 3245, processor
+
+    def test_resequence_without_djvu_xml(self):
+        import requests
+        from bgp import Sequencer
+        from bgp.modules.terms import PageTypeProcessor, CopyrightPageDetectorModule
+
+        class File:
+            md5 = 'md5'
+
+        class Item:
+            identifier = 'noxml'
+            exists = True
+            session = None
+            formats = ('DjVuTXT',)
+            plaintext = 'the cat sat on the mat. the cat sat.'
+
+            def get_files(self, formats):
+                return [File()] if formats[0] in self.formats else []
+
+            @property
+            def xml_content(self):
+                raise requests.exceptions.HTTPError('403 Forbidden')
+
+        sequencer = Sequencer(lambda: {
+            '1gram': NGramProcessor(modules={'1grams': WordFreqModule()}, n=1),
+            'pagetypes': PageTypeProcessor(modules={'copyright_page': CopyrightPageDetectorModule()}),
+        })
+        sequencer.get_book = lambda book: book
+        genome = sequencer.sequence(Item()).results
+        assert 'copyright_page' not in genome and genome['1grams'], genome
+        assert sequencer.stale_modules(Item(), genome) == {}
+        resequenced = sequencer.resequence(Item(), genome)
+        assert resequenced.rerun == {} and resequenced.results['1grams'] == genome['1grams']
+        # A forbidden Djvu XML is skipped again, leaving the genome as it was
+        Item.formats = ('DjVuTXT', 'Djvu XML')
+        assert sequencer.stale_modules(Item(), genome) == {'pagetypes': ['copyright_page']}
+        resequenced = sequencer.resequence(Item(), genome)
+        assert resequenced.rerun == {}, resequenced.rerun
+        assert resequenced.results['1grams'] == genome['1grams']
+
+    def test_sequence_without_djvu_xml(self):
+        import requests
+        from bgp import Sequencer
+        from bgp.modules.terms import (BackpageIsbnExtractorModule, CopyrightPageDetectorModule,
+                                       PageTypeProcessor, UrlExtractorModule)
+
+        class File:
+            md5 = 'md5'
+
+        class Item:
+            identifier = 'noxml'
+            exists = True
+            session = None
+            metadata = {}
+            formats = ('DjVuTXT',)
+            plaintext = 'the cat sat on the mat. see http://x.org for the cat.'
+
+            def get_files(self, formats):
+                return [File()] if formats[0] in self.formats else []
+
+            @property
+            def xml_content(self):
+                if 'Djvu XML' not in self.formats:
+                    raise AssertionError('a missing source is never requested')
+                raise requests.exceptions.HTTPError('403 Forbidden')
+
+            @property
+            def last_page(self):
+                raise requests.exceptions.HTTPError('403 Forbidden')
+
+            def iter_pages(self):
+                raise requests.exceptions.HTTPError('403 Forbidden')
+                yield
+
+        def pipeline(streaming=False):
+            return {
+                '2gram': NGramProcessor(modules={'2grams': WordFreqModule()}, n=2),
+                '1gram': NGramProcessor(modules={
+                    '1grams': WordFreqModule(), 'urls': UrlExtractorModule()}, n=1),
+                'pagetypes': PageTypeProcessor(modules={
+                    'copyright_page': CopyrightPageDetectorModule(),
+                    'backpage_isbn': BackpageIsbnExtractorModule(),
+                }, streaming=streaming),
+            }
+
+        for formats, streaming, reason in (
+                (('DjVuTXT',), False, 'does not have Djvu XML'),
+                (('DjVuTXT', 'Djvu XML'), False, 'Djvu XML is forbidden'),
+                (('DjVuTXT', 'Djvu XML'), True, 'a source is forbidden')):
+            Item.formats = formats
+            sequencer = Sequencer(lambda: pipeline(streaming))
+            sequencer.get_book = lambda book: book
+            genome = sequencer.sequence(Item()).results
+            assert genome['1grams'] and genome['2grams'] and genome['urls'] == ['http://x.org']
+            assert 'copyright_page' not in genome and 'backpage_isbn' not in genome
+            assert genome['metadata']['skipped'] == {'pagetypes': reason}, genome['metadata']
+            assert set(genome['metadata']['processors']) == {'1gram', '2gram'}
+
+        # A book with neither source can't be sequenced
+        Item.formats = ()
+        sequencer = Sequencer(pipeline)
+        sequencer.get_book = lambda book: book
+        with self.assertRaises(Exception) as e:
+            sequencer.sequence(Item())
+        assert 'does not have' in str(e.exception)
+
+    def test_parallel_sequencing_matches_serial(self):
+        import os
+        import bgp
+
+        class File:
+            md5 = 'md5'
+
+        class Item:
+            exists = True
+            session = None
+            metadata = {}
+            xml_content = property(bgp._memoize_xml_content)
+            pages = property(bgp._memoize_pages)
+            plaintext = property(bgp._memoize_plaintext)
+
+            def __init__(self, identifier, words):
+                self.identifier = identifier
+                lines = [' '.join(words[i:i + 8]) + '.' for i in range(0, len(words), 8)]
+                self._plaintext = '\n'.join(lines)
+                self._xml_content = ('<DjVuXML><BODY>' + ''.join(
+                    '<OBJECT><PARAM name="PAGE" value="%s_%04d.djvu"/><LINE>%s</LINE></OBJECT>' % (
+                        identifier, i, ''.join('<WORD>%s</WORD>' % w for w in line.split(' ')))
+                    for i, line in enumerate(lines)) + '</BODY></DjVuXML>').encode('utf-8')
+
+            def get_files(self, formats):
+                return [File()]
+
+        def without_times(results):
+            if isinstance(results, dict):
+                return {k: without_times(v) for k, v in results.items()
+                        if k != 'metadata' and not k.endswith('time')}
+            return results
+
+        words = ('the café’s cat sat on the mat and the dog sat on the log '
+                 'copyright http://x.org isbn 9780262517638 ').split(' ') * 30
+        books = [('one', words), ('two', words[5:])]
+        segments = set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+        genomes = {}
+        for parallel in (None, 'threads', 'processes'):
+            sequencer = bgp._default_sequencer()
+            sequencer.parallel = parallel
+            sequencer.workers = 2
+            sequencer.get_book = lambda book: book
+            try:
+                for identifier, book_words in books:
+                    book = Item(identifier, book_words)
+                    if identifier == 'two':
+                        book.pages  # Parsed pages are sent rather than the XML
+                    genome = without_times(sequencer.sequence(book).results)
+                    # A worker reuses a book's sources only for that book
+                    assert genomes.setdefault(identifier, genome) == genome, (parallel, identifier)
+            finally:
+                sequencer.close()
+        assert genomes['one']['1grams'] != genomes['two']['1grams']
+        assert 'http://x.org' in genomes['one']['urls']
+        if os.path.isdir('/dev/shm'):
+            # Every book's shared memory is unlinked
+            assert set(os.listdir('/dev/shm')) <= segments
+
+    def test_page_detection_overlapping_keywords(self):
+        from bgp.modules.terms import KeywordPageDetectorModule, PageDetectionEngine
+        engine = PageDetectionEngine({
+            'a': KeywordPageDetectorModule(['copyright']),
+            'b': KeywordPageDetectorModule(['right']),
+        })
+        text = 'all copyright reserved'
+        assert engine.detect(text, ['b']) == {'b'}
+        assert engine.detect(text, ['a', 'b']) == {'a', 'b'}
+        assert engine.detect(text, ['a']) == {'a'}
+        assert engine.detect('all rights reserved', ['a']) == set()
+
+    def test_corpus_runs_keep_carriage_returns(self):
+        import os
+        import tempfile
+        from bgp.corpus import read_run, write_run
+        rows = [('a\rb', 2, 1), ('c\r', 3, 2), (' d', 1, 1)]
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'run')
+            write_run(filename, rows)
+            assert list(read_run(filename)) == rows
+
+    def test_corpus_aggregate(self):
+        import os
+        import random
+        import tempfile
+        from collections import Counter
+        from bgp.corpus import CorpusAggregate, iter_genomes, merge_runs, read_run, write_run
+        from bgp.genome import write_genome
+
+        rng = random.Random(7)
+        vocab = ['w%d' % i for i in range(60)] + ['x\ry', 'é']
+        genomes = {}
+        for n in range(12):
+            terms = rng.sample(vocab, 20)
+            genomes['book%02d' % n] = {
+                '1grams': [[term, rng.randint(1, 9)] for term in sorted(terms)],
+                '2grams': [] if n % 3 else [['%s %s' % (terms[0], terms[1]), 1]],
+                'metadata': {'identifier': 'book%02d' % n},
+            }
+
+        def expected(module, books):
+            counts, dfs = Counter(), Counter()
+            for book in books:
+                for term, count in genomes[book][module]:
+                    counts[term] += count
+                    dfs[term] += 1
+            return sorted((term, counts[term], dfs[term]) for term in counts)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            results = os.path.join(tmp, 'results')
+            for book in sorted(genomes)[:8]:
+                os.makedirs(os.path.join(results, book))
+                write_genome(os.path.join(results, book, 'book_genome.json'), genomes[book])
+            # A handful of terms per run, so every task spills several
+            aggregate = CorpusAggregate(os.path.join(tmp, 'corpus'), max_terms=25)
+            assert aggregate.add(iter_genomes(results), task_size=3) == 8
+            assert aggregate.documents == 8
+            assert list(aggregate.iter_table('1grams')) == expected('1grams', sorted(genomes)[:8])
+            # Adding again only counts the new books
+            for book in sorted(genomes)[8:]:
+                os.makedirs(os.path.join(results, book))
+                write_genome(os.path.join(results, book, 'book_genome.json'), genomes[book])
+            assert aggregate.add(iter_genomes(results), task_size=3) == 4
+            assert aggregate.add(iter_genomes(results)) == 0
+            assert aggregate.documents == 12
+            for module in ('1grams', '2grams'):
+                assert list(aggregate.iter_table(module)) == expected(module, genomes)
+            assert list(aggregate.iter_table('3grams')) == []
+            top = aggregate.most_common('1grams', k=3)
+            assert [row[1] for row in top] == sorted(
+                (row[1] for row in expected('1grams', genomes)), reverse=True)[:3]
+            # Merging in several passes
+            runs = []
+            for i in range(5):
+                runs.append(os.path.join(tmp, 'run%d' % i))
+                write_run(runs[-1], [('a', i, 1), ('b%d' % i, 1, 1)])
+            merge_runs(runs, os.path.join(tmp, 'merged'), tmp, fan_in=2)
+            assert list(read_run(os.path.join(tmp, 'merged'))) == (
+                [('a', 10, 5)] + [('b%d' % i, 1, 1) for i in range(5)])
+
+    def test_index(self):
+        import os
+        import random
+        import tempfile
+        from bgp.corpus import iter_genomes
+        from bgp.genome import write_genome
+        from bgp.index import (Index, decode_postings, decode_varints, encode_postings,
+                               encode_varints, genome_terms)
+
+        numbers = [0, 1, 127, 128, 255, 16383, 16384, 2 ** 32, 2 ** 63 - 1]
+        data = encode_varints(numbers)
+        assert len(encode_varints([127])) == 1 and len(encode_varints([128])) == 2
+        assert decode_varints(data) == (numbers, len(data))
+        assert decode_varints(data, 0, 3) == (numbers[:3], 3)
+        postings = [(0, 1), (1, 300), (200, 2), (2 ** 40, 1)]
+        assert decode_postings(b'\xff' + encode_postings(postings), 1) == postings
+        assert decode_postings(encode_postings([])) == []
+
+        assert genome_terms({
+            '1grams': [['cat', 2]],
+            'urls': ['http://x.org', 'http://x.org'],
+            'backpage_isbn': ['9780262517638'],
+            'copyright_page': [{'page': '0004', 'isbns': ['9780262517638', '0262517639']}],
+        }) == {
+            '1grams': {'cat': 2}, '2grams': {}, '3grams': {},
+            'urls': {'http://x.org': 2},
+            'isbns': {'9780262517638': 2, '0262517639': 1},
+        }
+
+        rng = random.Random(3)
+        vocab = ['w%d' % i for i in range(40)] + ['é']
+        genomes = {}
+        for n in range(23):
+            genomes['book%02d' % n] = {
+                '1grams': [[term, rng.randint(1, 500)] for term in rng.sample(vocab, 10)],
+                'urls': ['http://x.org/%d' % (n % 4)],
+            }
+        expected = {}
+        for book, genome in genomes.items():
+            for field, terms in genome_terms(genome).items():
+                for term, count in terms.items():
+                    expected.setdefault((field, term), []).append((book, count))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            results = os.path.join(tmp, 'results')
+            for book in genomes:
+                os.makedirs(os.path.join(results, book))
+                write_genome(os.path.join(results, book, 'book_genome.json'), genomes[book])
+            index = Index(os.path.join(tmp, 'index'), max_segments=2)
+            # Segments of a few books, merged as they accumulate
+            assert index.add(iter_genomes(results), segment_size=3) == 23
+            assert index.add(iter_genomes(results), segment_size=3) == 0
+            assert 1 < len(index.manifest()) <= 3
+            assert index.identifiers() == set(genomes)
+
+            def check():
+                for (field, term), books in expected.items():
+                    assert sorted(index.lookup(field, term)) == sorted(books), (field, term)
+                assert index.lookup('1grams', 'missing') == []
+                assert index.lookup('urls', 'w1') == []
+
+            check()
+            index.merge()
+            assert len(index.manifest()) == 1
+            check()
+            index.close()
+            assert sorted(os.listdir(os.path.join(tmp, 'index'))) == [
+                index.manifest()[0], 'segments.json']
+
+    def test_status_store(self):
+        import multiprocessing
+        import os
+        import tempfile
+        from bgp.status import STATUS_FILENAME, StatusStore
+
+        with tempfile.TemporaryDirectory() as tmp:
+            touched = {
+                'a_b': {'ISBN_9780262517638_a_b': '', 'URLS_2_a_b': 'http://x.org\nhttp://y.org\n',
+                        'GENOME_UPDATED_a_b': '', 'notes.txt': 'kept'},
+                'c': {'SEQUENCE_FAILURE_c': 'Traceback...', 'UPDATE_CONFLICT_c': '',
+                      'ISBN_x_a_b': ''},
+            }
+            for identifier, files in touched.items():
+                os.makedirs(os.path.join(tmp, identifier))
+                for filename, content in files.items():
+                    with open(os.path.join(tmp, identifier, filename), 'w') as f:
+                        f.write(content)
+            store = StatusStore(os.path.join(tmp, STATUS_FILENAME))
+            assert store.migrate(tmp, remove=True) == 5
+            assert sorted(os.listdir(os.path.join(tmp, 'a_b'))) == ['notes.txt']
+            assert os.listdir(os.path.join(tmp, 'c')) == ['ISBN_x_a_b']
+            assert store.get('a_b') == {
+                'ISBN': ('9780262517638', None),
+                'URLS': ('2', 'http://x.org\nhttp://y.org\n'),
+                'GENOME_UPDATED': (None, None),
+            }
+            assert store.get('c') == {
+                'SEQUENCE_FAILURE': (None, 'Traceback...'), 'UPDATE_CONFLICT': (None, None)}
+            assert store.stats() == {'GENOME_UPDATED': 1, 'ISBN': 1, 'SEQUENCE_FAILURE': 1,
+                                     'UPDATE_CONFLICT': 1, 'URLS': 1}
+            assert [row['identifier'] for row in store.export('ISBN')] == ['a_b']
+
+            # Buffered writes are seen by get, and removals undo sets
+            store.set('d', 'UPDATE_FAILED')
+            store.remove('c', 'SEQUENCE_FAILURE')
+            assert store.get('d') == {'UPDATE_FAILED': (None, None)}
+            assert 'SEQUENCE_FAILURE' not in store.get('c')
+            store.flush()
+
+            # Forked workers' buffered writes are committed when they exit,
+            # and the parent's aren't committed twice
+            store.set('e', 'UPDATE_NONE')
+
+            def work(identifier):
+                store.set(identifier, 'ISBN', value='0262517639')
+
+            context = multiprocessing.get_context('fork')
+            workers = [context.Process(target=work, args=('w%d' % n,)) for n in range(3)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+                assert worker.exitcode == 0
+            assert store.get('w1') == {'ISBN': ('0262517639', None)}
+            assert [row['identifier'] for row in store.export('ISBN')] == ['a_b', 'w0', 'w1', 'w2']
+            assert store.stats()['UPDATE_NONE'] == 1
+            assert 'SEQUENCE_FAILURE' not in store.stats()
+
+    def test_readability_scores(self):
+        from bgp import readability
+        simple = [
+            'The cat sat on the mat.', 'It was a warm day and the sun was out.',
+            'A dog ran down the road to find his ball.', 'Sam and Kim went to the park to play.',
+            'They had fun on the swings.', 'Then it began to rain, so they ran home.',
+            'Mom made soup for lunch.', 'After lunch they read a book about a big red bus.',
+            'The bus went all over the town.', 'At night they went to bed and slept well.',
+        ]
+        dense = [
+            'Institutional investment in renewable infrastructure accelerated considerably during the previous decade.',
+            'Governments introduced regulatory incentives encouraging photovoltaic installations across residential communities.',
+            'Consequently, manufacturing capacity expanded, and production costs decreased substantially.',
+            'Economists nevertheless emphasize that intermittent generation complicates electricity market organization.',
+            'Battery technologies, particularly lithium-ion varieties, partially mitigate these operational difficulties.',
+            'However, mineral extraction raises environmental and humanitarian considerations that policymakers cannot ignore.',
+            'International cooperation remains essential for establishing responsible supply chains.',
+            'Universities contribute fundamental research regarding alternative electrochemical compositions.',
+            'Meanwhile, utilities are modernizing transmission networks to accommodate distributed generation.',
+            'These developments collectively illustrate a remarkably complicated technological transition.',
+        ]
+
+        def scores(text):
+            stats = readability.text_stats(NGramProcessor.fulltext_to_tokens(text))
+            sentences = readability.split_sentences(text)
+            return readability.flesch_kincaid(stats, len(sentences)), readability.smog(sentences)
+
+        # (Flesch-Kincaid, SMOG) scored by py-readability-metrics 1.4.5
+        for sentences, expected in ((simple, (-0.1, 3.13)), (dense, (26.91, 18.56))):
+            fk, s = scores(' '.join(sentences * 4))
+            assert abs(fk - expected[0]) <= 0.6 and abs(s - expected[1]) <= 0.6, (fk, s, expected)
+        # Flesch-Kincaid needs 100 words, SMOG 30 sentences
+        assert scores(' '.join(simple)) == (None, None)
+        fk, s = scores(' '.join(dense * 2))
+        assert fk is not None and s is None
+
+    def test_isbn_extraction_matches_isbnlib(self):
+        import random
+        import isbnlib
+        from bgp.djvu import Page
+        from bgp.modules.terms import IsbnExtractorModule, replace_mistakes, rmpunk
+
+        def isbnlib_validate(isbn):
+            isbn = rmpunk(isbn).replace(' ', '')
+            if len(isbn) == 9:
+                isbn = '0' + isbn
+            if re.search(r'^(\d{9})(\d|X)', isbn):
+                if isbnlib.is_isbn10(isbn[:10]):
+                    return isbn[:10]
+                if re.search(r'^(\d{12})(\d)', isbn) and isbnlib.is_isbn13(isbn[:13]):
+                    return isbn[:13]
+
+        def isbnlib_extract(page):
+            # ISBN extraction as it was done with isbnlib, a line at a time
+            return [isbn for line in page.lines
+                    for isbn in map(isbnlib_validate, isbnlib.get_isbnlike(replace_mistakes(line), level='loose'))
+                    if isbn]
+
+        rng = random.Random(15)
+        chars = '0123456789XxIOlS- -  ab,.'
+
+        def line():
+            parts = []
+            for _ in range(rng.randint(0, 6)):
+                r = rng.random()
+                if r < 0.3:
+                    parts.append(''.join(rng.choice(chars) for _ in range(rng.randint(1, 22))))
+                elif r < 0.5:
+                    parts.append(''.join(str(rng.randint(0, 9)) for _ in range(9)) + rng.choice('0123456789X'))
+                elif r < 0.7:
+                    isbn = rng.choice(['978', '979', '977']) + ''.join(str(rng.randint(0, 9)) for _ in range(10))
+                    parts.append(isbn[:3] + '-' + isbn[3:5] + '-' + isbn[5:] if rng.random() < 0.5 else isbn)
+                else:
+                    parts.append(rng.choice(['ISBN', '0-262-51763-X', '9780262517638', 'ISBN 978-0-262-51763-8',
+                                             '000000000X', '0000000000', '123456789X', '12345678']))
+            return ' '.join(parts)
+
+        found = 0
+        for i in range(2000):
+            page = Page(i, '%04d' % i, [line() for _ in range(rng.randint(0, 30))])
+            expected = isbnlib_extract(page)
+            assert IsbnExtractorModule.extract_isbn(page) == expected, (page.lines, expected)
+            found += len(expected)
+        assert found > 1000, found
+
+    def test_genome_formats_round_trip(self):
+        import json
+        import os
+        import tempfile
+        from bgp.genome import find_genome, iter_genome_lines, load_genome, write_genome
+
+        results = {
+            '1grams': [['cat', 3], ['mat', 2], ['sat', 2], ['the', 5], ['é\r', 1]],
+            'urls': ['http://x.org'],
+            'copyright_page': [{'page': '0004', 'isbns': ['9780262517638']}],
+            'backpage_isbn': [],
+            'metadata': {'identifier': 'b', 'processors': {'1gram': {'total_time': 0.1}}},
+        }
+        lines = [json.loads(line) for line in iter_genome_lines(results, chunk_size=2)]
+        assert lines[0] == {'format': 'bgp-genome', 'version': 1}
+        assert lines[1] == {'key': '1grams', 'rows': 5}
+        assert lines[2:5] == [
+            {'terms': ['cat', 'mat'], 'counts': [3, 2]},
+            {'terms': ['sat', 'the'], 'counts': [2, 5]},
+            {'terms': ['é\r'], 'counts': [1]},
+        ]
+        assert lines[5] == {'key': 'urls', 'value': ['http://x.org']}
+        # Empty lists aren't tables
+        assert {'key': 'backpage_isbn', 'value': []} in lines
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ('book_genome.json', 'book_genome.jsonl.gz'):
+                path = os.path.join(tmp, name.split('.', 1)[1])
+                os.makedirs(path)
+                write_genome(os.path.join(path, name), results)
+                assert find_genome(path) == os.path.join(path, name)
+                assert load_genome(path) == results
+            # Tables of several (default sized) chunks
+            results['2grams'] = [['w%d x' % i, i] for i in range(1, 25001)]
+            write_genome(os.path.join(tmp, 'jsonl.gz', 'book_genome.jsonl.gz'), results)
+            assert load_genome(os.path.join(tmp, 'jsonl.gz')) == results
@@ -0,0 +1,143 @@
+"""
+    cache.py
+    ~~~~~~~~
+
+    Persistent, content-addressed on-disk cache of book source files
+    (DjVuTXT, Djvu XML) so re-sequencing doesn't re-download them.
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import gzip
+import hashlib
+import os
+import tempfile
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+class CacheMissError(Exception):
+    pass
+
+
+class ContentCache:
+
+    def __init__(self, path, max_bytes=None, compression=None, offline=False):
+        """
+        :param str path: directory in which to keep cached files
+        :param int max_bytes: if set, evict least recently used files once
+            the cache grows beyond this many (on-disk) bytes
+        :param str compression: None, 'gzip' or 'zstd' (requires the
+            `zstandard` package) compression of files at rest
+        :param bool offline: never download or write; sources missing from
+            the cache raise CacheMissError
+        """
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError('Unknown compression: %s' % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.offline = offline
+        self._size = None
+
+    @staticmethod
+    def key(identifier, name, md5=None, mtime=None):
+        """
+        Cache entries are addressed by the source file's identity and
+        version, so an updated file on archive.org is a different entry
+        """
+        return hashlib.sha256('\0'.join(
+            str(part) for part in (identifier, name, md5, mtime)
+        ).encode('utf-8')).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], key + COMPRESSION_EXTENSIONS[self.compression])
+
+    def open(self, key):
+        """
+        :return: a readable, decompressed binary file object for key, or
+            None if it's not cached
+        """
+        filename = self.filename(key)
+        try:
+            # GzipFile doesn't close a file object it's given, so opens its own
+            f = gzip.open(filename, 'rb') if self.compression == 'gzip' else open(filename, 'rb')
+        except FileNotFoundError:
+            return None
+        if not self.offline:
+            # Mark as recently used for LRU eviction
+            os.utime(filename)
+        if self.compression == 'zstd':
+            return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+        return f
+
+    def get(self, key):
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def put(self, key, content):
+        if self.offline:
+            return
+        filename = self.filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if self.compression == 'gzip':
+            content = gzip.compress(content)
+        elif self.compression == 'zstd':
+            content = zstandard.ZstdCompressor().compress(content)
+        # Write then rename so concurrent readers never see partial files
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        try:
+            replaced = os.path.getsize(filename)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp, filename)
+        if self.max_bytes:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self.entries())
+            else:
+                self._size += len(content) - replaced
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        """
+        :return: [(filename, bytes, last used)] of every cached file
+        """
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.startswith('.tmp'):
+                    continue
+                filename = os.path.join(root, name)
+                try:
+                    stat = os.stat(filename)
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                entries.append((filename, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        """Removes least recently used files until within max_bytes"""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        for filename, size, _ in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            self._size -= size
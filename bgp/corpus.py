@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+"""
+    corpus.py
+    ~~~~~~~~~
+
+    Corpus-wide n-gram frequencies over many sequenced books' genomes.
+
+    Genomes are streamed, in parallel, through worker processes which count
+    their n-gram modules' terms in memory until a limit, then spill them to
+    disk as runs sorted by term. The runs are k-way merged into one table
+    per module of every term's corpus count and document frequency (the
+    number of books it appears in), also sorted by term, so an aggregate
+    can be added to incrementally by merging new runs into its tables.
+
+    usage: python -m bgp.corpus add corpus/ results/books/ [-p PROCESSES]
+           python -m bgp.corpus top corpus/ 1grams [-k 20]
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+from collections import Counter
+from operator import itemgetter
+
+from bgp.genome import find_genome, load_genome
+from bgp.scheduler import Scheduler
+
+NGRAM_MODULES = ('1grams', '2grams', '3grams')
+# Distinct terms a worker counts (per module) before spilling a run
+MAX_TERMS = 1000000
+# Max runs merged at once; more are merged in several passes
+MAX_FAN_IN = 64
+# Genomes per worker task
+TASK_SIZE = 500
+
+
+def iter_genomes(results_path):
+    """
+    :param str results_path: a directory of books' results directories,
+        e.g. pipeline.py's results/books/
+    :return: (identifier, genome filename) of each sequenced book
+    """
+    with os.scandir(results_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                filename = find_genome(entry.path)
+                if filename:
+                    yield entry.name, filename
+
+
+def read_run(filename):
+    """:return: (term, count, document frequency) rows of a run or table"""
+    # Only '\n' ends a row; terms may contain e.g. '\r' (from CRLF DjVuTXT)
+    with open(filename, encoding='utf-8', newline='\n') as f:
+        for line in f:
+            term, count, df = line.rstrip('\n').rsplit('\t', 2)
+            yield term, int(count), int(df)
+
+
+def write_run(filename, rows):
+    with open(filename, 'w', encoding='utf-8', newline='\n') as f:
+        for term, count, df in rows:
+            f.write('{}\t{}\t{}\n'.format(term, count, df))
+
+
+def spill(counts, dfs, spill_path):
+    """Writes counted terms to a new run, sorted by term"""
+    fd, filename = tempfile.mkstemp(dir=spill_path, suffix='.run')
+    os.close(fd)
+    write_run(filename, ((term, counts[term], dfs[term]) for term in sorted(counts)))
+    return filename
+
+
+def count_genomes(task):
+    """
+    Worker task: counts the n-gram modules' terms of a chunk of genomes
+    :param tuple task: ([(identifier, genome filename)], modules,
+        spill_path, max_terms)
+    :return: ([identifiers counted], {module: [run filenames]})
+    """
+    genomes, modules, spill_path, max_terms = task
+    counts = {m: Counter() for m in modules}
+    dfs = {m: Counter() for m in modules}
+    runs = {m: [] for m in modules}
+    counted = []
+    for identifier, filename in genomes:
+        try:
+            genome = load_genome(filename)
+        except Exception:
+            logging.exception('Skipping unreadable genome ' + filename)
+            continue
+        for m in modules:
+            table = genome.get(m) or []
+            counts[m].update(dict(table))
+            dfs[m].update(term for term, _ in table)
+            if len(counts[m]) >= max_terms:
+                runs[m].append(spill(counts[m], dfs[m], spill_path))
+                counts[m], dfs[m] = Counter(), Counter()
+        counted.append(identifier)
+    for m in modules:
+        if counts[m]:
+            runs[m].append(spill(counts[m], dfs[m], spill_path))
+    return counted, runs
+
+
+def merge_runs(filenames, out_filename, spill_path, fan_in=MAX_FAN_IN):
+    """
+    k-way merges runs (and tables) sorted by term into one, summing the
+    counts and document frequencies of each term
+    """
+    filenames = list(filenames)
+    while len(filenames) > fan_in:
+        # Merge in passes, so no more than fan_in files are open at once
+        merged = []
+        for i in range(0, len(filenames), fan_in):
+            fd, filename = tempfile.mkstemp(dir=spill_path, suffix='.run')
+            os.close(fd)
+            write_run(filename, _merge(filenames[i:i + fan_in]))
+            merged.append(filename)
+        filenames = merged
+    write_run(out_filename, _merge(filenames))
+
+
+def _merge(filenames):
+    rows = heapq.merge(*map(read_run, filenames), key=itemgetter(0))
+    for term, group in itertools.groupby(rows, key=itemgetter(0)):
+        count = df = 0
+        for _, c, d in group:
+            count += c
+            df += d
+        yield term, count, df
+
+
+class CorpusAggregate:
+
+    def __init__(self, path, modules=NGRAM_MODULES, max_terms=MAX_TERMS):
+        """
+        :param str path: directory of the aggregate: a {module}.tsv table
+            (term, count, document frequency; sorted by term) per module,
+            and the identifiers of the books counted so far
+        :param modules: genome modules whose [[term, count]] results are
+            aggregated
+        :param int max_terms: distinct terms a worker counts per module
+            before spilling them to disk (bounds its memory)
+        """
+        self.path = path
+        self.modules = tuple(modules)
+        self.max_terms = max_terms
+
+    def table_filename(self, module):
+        return os.path.join(self.path, module + '.tsv')
+
+    @property
+    def identifiers_filename(self):
+        return os.path.join(self.path, 'identifiers.txt')
+
+    def identifiers(self):
+        """:return: the set of identifiers of the books counted so far"""
+        if not os.path.exists(self.identifiers_filename):
+            return set()
+        with open(self.identifiers_filename) as f:
+            return {line.rstrip('\n') for line in f}
+
+    @property
+    def documents(self):
+        """Number of books counted"""
+        return len(self.identifiers())
+
+    def add(self, genomes, processes=1, task_size=TASK_SIZE):
+        """
+        Adds books' genomes to the aggregate, skipping books already in it
+        (to count a re-sequenced book's new genome, rebuild the aggregate)
+        :param iterable genomes: (identifier, genome filename), e.g. from
+            iter_genomes; read lazily
+        :param int processes: worker processes counting genomes
+        :return: number of books added
+        """
+        os.makedirs(self.path, exist_ok=True)
+        done = self.identifiers()
+        genomes = ((i, filename) for i, filename in genomes if i not in done)
+        spill_path = tempfile.mkdtemp(dir=self.path, prefix='spill-')
+        try:
+            tasks = (
+                (chunk, self.modules, spill_path, self.max_terms)
+                for chunk in iter(lambda: list(itertools.islice(genomes, task_size)), [])
+            )
+            scheduler = Scheduler(count_genomes, processes=processes)
+            counted = []
+            runs = {m: [] for m in self.modules}
+            for _, result, error in scheduler.run(tasks):
+                if error:
+                    raise error
+                identifiers, task_runs = result
+                counted.extend(identifiers)
+                for m in self.modules:
+                    runs[m].extend(task_runs[m])
+            if not counted:
+                return 0
+            # Merge every module's table before replacing any, then record
+            # the books counted
+            merged = {}
+            for m in self.modules:
+                tables = [self.table_filename(m)] if os.path.exists(self.table_filename(m)) else []
+                merged[m] = os.path.join(spill_path, m + '.tsv')
+                merge_runs(tables + runs[m], merged[m], spill_path)
+            for m in self.modules:
+                os.replace(merged[m], self.table_filename(m))
+            with open(self.identifiers_filename, 'a') as f:
+                f.writelines(identifier + '\n' for identifier in counted)
+            return len(counted)
+        finally:
+            shutil.rmtree(spill_path, ignore_errors=True)
+
+    def iter_table(self, module):
+        """:return: (term, count, document frequency), sorted by term"""
+        if not os.path.exists(self.table_filename(module)):
+            return iter(())
+        return read_run(self.table_filename(module))
+
+    def most_common(self, module, k=20):
+        """:return: the k (term, count, document frequency) of highest count"""
+        return heapq.nlargest(k, self.iter_table(module), key=itemgetter(1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate n-gram counts over many genomes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add = subparsers.add_parser('add', help="add the genomes in a results directory")
+    add.add_argument('aggregate_path')
+    add.add_argument('results_path', help="pipeline.py's results directory, e.g. results/books/")
+    add.add_argument('-p', '--processes', type=int, default=1)
+    add.add_argument('--modules', nargs='+', default=list(NGRAM_MODULES))
+    top = subparsers.add_parser('top', help='print the most frequent terms of a module')
+    top.add_argument('aggregate_path')
+    top.add_argument('module')
+    top.add_argument('-k', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        aggregate = CorpusAggregate(args.aggregate_path, modules=args.modules)
+        added = aggregate.add(iter_genomes(args.results_path), processes=args.processes)
+        print('added {} books ({} in total)'.format(added, aggregate.documents))
+    else:
+        aggregate = CorpusAggregate(args.aggregate_path)
+        for term, count, df in aggregate.most_common(args.module, k=args.k):
+            print(json.dumps({'term': term, 'count': count, 'df': df}))
+
+
+if __name__ == '__main__':
+    main()
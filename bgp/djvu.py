@@ -0,0 +1,80 @@
+"""
+    djvu.py
+    ~~~~~~~
+
+    Lightweight per-page view of a book's Djvu XML, built in a single
+    parse so every page-based processor and module can share it.
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+
+class Page:
+
+    def __init__(self, index, number, lines):
+        """
+        :param int index: 0-based position of the page within the book
+        :param str number: page number from the page's djvu filename (e.g. '0004')
+        :param [str] lines: text of each LINE, its WORDs joined by spaces
+        """
+        self.index = index
+        self.number = number
+        self.lines = lines
+        self._text = None
+
+    @property
+    def text(self):
+        """Every WORD on the page joined by spaces"""
+        if self._text is None:
+            self._text = ' '.join(line for line in self.lines if line)
+        return self._text
+
+
+def page_number(obj):
+    try:
+        return obj[0].attrib['value'].split('.djvu')[0][-4:]
+    except (IndexError, KeyError):
+        return None
+
+
+def to_page(obj, index):
+    lines = [
+        ' '.join(word.text or '' for word in line.iter('WORD'))
+        for line in obj.iter('LINE')
+    ]
+    return Page(index, page_number(obj), lines)
+
+
+def iter_pages(source):
+    """
+    Incrementally parses Djvu XML, yielding a Page as soon as each OBJECT
+    closes and then freeing its elements, so the whole DOM is never held
+    :param source: a filename or file-like object of Djvu XML bytes
+    """
+    from lxml import etree
+
+    context = etree.iterparse(source, events=('end',), tag='OBJECT', encoding='utf-8')
+    for index, (_, obj) in enumerate(context):
+        yield to_page(obj, index)
+        obj.clear()
+        while obj.getprevious() is not None:
+            del obj.getparent()[0]
+
+
+def parse_last_page(tail):
+    """
+    Parses the last page out of the tail end of a Djvu XML document
+    :param bytes tail: the last bytes of the document
+    :return: the last Page (with an unknown index of None), or None if
+        tail doesn't reach back to the start of the last OBJECT
+    """
+    start = tail.rfind(b'<OBJECT')
+    end = tail.find(b'</OBJECT>', start)
+    if start == -1 or end == -1:
+        return None
+    from lxml import etree
+
+    parser = etree.XMLParser(encoding='utf-8')
+    obj = etree.fromstring(tail[start:end + len(b'</OBJECT>')], parser=parser)
+    return to_page(obj, None)
@@ -0,0 +1,171 @@
+"""
+    genome.py
+    ~~~~~~~~~
+
+    Reading and writing book genomes (a Sequence's results), either as
+    book_genome.json or in a compressed, columnar format.
+
+    The compressed format (book_genome.jsonl.gz, or .zst with the
+    `zstandard` package) is a stream of JSON lines: a header, then one
+    line per top level key of the genome. Frequency tables (e.g. the
+    n-gram modules' [[term, count]] results) are stored as columns, in
+    chunks of terms and their counts, rather than as one pair per term.
+    It's written a line at a time, so the genome is never held in memory
+    as one serialized string.
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import gzip
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+GENOME_FILENAMES = {
+    None: 'book_genome.json',
+    'gzip': 'book_genome.jsonl.gz',
+    'zstd': 'book_genome.jsonl.zst',
+}
+FORMAT = 'bgp-genome'
+FORMAT_VERSION = 1
+TABLE_CHUNK_SIZE = 10000
+
+
+def genome_filename(compression=None):
+    """:return: the name of a genome file saved with compression"""
+    if compression not in GENOME_FILENAMES:
+        raise ValueError('Unknown compression: %s' % compression)
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression requires the zstandard package')
+    return GENOME_FILENAMES[compression]
+
+
+def encode_genome(results):
+    """
+    :param dict results: a Sequence's results (or any JSON serializable object)
+    :return: results as JSON bytes, encoded with orjson if it's installed
+    """
+    try:
+        import orjson
+    except ImportError:  # orjson is optional
+        return json.dumps(results).encode()
+    return orjson.dumps(results, option=orjson.OPT_NON_STR_KEYS)
+
+
+def is_frequency_table(value):
+    return bool(value) and isinstance(value, list) and all(
+        isinstance(row, (list, tuple)) and len(row) == 2
+        and isinstance(row[0], str) and isinstance(row[1], int)
+        for row in value)
+
+
+def iter_genome_lines(results, chunk_size=TABLE_CHUNK_SIZE):
+    """
+    Streaming encoder of the compressed format
+    :param dict results: a Sequence's results
+    :return: the (uncompressed) lines of the genome, as bytes
+    """
+    yield encode_genome({'format': FORMAT, 'version': FORMAT_VERSION}) + b'\n'
+    for key, value in results.items():
+        if not is_frequency_table(value):
+            yield encode_genome({'key': key, 'value': value}) + b'\n'
+            continue
+        yield encode_genome({'key': key, 'rows': len(value)}) + b'\n'
+        for i in range(0, len(value), chunk_size):
+            chunk = value[i:i + chunk_size]
+            yield encode_genome({
+                'terms': [term for term, _ in chunk],
+                'counts': [count for _, count in chunk],
+            }) + b'\n'
+
+
+def open_genome(filename, mode='rb'):
+    """:return: a binary file object for a genome file, (de)compressing"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError('zstd genomes require the zstandard package')
+        f = open(filename, mode)
+        if 'r' in mode:
+            return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+        return zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+    return open(filename, mode)
+
+
+def write_genome(filename, results, encoded=None):
+    """
+    Writes a genome in the format its filename's extension implies (see
+    GENOME_FILENAMES)
+    :param bytes encoded: for book_genome.json, results already encoded
+        (e.g. Sequence.encoded)
+    """
+    with open_genome(filename, 'wb') as f:
+        if filename.endswith('.json'):
+            f.write(encoded if encoded is not None else encode_genome(results))
+        else:
+            for line in iter_genome_lines(results):
+                f.write(line)
+
+
+def read_genome(filename):
+    """:return: the genome (results) in a file written by write_genome"""
+    with open_genome(filename) as f:
+        if filename.endswith('.json'):
+            return json.load(f)
+        lines = (json.loads(line) for line in _iter_lines(f))
+        header = next(lines)
+        if header.get('format') != FORMAT or header.get('version') != FORMAT_VERSION:
+            raise ValueError('Unknown genome format: %r' % header)
+        results = {}
+        for line in lines:
+            if 'value' in line:
+                results[line['key']] = line['value']
+                continue
+            table = []
+            while len(table) < line['rows']:
+                chunk = next(lines)
+                table.extend(map(list, zip(chunk['terms'], chunk['counts'])))
+            results[line['key']] = table
+        return results
+
+
+def _iter_lines(f, size=1024 * 1024):
+    # zstandard's stream reader doesn't support readline
+    carry = b''
+    while True:
+        data = f.read(size)
+        if not data:
+            break
+        lines = (carry + data).split(b'\n')
+        carry = lines.pop()
+        yield from lines
+    if carry:
+        yield carry
+
+
+def find_genome(path):
+    """
+    :param str path: a book's directory
+    :return: the filename of the genome saved in it, in any format, or None
+    """
+    for filename in GENOME_FILENAMES.values():
+        if os.path.exists(os.path.join(path, filename)):
+            return os.path.join(path, filename)
+    return None
+
+
+def load_genome(path):
+    """
+    :param str path: a genome file, or a book's directory containing one
+    :return: the genome, whichever format it was saved in
+    """
+    filename = find_genome(path) if os.path.isdir(path) else path
+    if filename is None:
+        raise FileNotFoundError('No genome in ' + path)
+    return read_genome(filename)
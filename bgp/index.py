@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+"""
+    index.py
+    ~~~~~~~~
+
+    On-disk inverted index of sequenced books: which books contain an
+    n-gram, URL or ISBN, and how often.
+
+    An index is a directory of immutable segments, each built from a batch
+    of genomes and later merged with others. A segment is one file: its
+    books' identifiers, a term dictionary sorted by (field, term), and per
+    term a posting list of (book, count) pairs, varint encoded with book
+    numbers as deltas. Dictionaries are binary searched through mmap, so a
+    lookup reads a few pages of each segment rather than every genome.
+
+    usage: python -m bgp.index add index/ results/books/
+           python -m bgp.index merge index/
+           python -m bgp.index lookup index/ 2grams "open book"
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from collections import Counter
+
+from bgp.corpus import iter_genomes
+from bgp.genome import load_genome
+
+FIELDS = ('1grams', '2grams', '3grams', 'urls', 'isbns')
+MAGIC = b'BGPIDX01'
+# magic, books, terms, then the offsets of the book offsets, book
+# identifiers, term offsets, posting offsets, terms and postings sections
+HEADER = struct.Struct('<8sQQQQQQQQ')
+OFFSET = struct.Struct('<Q')
+OFFSETS = struct.Struct('<QQ')
+# Merge every segment once an index has more than this
+MAX_SEGMENTS = 16
+# Books per segment added
+SEGMENT_SIZE = 1000
+
+
+def genome_terms(genome):
+    """:return: {field: {term: count}} of a genome"""
+    terms = {m: dict(genome.get(m) or ()) for m in FIELDS[:3]}
+    terms['urls'] = Counter(genome.get('urls') or ())
+    isbns = Counter(genome.get('backpage_isbn') or ())
+    for page in genome.get('copyright_page') or ():
+        isbns.update(page.get('isbns') or ())
+    terms['isbns'] = isbns
+    return terms
+
+
+def encode_varints(numbers):
+    out = bytearray()
+    for n in numbers:
+        while n >= 0x80:
+            out.append(n & 0x7f | 0x80)
+            n >>= 7
+        out.append(n)
+    return bytes(out)
+
+
+def decode_varints(data, pos=0, count=None):
+    """:return: ([numbers], position after them)"""
+    numbers = []
+    n = shift = 0
+    while count is None or len(numbers) < count:
+        if pos >= len(data):
+            break
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            numbers.append(n)
+            n = shift = 0
+    return numbers, pos
+
+
+def encode_postings(postings):
+    """:param postings: [(book number, count)] by ascending book number"""
+    numbers = [len(postings)]
+    previous = 0
+    for book, count in postings:
+        numbers += (book - previous, count)
+        previous = book
+    return encode_varints(numbers)
+
+
+def decode_postings(data, pos=0):
+    """:return: [(book number, count)]"""
+    (n,), pos = decode_varints(data, pos, 1)
+    numbers, _ = decode_varints(data, pos, 2 * n)
+    postings = []
+    book = 0
+    for delta, count in zip(numbers[::2], numbers[1::2]):
+        book += delta
+        postings.append((book, count))
+    return postings
+
+
+def _key(field, term):
+    return field.encode() + b'\0' + term.encode('utf-8')
+
+
+def _offsets_bytes(offsets):
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    return offsets.tobytes()
+
+
+def write_segment(filename, identifiers, postings):
+    """
+    :param [str] identifiers: the segment's books, numbered in this order
+    :param iterable postings: (key, [(book number, count)]) sorted by key
+    """
+    key_offsets, posting_offsets = array('Q'), array('Q')
+    with tempfile.TemporaryFile() as keys, open(filename + '.tmp', 'wb') as f:
+        f.write(b'\0' * HEADER.size)
+        postings_pos = f.tell()
+        for key, key_postings in postings:
+            key_offsets.append(keys.tell())
+            keys.write(key)
+            posting_offsets.append(f.tell() - postings_pos)
+            f.write(encode_postings(key_postings))
+        key_offsets.append(keys.tell())
+        book_offsets = array('Q', [0])
+        books_pos = f.tell()
+        for identifier in identifiers:
+            f.write(identifier.encode('utf-8'))
+            book_offsets.append(f.tell() - books_pos)
+        book_offsets_pos = f.tell()
+        f.write(_offsets_bytes(book_offsets))
+        key_offsets_pos = f.tell()
+        f.write(_offsets_bytes(key_offsets))
+        posting_offsets_pos = f.tell()
+        f.write(_offsets_bytes(posting_offsets))
+        keys_pos = f.tell()
+        keys.seek(0)
+        while True:
+            chunk = keys.read(1024 * 1024)
+            if not chunk:
+                break
+            f.write(chunk)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(identifiers), len(posting_offsets), book_offsets_pos,
+                            books_pos, key_offsets_pos, posting_offsets_pos, keys_pos,
+                            postings_pos))
+    os.replace(filename + '.tmp', filename)
+
+
+class Segment:
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.books, self.terms, book_offsets_pos, self.books_pos, key_offsets_pos,
+         posting_offsets_pos, self.keys_pos, self.postings_pos) = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError('Not an index segment: ' + filename)
+        self.book_offsets_pos = book_offsets_pos
+        self.key_offsets_pos = key_offsets_pos
+        self.posting_offsets_pos = posting_offsets_pos
+
+    def close(self):
+        self.data.close()
+
+    def _offset(self, pos, i):
+        return OFFSET.unpack_from(self.data, pos + OFFSET.size * i)[0]
+
+    def identifier(self, book):
+        start, end = OFFSETS.unpack_from(self.data, self.book_offsets_pos + OFFSET.size * book)
+        return self.data[self.books_pos + start:self.books_pos + end].decode('utf-8')
+
+    def key(self, i):
+        start, end = OFFSETS.unpack_from(self.data, self.key_offsets_pos + OFFSET.size * i)
+        return self.data[self.keys_pos + start:self.keys_pos + end]
+
+    def find(self, key):
+        """:return: the term number of key, or None"""
+        lo, hi = 0, self.terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.terms and self.key(lo) == key:
+            return lo
+        return None
+
+    def postings(self, i):
+        return decode_postings(
+            self.data, self.postings_pos + self._offset(self.posting_offsets_pos, i))
+
+    def lookup(self, field, term):
+        """:return: [(identifier, count)] of the books containing term"""
+        i = self.find(_key(field, term))
+        if i is None:
+            return []
+        return [(self.identifier(book), count) for book, count in self.postings(i)]
+
+    def __iter__(self):
+        """:return: (key, [(book number, count)]) sorted by key"""
+        for i in range(self.terms):
+            yield self.key(i), self.postings(i)
+
+    def identifiers(self):
+        return [self.identifier(book) for book in range(self.books)]
+
+
+class Index:
+
+    def __init__(self, path, max_segments=MAX_SEGMENTS):
+        """
+        :param str path: directory of the index's segments and manifest
+        :param int max_segments: merge segments once there are more
+        """
+        self.path = path
+        self.max_segments = max_segments
+        self._segments = {}
+
+    @property
+    def manifest_filename(self):
+        return os.path.join(self.path, 'segments.json')
+
+    def manifest(self):
+        """:return: segment filenames, oldest first"""
+        if not os.path.exists(self.manifest_filename):
+            return []
+        with open(self.manifest_filename) as f:
+            return json.load(f)['segments']
+
+    def _write_manifest(self, segments):
+        with open(self.manifest_filename + '.tmp', 'w') as f:
+            json.dump({'segments': segments}, f)
+        os.replace(self.manifest_filename + '.tmp', self.manifest_filename)
+
+    def segments(self):
+        """:return: this index's open Segments, oldest first"""
+        names = self.manifest()
+        for name in set(self._segments) - set(names):
+            self._segments.pop(name).close()
+        for name in names:
+            if name not in self._segments:
+                self._segments[name] = Segment(os.path.join(self.path, name))
+        return [self._segments[name] for name in names]
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments = {}
+
+    def identifiers(self):
+        """:return: the set of identifiers of the books indexed"""
+        return {i for segment in self.segments() for i in segment.identifiers()}
+
+    def _new_segment_name(self):
+        fd, filename = tempfile.mkstemp(dir=self.path, prefix='segment-', suffix='.idx')
+        os.close(fd)
+        return os.path.basename(filename)
+
+    def add(self, genomes, segment_size=SEGMENT_SIZE):
+        """
+        Indexes books' genomes as new segments, skipping books already
+        indexed (to index a re-sequenced book's new genome, rebuild the
+        index), merging segments as they accumulate
+        :param iterable genomes: (identifier, genome filename), e.g. from
+            bgp.corpus.iter_genomes; read lazily
+        :param int segment_size: books per new segment (bounds memory)
+        :return: number of books added
+        """
+        os.makedirs(self.path, exist_ok=True)
+        done = self.identifiers()
+        added = 0
+        identifiers = []
+        postings = {}
+        for identifier, filename in itertools.chain(genomes, [(None, None)]):
+            if identifiers and (identifier is None or len(identifiers) >= segment_size):
+                self._add_segment(identifiers, postings)
+                added += len(identifiers)
+                identifiers, postings = [], {}
+            if identifier is None or identifier in done:
+                continue
+            try:
+                terms = genome_terms(load_genome(filename))
+            except Exception:
+                logging.exception('Skipping unreadable genome ' + filename)
+                continue
+            book = len(identifiers)
+            identifiers.append(identifier)
+            done.add(identifier)
+            for field, field_terms in terms.items():
+                for term, count in field_terms.items():
+                    postings.setdefault(_key(field, term), []).append((book, count))
+        return added
+
+    def _add_segment(self, identifiers, postings):
+        name = self._new_segment_name()
+        write_segment(os.path.join(self.path, name), identifiers,
+                      ((key, postings[key]) for key in sorted(postings)))
+        self._write_manifest(self.manifest() + [name])
+        # Newer segments are merged into older ones no larger than them (so
+        # each book is merged O(log books) times), and all of them once
+        # there are more than max_segments
+        segments = self.segments()
+        while len(segments) > 1 and segments[-2].books <= segments[-1].books:
+            self.merge(segments[-2:])
+            segments = self.segments()
+        if len(segments) > self.max_segments:
+            self.merge()
+
+    def merge(self, segments=None):
+        """
+        Merges segments into one
+        :param [Segment] segments: consecutive segments (default all)
+        """
+        segments = segments or self.segments()
+        if len(segments) < 2:
+            return
+        offsets = list(itertools.accumulate([0] + [s.books for s in segments]))
+        identifiers = [i for segment in segments for i in segment.identifiers()]
+
+        def renumbered(n, segment):
+            for key, postings in segment:
+                yield key, n, [(book + offsets[n], count) for book, count in postings]
+
+        merged = heapq.merge(*(renumbered(n, s) for n, s in enumerate(segments)))
+        name = self._new_segment_name()
+        write_segment(os.path.join(self.path, name), identifiers, (
+            # Segments are in book number order, so their postings are too
+            (key, [p for _, _, postings in group for p in postings])
+            for key, group in itertools.groupby(merged, key=lambda row: row[0])
+        ))
+        names = [os.path.basename(segment.filename) for segment in segments]
+        manifest = self.manifest()
+        i = manifest.index(names[0])
+        self._write_manifest(manifest[:i] + [name] + manifest[i + len(names):])
+        for segment in segments:
+            self._segments.pop(os.path.basename(segment.filename)).close()
+            os.remove(segment.filename)
+
+    def lookup(self, field, term):
+        """
+        :param str field: one of FIELDS
+        :return: [(identifier, count)] of the books containing term
+        """
+        return [posting for segment in self.segments() for posting in segment.lookup(field, term)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query an inverted index of genomes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add = subparsers.add_parser('add', help='index the genomes in a results directory')
+    add.add_argument('index_path')
+    add.add_argument('results_path', help="pipeline.py's results directory, e.g. results/books/")
+    merge = subparsers.add_parser('merge', help="merge an index's segments into one")
+    merge.add_argument('index_path')
+    lookup = subparsers.add_parser('lookup', help='list the books containing a term')
+    lookup.add_argument('index_path')
+    lookup.add_argument('field', choices=FIELDS)
+    lookup.add_argument('term')
+    args = parser.parse_args()
+
+    index = Index(args.index_path)
+    if args.command == 'add':
+        print('added {} books'.format(index.add(iter_genomes(args.results_path))))
+    elif args.command == 'merge':
+        index.merge()
+    else:
+        for identifier, count in index.lookup(args.field, args.term):
+            print('{}\t{}'.format(identifier, count))
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+    lexile.py
+    ~~~~~~~~~
+
+    Client for the Lexile book API with a persistent ISBN -> result cache
+    (including negative results) and a token-bucket rate limit shared by
+    every process using the same cache file.
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import itertools
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+
+from bgp import sessions
+
+LEXILE_URL = 'https://atlas-fab.lexile.com/free/books/'
+LEXILE_HEADERS = {'accept': 'application/json; version=1.0'}
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'bgp', 'lexile.sqlite3')
+DAY = 24 * 60 * 60
+
+_clients = {}
+
+
+def is_transient(status):
+    """Whether a response status is a failure worth retrying later"""
+    return status == 429 or status >= 500
+
+
+class LexileClient:
+
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH, ttl=30 * DAY, negative_ttl=7 * DAY,
+                 rate=2.0, burst=2, session=None):
+        """
+        :param str cache_path: sqlite file holding cached results and the
+            shared rate limiter state
+        :param int ttl: seconds to reuse a found (200) result
+        :param int negative_ttl: seconds to reuse a not found (4xx) result
+        :param float rate: max requests per second, across all processes
+        :param int burst: max requests made back to back
+        :param session: a requests.Session (default: this process's
+            shared bgp.sessions session)
+        """
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.rate = rate
+        self.burst = burst
+        self.session = session
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        with self.connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS lexile ('
+                       'isbn TEXT PRIMARY KEY, status INTEGER, data TEXT, fetched REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS bucket ('
+                       'name TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+
+    def connect(self):
+        # A connection per call, so the client is safe to use from threads
+        # and forked processes alike
+        return closing(sqlite3.connect(
+            self.cache_path, timeout=60, isolation_level=None))
+
+    def cached(self, isbn):
+        """
+        :return: (status, data) if a fresh result for isbn is cached, else None
+        """
+        return self.cached_many([isbn]).get(str(isbn))
+
+    def cached_many(self, isbns):
+        """
+        :return: {isbn: (status, data)} of the isbns with a fresh cached
+            result, looked up over one connection
+        """
+        isbns = [str(isbn) for isbn in isbns]
+        results = {}
+        now = time.time()
+        with self.connect() as db:
+            # Within SQLite's default limit of 999 query parameters
+            for i in range(0, len(isbns), 500):
+                chunk = isbns[i:i + 500]
+                for isbn, status, data, fetched in db.execute(
+                        'SELECT isbn, status, data, fetched FROM lexile WHERE isbn IN (%s)'
+                        % ', '.join('?' * len(chunk)), chunk):
+                    ttl = self.ttl if status == 200 else self.negative_ttl
+                    if now - fetched < ttl:
+                        results[isbn] = (status, data and json.loads(data))
+        return results
+
+    def acquire(self):
+        """Blocks until the shared token bucket allows another request"""
+        while True:
+            with self.connect() as db:
+                db.execute('BEGIN IMMEDIATE')
+                row = db.execute('SELECT tokens, updated FROM bucket WHERE name = ?',
+                                 ('lexile',)).fetchone()
+                now = time.time()
+                tokens = self.burst if row is None else min(
+                    self.burst, row[0] + (now - row[1]) * self.rate)
+                wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+                if not wait:
+                    tokens -= 1
+                db.execute('INSERT OR REPLACE INTO bucket VALUES (?, ?, ?)',
+                           ('lexile', tokens, now))
+                db.execute('COMMIT')
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def get(self, isbn):
+        """
+        :param str isbn: an ISBN
+        :return: (status code, response json or None); found and not found
+            results are cached, transient (429/5xx) failures are not
+        """
+        return self.cached(isbn) or self.fetch(isbn)
+
+    def fetch(self, isbn):
+        """As get, but always requests isbn (then caches the result)"""
+        self.acquire()
+        session = self.session or sessions.get_session()
+        response = session.get(LEXILE_URL + str(isbn), headers=LEXILE_HEADERS)
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        if not is_transient(response.status_code):
+            with self.connect() as db:
+                db.execute('INSERT OR REPLACE INTO lexile VALUES (?, ?, ?, ?)',
+                           (str(isbn), response.status_code, json.dumps(data), time.time()))
+        return response.status_code, data
+
+    def iter_many(self, isbns, concurrency=4, chunk_size=500):
+        """
+        Looks up many ISBNs, chunk by chunk: each chunk's cached results in
+        one query, the rest concurrently (still within the rate limit)
+        :param iterable isbns: read lazily
+        :return: (isbn, (status code, response json or None)) for each
+            distinct isbn, as its result is ready
+        """
+        seen = set()
+        isbns = (isbn for isbn in map(str, filter(None, isbns))
+                 if not (isbn in seen or seen.add(isbn)))
+        with ThreadPoolExecutor(concurrency) as executor:
+            for chunk in iter(lambda: list(itertools.islice(isbns, chunk_size)), []):
+                cached = self.cached_many(chunk)
+                yield from cached.items()
+                fetches = {executor.submit(self.fetch, isbn): isbn
+                           for isbn in chunk if isbn not in cached}
+                for fetch in as_completed(fetches):
+                    yield fetches[fetch], fetch.result()
+
+
+def get_client():
+    """:return: this process's shared LexileClient"""
+    pid = os.getpid()
+    if pid not in _clients:
+        _clients.clear()
+        _clients[pid] = LexileClient()
+    return _clients[pid]
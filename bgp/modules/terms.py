@@ -1,20 +1,84 @@
+import copy
+import heapq
 import re
-from collections import defaultdict
+from collections import Counter
+from functools import lru_cache
 
-import isbnlib
-import requests
 import time
-from lxml import etree
+
+from bgp import readability
+from bgp.ngrams import NGramCounter
+from bgp.sketch import HeavyHitters
 
 
 PUNCTUATION = r'!"#$%&\'\/:()*+,.-;<=>?@[\\]^`{|}*'  # this needs improving
 
-class FulltextProcessor():
+class Spawnable:
+    """
+    Remembers the arguments a processor or module was constructed with, so
+    a Sequencer can spawn a fresh copy (with clean state) for every book by
+    re-running its constructor, sharing rather than copying the arguments
+    (e.g. stop words) instead of deep copying the whole pipeline
+    """
+
+    # Recorded in genomes; bump whenever a change alters a processor's or
+    # module's results, so Sequencer.resequence reruns it on old genomes
+    version = 1
+
+    def __new__(cls, *args, **kwargs):
+        instance = super().__new__(cls)
+        instance._spawn_args = (args, kwargs)
+        return instance
+
+    def spawn(self):
+        args, kwargs = self._spawn_args
+        return type(self)(*args, **kwargs)
+
+
+class Processor(Spawnable):
+
+    # Book sources (see bgp.SOURCE_FORMATS) this processor's results are
+    # derived from, whose fingerprints are recorded in genomes. A Sequencer
+    # skips the processor if any of them is missing. (Item metadata is
+    # always fetched, as it lists the sources.)
+    inputs = ()
+
+    def prepare(self, book):
+        """
+        Computes (and caches on book) anything this processor shares with
+        others, before a Sequencer runs them concurrently in threads
+        """
+
+    def spawn(self):
+        processor = super().spawn()
+        processor.modules = {m: spawn(self.modules[m]) for m in self.modules}
+        return processor
+
+
+def spawn(component):
+    """
+    :return: a fresh copy of a processor or module, falling back to a deep
+        copy for components which aren't Spawnable
+    """
+    if hasattr(component, 'spawn'):
+        return component.spawn()
+    return copy.deepcopy(component)
+
+
+class FulltextProcessor(Processor):
+
+    inputs = ('plaintext',)
+    # Book sources this processor reads, which a Sequencer may prefetch
+    sources = ('plaintext',)
 
     def __init__(self, modules):
         self.modules = modules
         self.time = 0
 
+    def prepare(self, book):
+        # ReadingLevelModule counts words over the shared tokens
+        NGramProcessor.book_to_tokens(book)
+
     def run(self, book):
         processor_tic = time.perf_counter()
         for m in self.modules:
@@ -33,7 +97,7 @@ class FulltextProcessor():
         }
 
 
-class ReadingLevelModule:
+class ReadingLevelModule(Spawnable):
 
     def __init__(self):
         self.lexile = None
@@ -42,38 +106,24 @@ class ReadingLevelModule:
         self.time = 0
 
     def run(self, book, **kwargs):
-        import nltk
-
-        try:
-            nltk.data.find('tokenizers/punkt')
-        except LookupError:
-            print('Downloading Punkt Tokenizer...')
-            nltk.download('punkt')
+        from bgp import lexile
 
-        from readability import Readability
-        from readability.scorers.flesch_kincaid import ReadabilityException
-
-        doc = book.plaintext
         isbn = 'isbn' in book.metadata and book.metadata['isbn'][0]
 
-        url = 'https://atlas-fab.lexile.com/free/books/' + str(isbn)
-
-        headers = {'accept': 'application/json; version=1.0'}
-        lexile = requests.get(url, headers=headers)
         # Checks if lexile exists for ISBN. If doesn't exist value remains 'None'.
         # If lexile does exist but no age range, value will be 'None'.
-        # If no ISBN, value will be 'None'.
-        if lexile.status_code == 200:
-            self.lexile = lexile.json()
-        try:
-            r = Readability(doc)
-            fk = r.flesch_kincaid()
-            s = r.smog()
-            self.readability_fk_score = fk.score
-            self.readability_s_score = s.score
-        # If less than 100 words
-        except ReadabilityException:
-            pass
+        # If no ISBN, value will be 'None' (and no request is made).
+        if isbn:
+            status, lexile_data = lexile.get_client().get(isbn)
+            if status == 200:
+                self.lexile = lexile_data
+        # Counts words and syllables over the book's shared tokens
+        stats = readability.text_stats(NGramProcessor.book_to_tokens(book))
+        sentences = readability.split_sentences(book.plaintext)
+        self.readability_fk_score = readability.flesch_kincaid(stats, len(sentences))
+        # If less than 100 words, neither score is computed
+        if self.readability_fk_score is not None:
+            self.readability_s_score = readability.smog(sentences)
 
     @property
     def results(self):
@@ -88,41 +138,108 @@ class ReadingLevelModule:
             }
         }
 
-class NGramProcessor():
+class NGramProcessor(Processor):
+
+    inputs = ('plaintext',)
 
-    def __init__(self, modules, n=1, threshold=None, stop_words=None):
+    def __init__(self, modules, n=1, threshold=None, stop_words=None, chunk_size=None):
         """
         ngram processor takes a book of plaintext, splits the contents into tokens, and then passes them into each of its modules
         the word frequency module is a common module for this processor
         :param lambda modules: a dict of {'name': module}
         :param int n: n-gram sequence length
         :param int threshold: min occurrences threshold
+        :param int chunk_size: if set, stream plaintext in chunks of this
+            many characters and feed modules batch by batch, rather than
+            holding every token and n-gram of the book in memory at once
         """
         self.modules = modules
         self.n = n
         self.threshold = threshold
         self.stop_words = stop_words
+        self.chunk_size = chunk_size
         # use token_count as word count for profiler
         self.token_count = 0
         self.time = 0
         self.tokenization_time = 0
 
+    @property
+    def sources(self):
+        # Streamed plaintext is read incrementally rather than prefetched
+        return () if self.chunk_size else ('plaintext',)
+
+    def prepare(self, book):
+        if not self.chunk_size:
+            self.book_to_tokens(book, stop_words=self.stop_words)
+
     def run(self, book):
+        if self.chunk_size:
+            return self.run_streaming(book)
         book.plaintext  # Priming memoization
         processor_tic = time.perf_counter()
-        self.terms = self.fulltext_to_ngrams(
-            book.plaintext, n=self.n, stop_words=self.stop_words)
+        tokens = self.book_to_tokens(book, stop_words=self.stop_words)
+        self.terms = None
+        if not all(self.accepts_tokens(m) for m in self.modules.values()):
+            self.terms = self.tokens_to_ngrams(tokens, n=self.n) if self.n > 1 else tokens
         self.tokenization_time = round(time.perf_counter() - processor_tic, 3)
         for m in self.modules:
             module_tic = time.perf_counter()
-            for i, term in enumerate(self.terms):
-                self.token_count += 1
-                self.modules[m].run(term, threshold=self.threshold, index=i)
+            self.run_module(self.modules[m], self.terms, tokens=tokens)
             module_toc = time.perf_counter()
             self.modules[m].time = round(module_toc - module_tic, 3)
         processor_toc = time.perf_counter()
         self.time = round(processor_toc - processor_tic, 3)
 
+    def run_streaming(self, book):
+        processor_tic = time.perf_counter()
+        token_batches = self.iter_token_batches(
+            book.iter_plaintext(self.chunk_size), stop_words=self.stop_words)
+        needs_terms = not all(self.accepts_tokens(m) for m in self.modules.values())
+        terms = None
+        carry = []
+        tokenization_time = 0
+        module_times = dict.fromkeys(self.modules, 0)
+        while True:
+            tokenization_tic = time.perf_counter()
+            tokens = next(token_batches, None)
+            if tokens is not None and needs_terms:
+                # As iter_ngram_batches, carrying n-1 tokens between batches
+                terms = tokens
+                if self.n > 1:
+                    terms = carry + tokens
+                    carry = terms[-(self.n - 1):]
+                    terms = self.tokens_to_ngrams(terms, n=self.n)
+            tokenization_time += time.perf_counter() - tokenization_tic
+            if tokens is None:
+                break
+            for m in self.modules:
+                if not (tokens if self.accepts_tokens(self.modules[m]) else terms):
+                    continue
+                module_tic = time.perf_counter()
+                self.run_module(self.modules[m], terms, tokens=tokens)
+                module_times[m] += time.perf_counter() - module_tic
+        for m in self.modules:
+            self.modules[m].time = round(module_times[m], 3)
+        self.tokenization_time = round(tokenization_time, 3)
+        self.time = round(time.perf_counter() - processor_tic, 3)
+
+    @staticmethod
+    def accepts_tokens(module):
+        """Whether module counts n-grams itself from tokens (see run_tokens)"""
+        return getattr(module, 'accepts_tokens', False)
+
+    def run_module(self, module, terms, tokens=None):
+        if self.accepts_tokens(module):
+            self.token_count += module.run_tokens(tokens, n=self.n, threshold=self.threshold)
+            return
+        if hasattr(module, 'run_batch'):
+            # Modules which can consume all terms at once skip per-term dispatch
+            module.run_batch(terms, threshold=self.threshold)
+        else:
+            for i, term in enumerate(terms):
+                module.run(term, threshold=self.threshold, index=i)
+        self.token_count += len(terms)
+
     @property
     def results(self):
         return {
@@ -139,24 +256,90 @@ class NGramProcessor():
         ngrams = zip(*[tokens[i:] for i in range(n)])
         return [" ".join(ngram) for ngram in ngrams]
 
+    @staticmethod
+    def clean(fulltext):
+        return (
+            fulltext.lower()
+            .replace('’', "'")
+            .replace('. ', ' ')
+            .replace('! ', ' ')
+            .replace('? ', ' ')
+            .replace('\n-', '')
+            .replace('\n', ' ')
+        )
+
     @classmethod
-    def fulltext_to_ngrams(cls, fulltext, n=1, stop_words=None):
+    def fulltext_to_raw_tokens(cls, fulltext):
+        """
+        Cleans and splits fulltext without stripping or stop word filtering
+        so the (expensive) result may be shared by every stop word variant
+        """
+        return [t for t in cls.clean(fulltext).split(' ') if t]
+
+    @staticmethod
+    def filter_tokens(raw_tokens, stop_words=None):
         stop_words = stop_words or {}
+        return [t.strip() for t in raw_tokens if t not in stop_words]
 
-        def clean(fulltext):
-            return (
-                fulltext.lower()
-                .replace('’', "'")
-                .replace('. ', ' ')
-                .replace('! ', ' ')
-                .replace('? ', ' ')
-                .replace('\n-', '')
-                .replace('\n', ' ')
-            )
-        tokens = [
-            t.strip() for t in clean(fulltext).split(' ')
-            if t and t not in stop_words
-        ]
+    @classmethod
+    def fulltext_to_tokens(cls, fulltext, stop_words=None):
+        return cls.filter_tokens(
+            cls.fulltext_to_raw_tokens(fulltext), stop_words=stop_words)
+
+    @classmethod
+    def book_to_tokens(cls, book, stop_words=None):
+        """
+        Tokenizes book.plaintext once per book and memoizes the result (and
+        each stop word variant of it) on the book, so every NGramProcessor
+        within a Sequence derives its n-grams from the same token stream
+        :param book: an `internetarchive` Item with plaintext
+        :param set stop_words: tokens to be excluded
+        :rtype: [str]
+        """
+        if not hasattr(book, '_raw_tokens'):
+            book._raw_tokens = cls.fulltext_to_raw_tokens(book.plaintext)
+            book._tokens = {}
+        key = frozenset(stop_words) if stop_words else None
+        if key not in book._tokens:
+            book._tokens[key] = cls.filter_tokens(book._raw_tokens, stop_words=key)
+        return book._tokens[key]
+
+    @classmethod
+    def iter_token_batches(cls, chunks, stop_words=None):
+        """
+        Tokenizes an iterable of consecutive text chunks, yielding one list
+        of tokens per chunk. Text is only cut after its last space, where
+        none of the clean() substitutions can straddle the cut, so the
+        concatenated batches equal fulltext_to_tokens of the whole text.
+        """
+        carry = ''
+        for chunk in chunks:
+            text = carry + chunk
+            cut = text.rfind(' ') + 1
+            carry = text[cut:]
+            if cut:
+                yield cls.fulltext_to_tokens(text[:cut], stop_words=stop_words)
+        if carry:
+            yield cls.fulltext_to_tokens(carry, stop_words=stop_words)
+
+    @classmethod
+    def iter_ngram_batches(cls, token_batches, n=1):
+        """
+        Turns batches of tokens into batches of n-grams, carrying the last
+        n-1 tokens over so n-grams spanning two batches are not lost
+        """
+        carry = []
+        for tokens in token_batches:
+            if n > 1:
+                tokens = carry + tokens
+                carry = tokens[-(n - 1):]
+                tokens = cls.tokens_to_ngrams(tokens, n=n)
+            if tokens:
+                yield tokens
+
+    @classmethod
+    def fulltext_to_ngrams(cls, fulltext, n=1, stop_words=None):
+        tokens = cls.fulltext_to_tokens(fulltext, stop_words=stop_words)
         ngrams = cls.tokens_to_ngrams(tokens, n=n) if n > 1 else tokens
         return ngrams
 
@@ -166,17 +349,59 @@ def rmpunk(word, punctuation=PUNCTUATION):
         if c not in punctuation
     )
 
+@lru_cache(maxsize=None)
+def punctuation_table(punctuation=PUNCTUATION):
+    return str.maketrans('', '', punctuation)
+
+def rmpunk_batch(words, punctuation=PUNCTUATION):
+    """
+    Equivalent to [rmpunk(w, punctuation) for w in words] but cleans every
+    word in a single C-level translate/encode pass over the joined words
+    """
+    if '\n' not in punctuation:
+        cleaned = (
+            '\n'.join(words)
+            .translate(punctuation_table(punctuation))
+            .encode("ascii", "ignore").decode()
+            .split('\n')
+        )
+        # A word containing a newline would shift every subsequent word
+        if len(cleaned) == len(words):
+            return cleaned
+    return [rmpunk(w, punctuation=punctuation) for w in words]
+
 def replace_mistakes(word):
     substitutions = [('I', '1'), ('O', '0'), ('l', '1'), ('S', '5')]
     for sub in substitutions:
         word = word.replace(*sub)
     return word
 
-class WordFreqModule:
+class WordFreqModule(Spawnable):
 
-    def __init__(self, punctuation=PUNCTUATION):
+    def __init__(self, punctuation=PUNCTUATION, max_terms=None,
+                 sketch_width=2 ** 20, sketch_depth=4, compact=False, max_results=None):
+        """
+        :param int max_terms: if set, count approximately with a bounded
+            amount of memory: a Count-Min sketch of sketch_width x
+            sketch_depth counters plus at most max_terms tracked terms,
+            only admitting terms which reach the processor's threshold
+        :param bool compact: count n-grams from an NGramProcessor's tokens
+            as packed token ids (see bgp.ngrams.NGramCounter) rather than
+            as strings, decoding only the terms in results. Results are
+            identical; ignored when counting approximately.
+        :param int max_results: if set, only the most frequent terms
+            (selected with a partial sort)
+        """
         self.punctuation = punctuation
-        self.freqmap = defaultdict(int)
+        self.max_terms = max_terms
+        self.sketch_width = sketch_width
+        self.sketch_depth = sketch_depth
+        self.compact = compact
+        self.max_results = max_results
+        self.heavy_hitters = None
+        self.ngram_counter = None
+        self.freqmap = Counter()
+        self.threshold = None
         self.time = 0
 
     def run(self, word, threshold=None, **kwargs):
@@ -187,19 +412,69 @@ class WordFreqModule:
         # we could add more advanced regex to
         # check if clean_word is something we care about
         if clean_word and not clean_word.startswith(" ") and not clean_word.endswith(" "):
-            self.freqmap[clean_word] += 1
+            if self.max_terms:
+                self.count_approximately([(clean_word, 1)])
+            else:
+                self.freqmap[clean_word] += 1
+
+    def run_batch(self, words, threshold=None, **kwargs):
+        """
+        Counts a whole list of words at once; produces the same freqmap
+        (counts and first-seen ordering) as calling run on each word
+        """
+        self.threshold = threshold
+        counts = Counter(rmpunk_batch(words, punctuation=self.punctuation))
+        # Filter distinct words rather than every occurrence
+        for clean_word in [w for w in counts if not w or w.startswith(" ") or w.endswith(" ")]:
+            del counts[clean_word]
+        if self.max_terms:
+            self.count_approximately(counts.items())
+        else:
+            self.freqmap.update(counts)
+
+    @property
+    def accepts_tokens(self):
+        # Terms are only decodable from cleaned tokens if cleaning keeps spaces
+        return self.compact and not self.max_terms and ' ' not in self.punctuation
+
+    def run_tokens(self, tokens, n=1, threshold=None):
+        """
+        Counts the n-grams of a batch of tokens, continuing on from the
+        previous batch
+        :return: the number of n-grams counted
+        """
+        self.threshold = threshold
+        if self.ngram_counter is None:
+            self.ngram_counter = NGramCounter(
+                n, clean=lambda words: rmpunk_batch(words, punctuation=self.punctuation))
+        return self.ngram_counter.update(tokens)
+
+    def count_approximately(self, counts):
+        if self.heavy_hitters is None:
+            self.heavy_hitters = HeavyHitters(
+                self.max_terms, threshold=self.threshold,
+                width=self.sketch_width, depth=self.sketch_depth)
+            self.freqmap = self.heavy_hitters.counts
+        self.heavy_hitters.update(counts)
 
     @property
     def results(self):
+        if self.ngram_counter is not None:
+            results = self.ngram_counter.most_common(
+                k=self.max_results, threshold=self.threshold)
+        else:
+            items = [items for items in self.freqmap.items()
+                     if not self.threshold or items[1] >= self.threshold]
+            if self.max_results is not None:
+                results = heapq.nlargest(self.max_results, items, key=lambda k_v: k_v[1])
+            else:
+                results = sorted(items, key=lambda k_v: k_v[1], reverse=True)
         return {
             "time": self.time,
-            "results": sorted(
-                [items for items in self.freqmap.items()
-                 if not self.threshold or items[1] >= self.threshold],
-                key=lambda k_v: k_v[1], reverse=True)
+            "results": results
         }
 
-class ExtractorModule:
+class ExtractorModule(Spawnable):
 
     def __init__(self, extractor):
         self.extractor = extractor
@@ -211,6 +486,9 @@ class ExtractorModule:
         if _term:
             self.matches.append(_term)
 
+    def run_batch(self, terms, **kwargs):
+        self.matches.extend(filter(None, map(self.extractor, terms)))
+
     @property
     def results(self):
         return{
@@ -231,61 +509,165 @@ class UrlExtractorModule(ExtractorModule):
         super().__init__(self.validate_url)
 
 
+# isbnlib's 'loose' ISBN-like pattern
+ISBN_LIKE = re.compile(r'[- 0-9X]{10,19}', re.I | re.M | re.S)
+ISBN10_LIKE = re.compile(r'^(\d{9})(\d|X)')
+ISBN13_LIKE = re.compile(r'^(\d{12})(\d)')
+# replace_mistakes as a single translation table
+OCR_MISTAKES = str.maketrans('IOlS', '1015')
+
+
+def is_isbn10(isbn):
+    """
+    :param str isbn: 9 ASCII digits followed by a digit or X
+    """
+    if isbn == '0000000000':
+        return False
+    total = sum((10 - i) * (ord(c) - 48) for i, c in enumerate(isbn[:9]))
+    check = (11 - total % 11) % 11
+    return isbn[9] == ('X' if check == 10 else chr(48 + check))
+
+
+def is_isbn13(isbn):
+    """
+    :param str isbn: 13 ASCII digits
+    """
+    if isbn[:3] not in ('978', '979'):
+        return False
+    total = sum((3 if i % 2 else 1) * (ord(c) - 48) for i, c in enumerate(isbn[:12]))
+    return ord(isbn[12]) - 48 == (10 - total % 10) % 10
+
+
 class IsbnExtractorModule(ExtractorModule):
 
 
     @staticmethod
     def validate_isbn(isbn):
         isbn = rmpunk(isbn).replace(' ', '')
+        return IsbnExtractorModule.check_isbn(isbn)
+
+    @staticmethod
+    def check_isbn(isbn):
+        """
+        :param str isbn: a candidate with punctuation and spaces removed
+        :return: its first 10 characters if they're a valid ISBN-10, else its
+            first 13 if they're a valid ISBN-13
+        """
         if len(isbn) == 9:
             isbn = '0' + isbn
-        match10 = re.search(r'^(\d{9})(\d|X)', isbn)
-        match13 = re.search(r'^(\d{12})(\d)', isbn)
+        match10 = ISBN10_LIKE.search(isbn)
+        match13 = ISBN13_LIKE.search(isbn)
 
         if match10:
-            if isbnlib.is_isbn10(match10.group()):
+            if is_isbn10(match10.group()):
                 return match10.group()
             elif match13:
-                if isbnlib.is_isbn13(match13.group()):
+                if is_isbn13(match13.group()):
                     return match13.group()
             else:
                 return False
 
     @staticmethod
     def extract_isbn(page):
+        """
+        Scans the whole page at once, validating each distinct candidate once
+        :param bgp.djvu.Page page: a page of the book
+        :return: valid ISBNs in the order (and as often) as they appear
+        """
+        text = '\n'.join(page.lines).translate(OCR_MISTAKES)
         isbns = []
-        for line in page.iter('LINE'):
-            line_text = ' '.join(word.text for word in line.iter('WORD'))
-            line_text_clean = replace_mistakes(line_text)
-            isbnlike_list = isbnlib.get_isbnlike(line_text_clean, level='loose')
-            for candidate_isbn in isbnlike_list:
-                isbn = IsbnExtractorModule.validate_isbn(candidate_isbn)
-                if isbn:
-                    isbns.append(isbn)
+        validated = {}
+        # Candidates only hold digits, X, x, '-' and ' ' (never '\n', so
+        # none span two lines)
+        for candidate in ISBN_LIKE.findall(text):
+            if candidate not in validated:
+                validated[candidate] = IsbnExtractorModule.check_isbn(
+                    candidate.replace('-', '').replace(' ', ''))
+            if validated[candidate]:
+                isbns.append(validated[candidate])
         return isbns
 
     def __init__(self):
         super().__init__(self.validate_isbn)
 
 
-class PageTypeProcessor:
+class PageTypeProcessor(Processor):
 
-    def __init__(self, modules):
+    inputs = ('xml',)
+
+    def __init__(self, modules, streaming=False):
+        """
+        page type processor steps through the pages of a book's Djvu XML and passes each into its modules
+        :param lambda modules: a dict of {'name': module}
+        :param bool streaming: if True, incrementally parse the Djvu XML as
+            it downloads (without memoizing it on the book) and stop reading
+            as soon as every module reports it is done
+        """
         self.modules = modules
+        self.streaming = streaming
         self.time = 0
 
+    @property
+    def sources(self):
+        return () if self.streaming else ('xml',)
+
     def run(self, book):
         processor_tic = time.perf_counter()
-        utf8_parser = etree.XMLParser(encoding='utf-8')
-        node = etree.fromstring(book.xml.encode('utf-8'), parser=utf8_parser)
+        # Parsed once per book and shared by every page-based processor,
+        # unless streaming, in which case the full list of pages is unknown
+        pages = None if self.streaming else book.pages
+        module_times = dict.fromkeys(self.modules, 0)
+        # Modules which only care about the last page are handed just that
+        # page; when streaming it's fetched on its own from the XML's tail
         for m in self.modules:
-            module_tic = time.perf_counter()
-            for page in node.iter('OBJECT'):
-                self.modules[m].run(page, node)
-            module_toc = time.perf_counter()
-            self.modules[m].time = round(module_toc - module_tic, 3)
+            if self.last_page_only(self.modules[m]):
+                module_tic = time.perf_counter()
+                last_page = book.last_page if self.streaming else (pages or [None])[-1]
+                if last_page is not None:
+                    self.modules[m].run_last_page(last_page)
+                module_times[m] += time.perf_counter() - module_tic
+        active = [
+            m for m in self.modules
+            if not self.last_page_only(self.modules[m]) and not getattr(self.modules[m], 'done', False)
+        ]
+        if not active:
+            pages_iter = ()
+        elif self.streaming:
+            pages_iter = book.iter_pages()
+        else:
+            pages_iter = pages
+        # Keyword detectors share a single scan of each page's text
+        engine = PageDetectionEngine({
+            m: self.modules[m] for m in self.modules
+            if isinstance(self.modules[m], KeywordPageDetectorModule)
+        })
+        for page in pages_iter:
+            detectors = [m for m in active if m in engine.detectors]
+            if detectors:
+                module_tic = time.perf_counter()
+                for m in engine.detect(page.text, detectors):
+                    self.modules[m].match(page)
+                for m in detectors:
+                    module_times[m] += (time.perf_counter() - module_tic) / len(detectors)
+            for m in active:
+                if m not in engine.detectors:
+                    module_tic = time.perf_counter()
+                    self.modules[m].run(page, pages)
+                    module_times[m] += time.perf_counter() - module_tic
+            active = [m for m in active if not getattr(self.modules[m], 'done', False)]
+            if not active:
+                # Every module is satisfied; don't read any further
+                break
+        for m in self.modules:
+            self.modules[m].time = round(module_times[m], 3)
         processor_toc = time.perf_counter()
         self.time = round(processor_toc - processor_tic, 3)
+
+    @staticmethod
+    def last_page_only(module):
+        """Whether module reads only the last page (see run_last_page)"""
+        return getattr(module, 'last_page_only', False)
+
     @property
     def results(self):
         return {
@@ -293,31 +675,84 @@ class PageTypeProcessor:
             "total_time": self.time,
         }
 
-class KeywordPageDetectorModule:
+@lru_cache(maxsize=None)
+def compile_keywords(keywords):
+    """
+    :param tuple keywords: regexes, any of which may match
+    :return: a single case-insensitive compiled alternation
+    """
+    return re.compile('|'.join('(?:%s)' % k for k in keywords), re.IGNORECASE)
+
+@lru_cache(maxsize=None)
+def compile_detectors(keyword_sets):
+    """
+    :param tuple keyword_sets: a tuple of keywords per detector
+    :return: a compiled alternation whose named group d<i> matches the
+        keywords of the i-th detector
+    """
+    return re.compile('|'.join(
+        '(?P<d%s>%s)' % (i, compile_keywords(keywords).pattern)
+        for i, keywords in enumerate(keyword_sets)
+    ), re.IGNORECASE)
+
+class PageDetectionEngine:
+
+    def __init__(self, detectors):
+        """
+        Finds which of many keyword page detectors match a page in one
+        regex scan of its text, so each added detector costs an extra
+        alternative rather than an extra pass over the book
+        :param dict detectors: {'name': KeywordPageDetectorModule}
+        """
+        self.detectors = detectors
+        self.names = list(detectors)
+        self.pattern = compile_detectors(tuple(
+            tuple(detectors[name].keywords) for name in self.names))
+
+    def detect(self, text, names):
+        """
+        :param str text: page text
+        :param [str] names: detectors to test
+        :return: set of names of detectors whose keywords occur in text
+        """
+        wanted = set(names)
+        found = set()
+        for match in self.pattern.finditer(text):
+            group = next(g for g, v in match.groupdict().items() if v is not None)
+            found.add(self.names[int(group[1:])])
+        if found and not wanted <= found:
+            # finditer skips matches overlapping an earlier one (possibly
+            # an unwanted detector's), which could hide a detector; only
+            # pages with some match need a recheck
+            found.update(n for n in wanted - found if self.detectors[n].pattern.search(text))
+        return found & wanted
+
+
+class KeywordPageDetectorModule(Spawnable):
 
     def __init__(self, keywords, extractor=None, match_limit=None):
         self.extractor = extractor
         self.keywords = keywords
+        self.pattern = compile_keywords(tuple(keywords))
         self.matched_pages = []
         self.match_limit = match_limit
 
-    def run(self, page, node):
-        if not self.match_limit or len(self.matched_pages) < self.match_limit:
-            # We think there's a better way to get text from the page
-            page_text = ' '.join([word.text for word in page.iter('WORD')])
-            for keyword in self.keywords:
-                if re.search(keyword, page_text, re.IGNORECASE):
-                    param = page[0].attrib['value'].split('.djvu')[0]
-                    current_page = param[-4:]
-                    match = {
-                        'page': current_page,
-                    }
-                    if self.extractor:
-                        match.update(self.extractor(page))
-                    self.matched_pages.append(match)
-                    # If we've found a match, we no longer need to
-                    # keep processing this page; exit for loop
-                    break
+    def run(self, page, pages):
+        if not self.done and self.pattern.search(page.text):
+            self.match(page)
+
+    def match(self, page):
+        match = {
+            'page': page.number,
+        }
+        if self.extractor:
+            match.update(self.extractor(page))
+        self.matched_pages.append(match)
+
+    @property
+    def done(self):
+        return bool(self.match_limit) and len(self.matched_pages) >= self.match_limit
+
     @property
     def results(self):
         return {
@@ -344,17 +779,17 @@ class CopyrightPageDetectorModule(KeywordPageDetectorModule):
         super().__init__(['copyright', '©'], extractor=self.extractor, match_limit=1)
 
 
-class BackpageIsbnExtractorModule():
+class BackpageIsbnExtractorModule(Spawnable):
+
+    # PageTypeProcessor hands this module only the book's last page (to
+    # run_last_page) rather than every page
+    last_page_only = True
 
     def __init__(self):
         self.isbns = []
 
-    def run(self, page, node):
-        current_page = int(page[0].attrib['value'].split('.djvu')[0][-4:])
-        if not hasattr(self, 'last_page'):
-            self.last_page = int(node.xpath("//OBJECT")[-1][0].attrib['value'].split('.djvu')[0][-4:])
-        if current_page == self.last_page:
-            self.isbns = IsbnExtractorModule.extract_isbn(page)
+    def run_last_page(self, page):
+        self.isbns = IsbnExtractorModule.extract_isbn(page)
 
     @property
     def results(self):
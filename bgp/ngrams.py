@@ -0,0 +1,155 @@
+"""
+    ngrams.py
+    ~~~~~~~~~
+
+    Compact exact n-gram counter: tokens are interned as integer ids, kept
+    in a 4 byte per token array, and n-grams are counted as packed integer
+    keys (with NumPy, if installed) rather than as millions of strings.
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import heapq
+from array import array
+from collections import Counter
+from itertools import islice
+from operator import itemgetter
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:  # numpy is optional
+        return None
+    return numpy
+
+
+def numpy_installed():
+    """
+    :return: whether NumPy is installed; without it, counting compactly
+        is slower than counting strings
+    """
+    return _numpy() is not None
+
+
+class NGramCounter:
+
+    def __init__(self, n=1, clean=None, use_numpy=None):
+        """
+        :param int n: n-gram length
+        :param callable clean: clean([token]) -> [cleaned token], applied
+            once per distinct token; n-grams whose first or last cleaned
+            token is empty aren't counted. Cleaned tokens must not contain
+            spaces, since terms are decoded as space-joined tokens.
+        :param bool use_numpy: count with NumPy (default: if installed)
+        """
+        self.n = n
+        self.clean = clean
+        self.use_numpy = _numpy() is not None if use_numpy is None else use_numpy
+        self.ids = {}  # token -> id of its cleaned form
+        self.vocab = []  # id -> cleaned token
+        self.vocab_ids = {}  # cleaned token -> id
+        self.tokens = array('I')  # token ids, in order
+
+    def update(self, tokens):
+        """
+        Adds a batch of tokens continuing on from the previous batch
+        :return: the number of n-grams the batch adds
+        """
+        new_tokens = list(set(tokens).difference(self.ids))
+        if new_tokens:
+            cleaned = self.clean(new_tokens) if self.clean else new_tokens
+            for token, clean_token in zip(new_tokens, cleaned):
+                if clean_token not in self.vocab_ids:
+                    self.vocab_ids[clean_token] = len(self.vocab)
+                    self.vocab.append(clean_token)
+                self.ids[token] = self.vocab_ids[clean_token]
+        before = self.ngram_count
+        self.tokens.extend(map(self.ids.__getitem__, tokens))
+        return self.ngram_count - before
+
+    @property
+    def ngram_count(self):
+        return max(0, len(self.tokens) - self.n + 1)
+
+    def most_common(self, k=None, threshold=None):
+        """
+        :param int k: if set, only the k most frequent terms (partially
+            sorted, so without sorting every term)
+        :param int threshold: min occurrences of terms
+        :return: [(term, count)] by descending count, ties in the order the
+            terms first occurred; only surviving terms are decoded
+        """
+        if self.use_numpy and len(self.vocab) < 1 << (64 // self.n):
+            columns, counts = self._count_numpy(k=k, threshold=threshold)
+        else:
+            columns, counts = self._count(k=k, threshold=threshold)
+        vocab = self.vocab
+        terms = map(' '.join, zip(*[map(vocab.__getitem__, column) for column in columns]))
+        return list(zip(terms, counts))
+
+    def _empty_id(self):
+        return self.vocab_ids.get('')
+
+    def _count(self, k=None, threshold=None):
+        n = self.n
+        tokens = self.tokens
+        if n == 1:
+            keys = tokens
+        elif n == 2:
+            keys = map(lambda a, b: a << 32 | b, tokens, islice(tokens, 1, None))
+        else:
+            def pack(*ids):
+                key = 0
+                for i in ids:
+                    key = key << 32 | i
+                return key
+            keys = map(pack, *(islice(tokens, i, None) for i in range(n)))
+        # Counter preserves first occurrence order, which sorting keeps for ties
+        counts = Counter(keys)
+        empty = self._empty_id()
+        first_shift = 32 * (n - 1)
+        items = [
+            (key, count) for key, count in counts.items()
+            if (not threshold or count >= threshold)
+            and (empty is None or (key >> first_shift != empty
+                                   and key & 0xffffffff != empty))
+        ]
+        if k is not None:
+            items = heapq.nlargest(k, items, key=itemgetter(1))
+        else:
+            items.sort(key=itemgetter(1), reverse=True)
+        keys = [key for key, _ in items]
+        columns = [[key >> 32 * (n - 1 - i) & 0xffffffff for key in keys] for i in range(n)]
+        return columns, [count for _, count in items]
+
+    def _count_numpy(self, k=None, threshold=None):
+        numpy = _numpy()
+        n = self.n
+        bits = numpy.uint64(64 // n)
+        ids = numpy.frombuffer(self.tokens, dtype=numpy.uint32).astype(numpy.uint64)
+        m = len(ids) - n + 1
+        if m <= 0 or k == 0:
+            return [[]] * n, []
+        keys = ids[:m].copy()
+        for i in range(1, n):
+            keys = (keys << bits) | ids[i:i + m]
+        empty = self._empty_id()
+        if empty is not None:
+            keys = keys[(ids[:m] != empty) & (ids[n - 1:n - 1 + m] != empty)]
+        keys, first, counts = numpy.unique(keys, return_index=True, return_counts=True)
+        if threshold:
+            survivors = counts >= threshold
+            keys, first, counts = keys[survivors], first[survivors], counts[survivors]
+        # Higher counts first, then earlier first occurrences
+        score = counts.astype(numpy.int64) * (m + 1) - first
+        if k is not None and k < len(keys):
+            order = numpy.argpartition(-score, k - 1)[:k]
+            order = order[numpy.argsort(-score[order], kind='stable')]
+        else:
+            order = numpy.argsort(-score, kind='stable')
+        keys = keys[order]
+        mask = numpy.uint64((1 << (64 // n)) - 1)
+        columns = [((keys >> bits * numpy.uint64(n - 1 - i)) & mask).tolist() for i in range(n)]
+        return columns, counts[order].tolist()
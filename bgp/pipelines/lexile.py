@@ -1,67 +1,66 @@
-import internetarchive as ia
-import requests
 import json
-import time
 import csv
+import os
 from isbnlib import to_isbn13
 
+from bgp import sessions
+from bgp.lexile import LexileClient, is_transient
+
+MAX_ISBNS = 195820
+
 def get_isbn_items(query=""):
     """Function which fetches ISBNs from Archive.org items"""
     url = "https://archive.org/advancedsearch.php?q=" + query
-    r = requests.get(url)
+    r = sessions.get_session().get(url)
     isbn_items = r.json()["response"]["docs"]
     print(f"Length of isbn_items: {len(isbn_items)}")
     return isbn_items
 
-def get_lexile(isbn):
-    try:
-        url = 'https://atlas-fab.lexile.com/free/books/' + str(isbn)
-        headers = {'accept': 'application/json; version=1.0'}
-        lexile = requests.get(url, headers=headers)
-        lexile.raise_for_status()  # this will raise an error for us if the http status returned is not 200 OK
-        print(f"json from lexile is: \n {lexile.json()}")
-        data = lexile.json()
-        return data, data.get("error_msg")
-    except Exception as e:
-        if e.response.status_code not in [200, 404]:
-            raise Exception(f"Got scary response back from server: {e}") 
-        return {}, e
-  
 def main(query=""):
     # Now, do our query to get isbns
     isbn_items = get_isbn_items(query)
-    # Next, load all isbns we've seen from the `log` file
-    with open("log.csv", "r") as f:
-        csv_reader = csv.reader(f, delimiter=",")
-        next(csv_reader)
-        seen_isbns = {row[0] for row in csv_reader}
+    # Next, skip every isbn the `log` file shows we've already run
+    seen_isbns = set()
+    if os.path.exists("log.csv"):
+        with open("log.csv", "r") as f:
+            seen_isbns = {row["isbn"] for row in csv.DictReader(f)}
+    isbns = []
+    for item in isbn_items:
+        isbn = to_isbn13(item.get("isbn") and item["isbn"][0])
+        if isbn and isbn not in seen_isbns:
+            seen_isbns.add(isbn)
+            isbns.append(isbn)
+        # Set this to break once we've gone through as many books as we want
+        if len(isbns) > MAX_ISBNS:
+            break
+    print(f"Running {len(isbns)} isbns")
+    # The client's shared rate limit keeps us from overloading lexile servers,
+    # and its cache answers isbns looked up by an earlier, interrupted run
+    client = LexileClient()
     # Open a successes file to store lexile info from successful runs and a log file to keep track of the kind of result for each book run
+    new_log = not os.path.exists("log.csv")
+    ran_isbns = 0
     with open("successes.jsonl", "a") as successes, open("log.csv", "a") as log:
         fieldnames = ["isbn", "success", "error_msg"]
         writer = csv.DictWriter(log, fieldnames=fieldnames)
-        log_info = {}
-        ran_isbns = 0
-        for i, item in enumerate(isbn_items):
-            isbn = to_isbn13(item.get("isbn") and item["isbn"][0])
-            print(f"i is {i}")
-            # If isbn is in the seen_isbns, skip it.
-            if isbn and isbn not in seen_isbns:
-                log_info["isbn"] = isbn
-                print(f"Running isbn {isbn}")
-                # Keep from overloading lexile servers
-                time.sleep(.5)
-                data, error_msg = get_lexile(isbn)
-                log_info["error_msg"] = error_msg
-                log_info["success"] = data.get("success", False)
-                if log_info["success"]:
-                    successes.write(json.dumps(data)+"\n")
-                writer.writerow(log_info)
-                ran_isbns += 1
-                print(f"There have been {ran_isbns} isbns run")
-
-            # Set this to break once we've gone through as many books as we want
-            if ran_isbns > 195820:
-                break
+        if new_log:
+            writer.writeheader()
+        # Each result is written as it arrives
+        for isbn, (status, data) in client.iter_many(isbns):
+            if is_transient(status):
+                # Left out of the log (and uncached), so the next run retries it
+                continue
+            data = data or {}
+            log_info = {
+                "isbn": isbn,
+                "success": data.get("success", False),
+                "error_msg": data.get("error_msg") or (status != 200 and status) or None,
+            }
+            if log_info["success"]:
+                successes.write(json.dumps(data)+"\n")
+            writer.writerow(log_info)
+            ran_isbns += 1
+    print(f"There have been {ran_isbns} isbns run")
 
 if __name__ == "__main__":
     # Input our archive.org query here
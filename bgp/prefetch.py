@@ -0,0 +1,71 @@
+"""
+    prefetch.py
+    ~~~~~~~~~~~
+
+    Fetches upcoming books (metadata and sources) on background threads
+    while the current book is being sequenced.
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+
+    def __init__(self, fetch, books, depth=4, workers=None):
+        """
+        :param callable fetch: fetch(book) -> fetched book; run on a thread
+        :param iterable books: books (e.g. identifiers) in the order they'll
+            be consumed
+        :param int depth: max number of books fetched or being fetched ahead
+            of the consumer (the bounded queue)
+        :param int workers: number of fetch threads (default depth)
+        """
+        self.fetch = fetch
+        self.books = iter(books)
+        self.depth = depth
+        self.workers = workers or depth
+        self.stats = {
+            'fetched': 0,
+            # books queued ahead of the consumer, at the last take
+            'queue_depth': 0,
+            'max_queue_depth': 0,
+            # seconds the consumer spent waiting on fetches (I/O bound)
+            'consumer_wait_time': 0,
+            # takes at which the queue was full and its head already fetched,
+            # i.e. fetchers were held back waiting on the consumer (CPU bound)
+            'backpressure': 0,
+        }
+
+    def __iter__(self):
+        """
+        :return: (book, fetched book or None, exception or None) in order
+        """
+        queue = deque()
+        with ThreadPoolExecutor(self.workers) as executor:
+            def fill():
+                for book in self.books:
+                    queue.append((book, executor.submit(self.fetch, book)))
+                    if len(queue) >= self.depth:
+                        break
+
+            fill()
+            while queue:
+                book, future = queue.popleft()
+                if len(queue) + 1 >= self.depth and future.done():
+                    self.stats['backpressure'] += 1
+                fill()
+                wait_tic = time.perf_counter()
+                try:
+                    fetched, error = future.result(), None
+                except Exception as e:
+                    fetched, error = None, e
+                self.stats['consumer_wait_time'] += time.perf_counter() - wait_tic
+                self.stats['fetched'] += 1
+                self.stats['queue_depth'] = len(queue)
+                self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], len(queue))
+                yield book, fetched, error
@@ -0,0 +1,123 @@
+"""
+    readability.py
+    ~~~~~~~~~~~~~~
+
+    In-process Flesch-Kincaid and SMOG scoring from counts gathered over a
+    book's shared tokens, following the counting rules of
+    py-readability-metrics (whose scores these replace).
+
+    Scores agree with py-readability-metrics to within about 0.6 grade
+    levels on book length texts (typically much closer). Sentences are
+    split with a punctuation heuristic rather than punkt, and words come
+    from the sequencer's cleaned tokens (which drop sentence-final '?' and
+    '!'), so counts differ slightly on hard cases like abbreviations and
+    initials.
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+
+# Tokens py-readability-metrics doesn't count as words
+PUNCTUATION_TOKEN = re.compile(r"^[.,\/#!$%'\^&\*;:{}=\-_`~()]$")
+# Approximates nltk's TweetTokenizer for words, numbers, ellipses and
+# (single character) punctuation
+WORD_TOKEN = re.compile(r"[^\W\d_](?:[^\W\d_]|['\-_])+[^\W\d_]|\w+|\.(?:\s*\.)+|\S")
+SENTENCE_END = re.compile(r"""[.!?]+["'”’)\]]*\s+(?=\S)""")
+ABBREVIATIONS = frozenset([
+    'mr', 'mrs', 'ms', 'dr', 'st', 'jr', 'sr', 'vs', 'etc', 'prof', 'no', 'vol', 'fig',
+])
+
+MIN_FLESCH_KINCAID_WORDS = 100
+SMOG_SENTENCES = 30
+
+
+@lru_cache(maxsize=None)
+def count_syllables(word):
+    word = word.lower()
+    if len(word) <= 3:
+        return 1
+    word = re.sub('(?:[^laeiouy]es|[^laeiouy]e)$', '', word)
+    word = re.sub('^y', '', word)
+    return len(re.findall('[aeiouy]{1,2}', word))
+
+
+@lru_cache(maxsize=1 << 20)
+def token_stats(token):
+    """
+    Syllable table entry for a whitespace separated token
+    :return: (words, syllables, polysyllabic words) within token
+    """
+    words = syllables = polysyllables = 0
+    for word in WORD_TOKEN.findall(token):
+        if not PUNCTUATION_TOKEN.match(word):
+            count = count_syllables(word)
+            words += 1
+            syllables += count
+            polysyllables += count >= 3
+    return words, syllables, polysyllables
+
+
+def text_stats(tokens):
+    """
+    :param [str] tokens: whitespace separated tokens (e.g. a book's shared
+        tokens), each looked up once in the syllable table
+    :return: {'words', 'syllables', 'polysyllables'} counts
+    """
+    words = syllables = polysyllables = 0
+    for token, n in Counter(tokens).items():
+        w, s, p = token_stats(token)
+        words += w * n
+        syllables += s * n
+        polysyllables += p * n
+    return {'words': words, 'syllables': syllables, 'polysyllables': polysyllables}
+
+
+def split_sentences(text):
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        last_word = text[start:match.start()].rsplit(None, 1)[-1:]
+        if last_word and last_word[0].lower().lstrip('("\'') in ABBREVIATIONS:
+            continue
+        if last_word and len(last_word[0]) == 1 and last_word[0].isalpha() \
+                and text[match.start()] == '.':
+            continue  # an initial
+        sentence = text[start:match.start() + 1].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+    sentence = text[start:].strip()
+    if sentence:
+        sentences.append(sentence)
+    return sentences
+
+
+def flesch_kincaid(stats, sentences):
+    """
+    :param dict stats: text_stats of the text
+    :param int sentences: number of sentences in the text
+    :return: Flesch-Kincaid grade level, or None if under 100 words
+    """
+    if stats['words'] < MIN_FLESCH_KINCAID_WORDS or not sentences:
+        return None
+    return (0.38 * stats['words'] / sentences
+            + 11.8 * stats['syllables'] / stats['words']) - 15.59
+
+
+def smog(sentences):
+    """
+    SMOG grade from the first, middle and last 10 sentences (McLaughlin, 1969)
+    :param [str] sentences: every sentence of the text
+    :return: SMOG grade, or None if under 30 sentences
+    """
+    if len(sentences) < SMOG_SENTENCES:
+        return None
+    mid = len(sentences) // 2
+    sample = sentences[:10] + sentences[mid - 5:mid + 5] + sentences[-10:]
+    polysyllables = text_stats(' '.join(sample).split())['polysyllables']
+    return 1.0430 * math.sqrt(30 * polysyllables / SMOG_SENTENCES) + 3.1291
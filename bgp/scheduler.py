@@ -0,0 +1,225 @@
+"""
+    scheduler.py
+    ~~~~~~~~~~~~
+
+    Runs a stream of tasks (e.g. books) on a pool of forked worker
+    processes, with a bounded number in flight, the costliest of the next
+    few tasks started first, and workers replaced after a number of tasks
+    or once their memory grows too large.
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import heapq
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import resource
+from concurrent.futures import ThreadPoolExecutor
+
+
+def rss():
+    """:return: this process's current resident set size, in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak rather than current RSS (kB on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _worker(fn, conn, inherited, max_tasks, max_rss):
+    # Forked with the scheduler's ends of every worker's pipe, which are
+    # closed so a pipe's only other end is in the scheduler (and EOF is
+    # seen by whichever side outlives the other)
+    for other in inherited:
+        other.close()
+    done = 0
+    while True:
+        try:
+            item = conn.recv()
+        except (EOFError, OSError):  # the scheduler is gone
+            return
+        if item == _STOP:
+            return
+        try:
+            outcome = (fn(item), None)
+        except Exception as e:
+            outcome = (None, e)
+        done += 1
+        retire = bool((max_tasks and done >= max_tasks) or (max_rss and rss() > max_rss))
+        try:
+            try:
+                conn.send((outcome, retire))
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                conn.send(((None, Exception('unpicklable outcome: %r' % e)), retire))
+        except OSError:  # the scheduler is gone
+            return
+        if retire:
+            return
+
+
+def _coster(cost, conn, inherited, threads):
+    # Costs are computed (e.g. fetched) on threads in a process of their
+    # own, so the scheduler forks its workers from a process running none
+    for other in inherited:
+        other.close()
+    with ThreadPoolExecutor(threads) as executor:
+        while True:
+            try:
+                items = conn.recv()
+            except (EOFError, OSError):  # the scheduler is gone
+                return
+            if items == _STOP:
+                return
+            try:
+                conn.send(list(executor.map(cost, items)))
+            except OSError:
+                return
+
+
+_STOP = '__stop__'
+
+
+class WorkerDied(Exception):
+    pass
+
+
+class Scheduler:
+
+    def __init__(self, fn, processes=1, lookahead=0, cost=None, cost_workers=8,
+                 max_tasks_per_worker=None, max_rss_bytes=None):
+        """
+        :param callable fn: fn(item) -> result, run in a worker process;
+            results and exceptions must be picklable
+        :param int processes: number of worker processes, each running one
+            task at a time (so at most this many tasks are in flight)
+        :param int lookahead: number of upcoming items whose costs are
+            compared so the costliest starts first (default 0, i.e. input
+            order); only these are read ahead of the workers
+        :param callable cost: cost(item) -> number, e.g. a book's size; run
+            on cost_workers threads in a process of its own, so may do I/O
+        :param int max_tasks_per_worker: replace workers after this many tasks
+        :param int max_rss_bytes: replace workers whose RSS exceeds this
+            after a task
+        """
+        self.fn = fn
+        self.processes = processes
+        self.lookahead = lookahead if cost else 0
+        self.cost = cost
+        self.cost_workers = cost_workers
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_rss_bytes = max_rss_bytes
+        self.stats = {
+            'completed': 0,
+            'failed': 0,
+            # workers replaced after max_tasks_per_worker or max_rss_bytes
+            'recycled': 0,
+            # workers which died (e.g. were killed) mid task
+            'died': 0,
+        }
+
+    def _cost(self, item):
+        try:
+            return self.cost(item)
+        except Exception:
+            return 0
+
+    def run(self, items):
+        """
+        :param iterable items: tasks, read lazily (e.g. lines of a file)
+        :return: (item, result or None, exception or None) as tasks finish
+        """
+        context = multiprocessing.get_context('fork')
+        items = iter(items)
+        order = itertools.count()
+        upcoming = []  # heap of (-cost, input order, item)
+        workers = {}  # connection -> [process, item it's running or None]
+        costs = []  # the connection to the cost process, if any
+
+        def start_worker():
+            conn, child_conn = context.Pipe()
+            # Not daemonic, so workers may fork too (e.g. a parallel Sequencer)
+            worker = context.Process(target=_worker, args=(
+                self.fn, child_conn, list(workers) + [conn] + costs,
+                self.max_tasks_per_worker, self.max_rss_bytes))
+            worker.start()
+            child_conn.close()
+            workers[conn] = [worker, None]
+
+        def stop_worker(conn):
+            worker, item = workers.pop(conn)
+            if item is None and worker.is_alive():
+                try:
+                    conn.send(_STOP)
+                except OSError:
+                    pass
+            conn.close()
+            worker.join()
+
+        def read_ahead():
+            wanted = self.processes + self.lookahead - len(upcoming)
+            batch = list(itertools.islice(items, max(wanted, 0)))
+            weights = [0] * len(batch)
+            if costs and batch:
+                try:
+                    costs[0].send(batch)
+                    weights = costs[0].recv()
+                except (EOFError, OSError):  # the cost process died
+                    pass
+            for item, weight in zip(batch, weights):
+                heapq.heappush(upcoming, (-weight, next(order), item))
+
+        if self.lookahead:
+            conn, child_conn = context.Pipe()
+            coster = context.Process(target=_coster, daemon=True, args=(
+                self._cost, child_conn, [conn], self.cost_workers))
+            coster.start()
+            child_conn.close()
+            costs.append(conn)
+        try:
+            for _ in range(self.processes):
+                start_worker()
+            try:
+                while True:
+                    read_ahead()
+                    for conn, state in workers.items():
+                        if state[1] is None and upcoming:
+                            state[1] = heapq.heappop(upcoming)[2]
+                            conn.send(state[1])
+                    busy = [conn for conn in workers if workers[conn][1] is not None]
+                    if not busy:
+                        break
+                    for conn in multiprocessing.connection.wait(busy):
+                        item = workers[conn][1]
+                        try:
+                            (result, error), retire = conn.recv()
+                        except (EOFError, OSError):
+                            self.stats['died'] += 1
+                            result, retire = None, True
+                            error = WorkerDied(
+                                'worker %d died running the task' % workers[conn][0].pid)
+                        else:
+                            self.stats['recycled'] += retire
+                        workers[conn][1] = None
+                        if retire:
+                            stop_worker(conn)
+                            start_worker()
+                        self.stats['failed' if error else 'completed'] += 1
+                        yield item, result, error
+            finally:
+                for conn in list(workers):
+                    if workers[conn][1] is not None:  # abandoned by the consumer
+                        workers[conn][0].terminate()
+                    stop_worker(conn)
+        finally:
+            if costs:
+                try:
+                    costs[0].send(_STOP)
+                except OSError:
+                    pass
+                costs[0].close()
+                coster.join()
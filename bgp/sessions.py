@@ -0,0 +1,105 @@
+"""
+    sessions.py
+    ~~~~~~~~~~~
+
+    Pooled, keep-alive HTTP sessions with timeouts and retries (with
+    jittered exponential backoff), shared by all of a worker's requests.
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import os
+import random
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+SETTINGS = {
+    'pool_size': 10,
+    # (connect, read) seconds
+    'timeout': (10, 120),
+    'retries': 5,
+    'backoff_factor': 0.5,
+    'status_forcelist': (429, 500, 502, 503, 504),
+}
+
+_sessions = {}
+
+
+def configure(**settings):
+    """
+    Overrides SETTINGS (pool_size, timeout, retries, backoff_factor,
+    status_forcelist) for sessions and adapters created from now on
+    """
+    unknown = set(settings) - set(SETTINGS)
+    if unknown:
+        raise ValueError('Unknown session settings: ' + ', '.join(sorted(unknown)))
+    SETTINGS.update(settings)
+    _sessions.clear()
+
+
+class JitteredRetry(Retry):
+
+    def get_backoff_time(self):
+        # Spread retries of concurrent workers so they don't stampede
+        backoff = super().get_backoff_time()
+        return backoff * random.uniform(0.5, 1.5)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def get_adapter():
+    """
+    :return: a pooled adapter retrying idempotent requests on connection
+        errors and on 429/5xx responses (honouring Retry-After). Uploads
+        aren't retried here since a consumed request body can't be resent.
+    """
+    retry = JitteredRetry(
+        total=SETTINGS['retries'],
+        backoff_factor=SETTINGS['backoff_factor'],
+        status_forcelist=SETTINGS['status_forcelist'],
+        allowed_methods=frozenset(['HEAD', 'GET', 'OPTIONS']),
+        raise_on_status=False)
+    return TimeoutHTTPAdapter(
+        timeout=SETTINGS['timeout'],
+        pool_connections=SETTINGS['pool_size'],
+        pool_maxsize=SETTINGS['pool_size'],
+        max_retries=retry)
+
+
+def mount(session):
+    """
+    Mounts a pooled adapter over every adapter of session (e.g. an
+    `internetarchive` ArchiveSession, which mounts its own per host).
+    Remounting reuses the session's pooled adapter, and its connections.
+    :rtype: requests.Session
+    """
+    adapter = next((a for a in session.adapters.values() if isinstance(a, TimeoutHTTPAdapter)),
+                   None) or get_adapter()
+    for prefix in set(session.adapters) | {'http://', 'https://'}:
+        session.mount(prefix, adapter)
+    return session
+
+
+def get_session():
+    """
+    :return: this process's shared requests.Session. Sessions are never
+        shared across processes, since forked workers can't share sockets.
+    """
+    pid = os.getpid()
+    if pid not in _sessions:
+        _sessions.clear()
+        _sessions[pid] = mount(requests.Session())
+    return _sessions[pid]
@@ -0,0 +1,90 @@
+"""
+    sketch.py
+    ~~~~~~~~~
+
+    Bounded-memory approximate counters for term frequencies of books
+    which are too large to count exactly.
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import heapq
+from array import array
+
+
+class CountMinSketch:
+
+    def __init__(self, width=2 ** 20, depth=4):
+        """
+        Approximate frequency table of `depth` rows of `width` counters
+        (4 bytes each). Estimates never undercount; with conservative
+        updates they overcount by at most ~2N/width with probability
+        1 - 1/2^depth, where N is the total count added.
+        :param int width: counters per row
+        :param int depth: number of rows (independent hashes)
+        """
+        self.width = width
+        self.depth = depth
+        self.rows = [array('I', bytes(4 * width)) for _ in range(depth)]
+
+    def _indexes(self, item):
+        h = hash(item)
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) & 0xffffffff) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, item, count=1):
+        """
+        Adds count occurrences of item (conservative update) and returns
+        the item's new estimated frequency
+        """
+        indexes = self._indexes(item)
+        estimate = min(row[i] for row, i in zip(self.rows, indexes)) + count
+        for row, i in zip(self.rows, indexes):
+            if row[i] < estimate:
+                row[i] = estimate
+        return estimate
+
+    def __getitem__(self, item):
+        return min(row[i] for row, i in zip(self.rows, self._indexes(item)))
+
+
+class HeavyHitters:
+
+    def __init__(self, capacity, threshold=None, width=2 ** 20, depth=4):
+        """
+        Tracks the terms whose estimated frequency reaches `threshold`,
+        holding at most `capacity` of them. Every term is counted in a
+        CountMinSketch, but only terms at or above the threshold get an
+        entry in `counts`, so the threshold is applied while counting.
+        When `counts` outgrows capacity the least frequent quarter is
+        evicted; evicted terms keep accruing in the sketch and re-enter
+        with their full estimate if they recur.
+        :param int capacity: max number of tracked terms
+        :param int threshold: min estimated occurrences to track a term
+        """
+        self.capacity = capacity
+        self.threshold = threshold or 1
+        self.sketch = CountMinSketch(width=width, depth=depth)
+        self.counts = {}
+
+    def update(self, items):
+        """
+        :param items: iterable of (term, count) pairs, e.g. Counter.items()
+        """
+        add = self.sketch.add
+        counts = self.counts
+        for term, count in items:
+            estimate = add(term, count)
+            if estimate >= self.threshold:
+                counts[term] = estimate
+                if len(counts) > self.capacity:
+                    self.prune()
+
+    def prune(self):
+        keep = heapq.nlargest(
+            self.capacity * 3 // 4, self.counts.items(), key=lambda k_v: k_v[1])
+        keep = {term for term, _ in keep}
+        for term in [t for t in self.counts if t not in keep]:
+            del self.counts[term]
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+"""
+    status.py
+    ~~~~~~~~~
+
+    pipeline.py's record of what it has done for each book (e.g. uploaded
+    its genome, found an ISBN, failed), kept in one SQLite database (in WAL
+    mode, so worker processes can write to it concurrently) rather than as
+    empty files touched in a directory per book.
+
+    usage: python -m bgp.status stats results/books/
+           python -m bgp.status export results/books/ [--record RECORD]
+           python -m bgp.status migrate results/books/ [--remove]
+
+    :copyright: (c) 2020 by OBGP
+    :license: see LICENSE for more details.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from contextlib import closing
+from multiprocessing.util import Finalize
+
+STATUS_FILENAME = 'status.sqlite3'
+
+# Records pipeline.py keeps per book; ISBN and URLS also have a value (the
+# ISBN, the number of URLs), and URLS and SEQUENCE_FAILURE data (the URLs,
+# the traceback)
+RECORDS = [
+    'GENOME_UPDATED', 'ISBN', 'UPDATE_NONE', 'UPDATE_FAILED', 'UPDATE_SUCCEED',
+    'UPDATE_CONFLICT', 'URLS', 'SEQUENCE_FAILURE',
+]
+VALUED_RECORDS = ('ISBN', 'URLS')
+
+
+class StatusStore:
+
+    def __init__(self, path, batch_size=100, flush_interval=5.0):
+        """
+        :param str path: the SQLite database file
+        :param int batch_size: writes buffered before they're committed
+        :param float flush_interval: max seconds a write stays buffered
+            (checked on each write). Buffered writes are also committed
+            when the process exits, including forked worker processes.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._pending_pid = None
+        self._flushed = time.monotonic()
+        with self.connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS status ('
+                       'identifier TEXT, record TEXT, value TEXT, data TEXT, updated REAL, '
+                       'PRIMARY KEY (identifier, record))')
+            db.execute('CREATE INDEX IF NOT EXISTS status_record ON status (record, value)')
+
+    def connect(self):
+        # A connection per call, so the store is safe to use from forked
+        # processes
+        return closing(sqlite3.connect(self.path, timeout=60, isolation_level=None))
+
+    def _buffer(self):
+        if self._pending_pid != os.getpid():
+            # Writes buffered by the process this one was forked from are
+            # its own to commit
+            self._pending = []
+            self._pending_pid = os.getpid()
+            Finalize(self, type(self)._flush_pending,
+                     args=(self.path, self._pending), exitpriority=10)
+        return self._pending
+
+    def set(self, identifier, record, value=None, data=None):
+        self._buffer().append((identifier, record, value, data, time.time()))
+        self._maybe_flush()
+
+    def remove(self, identifier, *records):
+        for record in records:
+            self._buffer().append((identifier, record, None, None, None))
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if (len(self._pending) >= self.batch_size
+                or time.monotonic() - self._flushed >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Commits buffered writes, in one transaction"""
+        self._flush_pending(self.path, self._buffer())
+        self._flushed = time.monotonic()
+
+    @staticmethod
+    def _flush_pending(path, pending):
+        if not pending:
+            return
+        with closing(sqlite3.connect(path, timeout=60, isolation_level=None)) as db:
+            db.execute('BEGIN IMMEDIATE')
+            for identifier, record, value, data, updated in pending:
+                if updated is None:
+                    db.execute('DELETE FROM status WHERE identifier = ? AND record = ?',
+                               (identifier, record))
+                else:
+                    db.execute('INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?, ?)',
+                               (identifier, record, value, data, updated))
+            db.execute('COMMIT')
+        del pending[:]
+
+    def get(self, identifier):
+        """
+        :return: {record: (value, data)} of a book, including buffered writes
+        """
+        with self.connect() as db:
+            status = {
+                record: (value, data) for record, value, data in db.execute(
+                    'SELECT record, value, data FROM status WHERE identifier = ?',
+                    (identifier,))
+            }
+        for _identifier, record, value, data, updated in self._buffer():
+            if _identifier == identifier:
+                if updated is None:
+                    status.pop(record, None)
+                else:
+                    status[record] = (value, data)
+        return status
+
+    def stats(self):
+        """:return: {record: number of books}"""
+        self.flush()
+        with self.connect() as db:
+            return dict(db.execute(
+                'SELECT record, COUNT(*) FROM status GROUP BY record ORDER BY record'))
+
+    def export(self, record=None):
+        """
+        :param str record: only books with this record
+        :return: {'identifier', 'record', 'value', 'data', 'updated'} rows
+        """
+        self.flush()
+        query = 'SELECT identifier, record, value, data, updated FROM status'
+        args = ()
+        if record:
+            query += ' WHERE record = ?'
+            args = (record,)
+        with self.connect() as db:
+            for row in db.execute(query + ' ORDER BY identifier, record', args):
+                yield dict(zip(('identifier', 'record', 'value', 'data', 'updated'), row))
+
+    def migrate(self, results_path, remove=False):
+        """
+        Imports the files pipeline.py used to touch in each book's
+        directory (e.g. ISBN_{isbn}_{identifier}) under results_path
+        :param bool remove: delete the files once imported
+        :return: number of files imported
+        """
+        imported = []
+        for identifier in sorted(os.listdir(results_path)):
+            book_path = os.path.join(results_path, identifier)
+            if not os.path.isdir(book_path):
+                continue
+            for filename in os.listdir(book_path):
+                suffix = '_' + identifier
+                if not filename.endswith(suffix):
+                    continue
+                name = filename[:-len(suffix)]
+                record = next((r for r in RECORDS if name == r or (
+                    r in VALUED_RECORDS and name.startswith(r + '_'))), None)
+                if not record:
+                    continue
+                file_path = os.path.join(book_path, filename)
+                with open(file_path) as f:
+                    data = f.read() or None
+                value = name[len(record) + 1:] if record in VALUED_RECORDS else None
+                self.set(identifier, record, value=value, data=data)
+                imported.append(file_path)
+        self.flush()
+        if remove:
+            for file_path in imported:
+                os.remove(file_path)
+        return len(imported)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query or build pipeline.py's status store")
+    parser.add_argument('command', choices=['stats', 'export', 'migrate'])
+    parser.add_argument('results_path', help="pipeline.py's results directory, e.g. results/books/")
+    parser.add_argument('--record', choices=RECORDS,
+                        help='export: only books with this record')
+    parser.add_argument('--remove', action='store_true',
+                        help='migrate: delete the touched files once imported')
+    args = parser.parse_args()
+
+    store = StatusStore(os.path.join(args.results_path, STATUS_FILENAME))
+    if args.command == 'stats':
+        for record, count in store.stats().items():
+            print('{}\t{}'.format(record, count))
+    elif args.command == 'export':
+        for row in store.export(record=args.record):
+            sys.stdout.write(json.dumps(row) + '\n')
+    else:
+        print('imported {} files'.format(store.migrate(args.results_path, remove=args.remove)))
+
+
+if __name__ == '__main__':
+    main()
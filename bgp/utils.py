@@ -1,4 +1,4 @@
-STOP_WORDS = set("""'d 'll 'm 're 's 've a about above across after afterwards
+STOP_WORDS = frozenset("""'d 'll 'm 're 's 've a about above across after afterwards
 1 2 3 4 5 6 7 8 9 0 ~ ! $ > = < + . & ee es a b c d e f g h i j k l m n o p q r s t u v w x y z
 again against all almost alone along already also although always am among
 amongst amount an and another any anyhow anyone anything anyway anywhere are
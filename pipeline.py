@@ -1,12 +1,16 @@
 import argparse
-import concurrent.futures
-import glob
+import itertools
 import json
+import logging
 import os
 import sys
 import traceback
 
-from bgp import MINIMAL_SEQUENCER, ia
+from bgp import MINIMAL_SEQUENCER, SOURCE_FORMATS, configure_logging
+from bgp.cache import ContentCache
+from bgp.genome import find_genome, genome_filename, load_genome
+from bgp.scheduler import Scheduler
+from bgp.status import STATUS_FILENAME, StatusStore
 
 parser = argparse.ArgumentParser(prog='[pipeline]',
                                  description='Automate Open Book Genome Project sequencer')
@@ -18,6 +22,79 @@ parser.add_argument('-p',
                     type=int,
                     help='number of pipeline processes to run concurrently (default is 1)')
 
+parser.add_argument('--prefetch',
+                    action='store',
+                    metavar='prefetch-count',
+                    type=int,
+                    help='number of upcoming books each process downloads in the background while sequencing')
+
+parser.add_argument('--cache-dir',
+                    action='store',
+                    metavar='cache-dir',
+                    type=str,
+                    help='directory in which to cache downloaded book sources between runs')
+
+parser.add_argument('--cache-max-bytes',
+                    action='store',
+                    metavar='cache-max-bytes',
+                    type=int,
+                    help='evict least recently used cached sources beyond this size')
+
+parser.add_argument('--cache-compression',
+                    action='store',
+                    choices=['gzip', 'zstd'],
+                    help='compress cached sources at rest')
+
+parser.add_argument('--offline',
+                    action='store_true',
+                    help='never download sources; only sequence books already in the cache')
+
+parser.add_argument('--resequence',
+                    action='store_true',
+                    help='for books already sequenced, run only modules which are new or stale (changed version or source files) and merge them into the existing genome')
+
+parser.add_argument('--parallel',
+                    action='store',
+                    choices=['threads', 'processes'],
+                    help="run each book's processors concurrently, in threads or worker processes")
+
+parser.add_argument('--parallel-min-bytes',
+                    action='store',
+                    metavar='parallel-min-bytes',
+                    type=int,
+                    default=0,
+                    help='only sequence books whose sources are at least this large in parallel')
+
+parser.add_argument('--parallel-workers',
+                    action='store',
+                    metavar='parallel-workers',
+                    type=int,
+                    help="max concurrent processors per book, and so each process's pool size with --parallel processes (default CPU count divided by the number of processes)")
+
+parser.add_argument('--lookahead',
+                    action='store',
+                    metavar='lookahead-count',
+                    type=int,
+                    default=0,
+                    help='number of upcoming books whose sizes (item_size in the jsonl, else from metadata) are compared so the largest are sequenced first (default 0, i.e. file order)')
+
+parser.add_argument('--max-tasks-per-process',
+                    action='store',
+                    metavar='max-tasks',
+                    type=int,
+                    help='replace each process after this many books (or batches, with --prefetch)')
+
+parser.add_argument('--max-rss-mb',
+                    action='store',
+                    metavar='max-rss-mb',
+                    type=int,
+                    help='replace a process once its memory use exceeds this many MB')
+
+parser.add_argument('--genome-compression',
+                    action='store',
+                    choices=['gzip', 'zstd'],
+                    help='save and upload genomes compressed, with frequency tables stored as columns (book_genome.jsonl.gz/.zst)')
+
 parser.add_argument('Path',
                     metavar='source-path',
                     type=str,
@@ -25,80 +102,86 @@ parser.add_argument('Path',
 
 args = parser.parse_args()
 
+configure_logging()
+
 input_path = args.Path
 process_count = args.processes
 
 if not process_count:
     process_count = 1
 
+if args.cache_dir:
+    MINIMAL_SEQUENCER.cache = ContentCache(args.cache_dir,
+                                           max_bytes=args.cache_max_bytes,
+                                           compression=args.cache_compression,
+                                           offline=args.offline)
+elif args.offline:
+    print('--offline requires --cache-dir')
+    sys.exit()
+
+MINIMAL_SEQUENCER.parallel = args.parallel
+MINIMAL_SEQUENCER.genome_compression = args.genome_compression
+try:
+    genome_filename(args.genome_compression)
+except ValueError as e:
+    print(e)
+    sys.exit()
+MINIMAL_SEQUENCER.parallel_min_bytes = args.parallel_min_bytes
+# Every process has its own pool, so together they don't exceed the CPUs
+MINIMAL_SEQUENCER.workers = args.parallel_workers or max((os.cpu_count() or 1) // process_count, 1)
+
 if not os.path.isfile(input_path):
     print('The path specified does not exist')
     sys.exit()
 
 RESULTS_PATH = 'results/' + input_path.split('.jsonl')[0] + '/'
-books = []
-
-
-def touch(identifier, record, data=None):
-    file_name = '{}{}/{}_{}'.format(RESULTS_PATH, identifier, record, identifier)
-    f = open(file_name, 'a')
-    if data:
-        f.write(data)
-    f.close()
 
 
 def db_isbn_extracted(identifier, isbn):
-    touch(identifier, 'ISBN_{}'.format(isbn))
+    STATUS.set(identifier, 'ISBN', value=isbn)
 
 
 def db_isbn_none(identifier):
-    touch(identifier, 'UPDATE_NONE')
+    STATUS.set(identifier, 'UPDATE_NONE')
 
 
 def db_update_failed(identifier):
-    touch(identifier, 'UPDATE_FAILED')
+    STATUS.set(identifier, 'UPDATE_FAILED')
 
 
 def db_update_succeed(identifier):
-    if os.path.exists('{}{}/UPDATE_FAILED_{}'.format(RESULTS_PATH, identifier, identifier)):
-        os.remove('{}{}/UPDATE_FAILED_{}'.format(RESULTS_PATH, identifier, identifier))
-    if os.path.exists('{}{}/UPDATE_CONFLICT_{}'.format(RESULTS_PATH, identifier, identifier)):
-        os.remove('{}{}/UPDATE_CONFLICT_{}'.format(RESULTS_PATH, identifier, identifier))
-    touch(identifier, 'UPDATE_SUCCEED')
+    STATUS.remove(identifier, 'UPDATE_FAILED', 'UPDATE_CONFLICT')
+    STATUS.set(identifier, 'UPDATE_SUCCEED')
 
 
 def db_update_conflict(identifier):
-    touch(identifier, 'UPDATE_CONFLICT')
+    STATUS.set(identifier, 'UPDATE_CONFLICT')
 
 
 def db_urls_found(identifier, urls):
-    urls_count = len(urls)
-    urls_data = ''
-    for url in urls:
-        urls_data += '{}\n'.format(url)
-    touch(identifier, 'URLS_{}'.format(urls_count), data=urls_data)
+    STATUS.set(identifier, 'URLS', value=len(urls),
+               data=''.join('{}\n'.format(url) for url in urls))
 
 
 def db_genome_updated(identifier):
-    touch(identifier, 'GENOME_UPDATED')
+    STATUS.set(identifier, 'GENOME_UPDATED')
 
 
 def db_sequence_success(identifier):
-    if os.path.exists('{}{}/SEQUENCE_FAILURE_{}'.format(RESULTS_PATH, identifier, identifier)):
-        os.remove('{}{}/SEQUENCE_FAILURE_{}'.format(RESULTS_PATH, identifier, identifier))
+    STATUS.remove(identifier, 'SEQUENCE_FAILURE')
 
 
 def db_sequence_failure(identifier, exception):
-    touch(identifier, 'SEQUENCE_FAILURE', data=str(exception))
+    STATUS.set(identifier, 'SEQUENCE_FAILURE', data=str(exception))
 
 
 def get_canonical_isbn(genome):
     c_isbns = None
     b_isbns = None
-    if genome['copyright_page']:
+    if genome.get('copyright_page'):
         # ISBN's extracted from copyright page
         c_isbns = genome['copyright_page'][0]['isbns']
-    if genome['backpage_isbn']:
+    if genome.get('backpage_isbn'):
         # ISBN's extracted from back page
         b_isbns = genome['backpage_isbn']
 
@@ -121,7 +204,7 @@ def update_isbn(genome):
     """
     itemid = genome.get('metadata').get('identifier')
     # Checks if ia item already has isbn
-    item = ia.get_item(itemid)
+    item = MINIMAL_SEQUENCER.ia.get_item(itemid)
     metadata = item.item_metadata['metadata']
     if 'isbn' in metadata:
         item_isbn = item.item_metadata['metadata']['isbn'][0]
@@ -149,40 +232,76 @@ def extract_urls(genome):
     Save item's extracted urls to database.
     """
     itemid = genome.get('metadata').get('identifier')
-    urls = set([url for url in genome['urls'] if 'archive.org' not in url])
+    urls = set([url for url in genome.get('urls', []) if 'archive.org' not in url])
     db_urls_found(itemid, urls)
 
 
-with open(input_path) as fin:
-    for line in fin:
-        books.append(json.loads(line.replace("\n", ""))['identifier'])
+def iter_records(path):
+    """Streams the jsonl records (each with an ia identifier) of path"""
+    with open(path) as fin:
+        for line in fin:
+            if line.strip():
+                yield json.loads(line)
+
+
+def book_size(record):
+    """
+    :return: a book's expected cost: the record's item_size if it has one
+        (e.g. from a scrape API query), else the size of its source files
+        from the item's metadata
+    """
+    if 'item_size' in record:
+        return int(record['item_size'])
+    item = MINIMAL_SEQUENCER.ia.get_item(record['identifier'])
+    return sum(int(f.get('size', 0)) for f in item.files
+               if f.get('format') in SOURCE_FORMATS.values())
+
+
 if RESULTS_PATH and not os.path.exists(RESULTS_PATH):
     os.makedirs(RESULTS_PATH)
+status_path = RESULTS_PATH + STATUS_FILENAME
+migrate_status = not os.path.exists(status_path)
+STATUS = StatusStore(status_path)
+if migrate_status:
+    # Resume runs whose statuses were recorded as touched files
+    STATUS.migrate(RESULTS_PATH)
 
 
-def run_pipeline(book):
+def run_pipeline(book, sequenced=None):
+    """
+    :param str book: identifier of the book
+    :param sequenced: the book's Sequence (or the Exception raised
+        sequencing it) if it has already been sequenced
+    """
     try:
         genome = None
-        if not os.path.exists('{}{}/'.format(RESULTS_PATH, book)):
-            os.makedirs('{}{}/'.format(RESULTS_PATH, book))
-        if not os.path.exists('{}{}/book_genome.json'.format(RESULTS_PATH, book)):
-            genome = MINIMAL_SEQUENCER.sequence(book)
+        if not find_genome(RESULTS_PATH + book):
+            genome = sequenced or MINIMAL_SEQUENCER.sequence(book)
+            if isinstance(genome, Exception):
+                raise genome
             genome.save(path=RESULTS_PATH)
             genome.upload()
             db_genome_updated(book)
             genome = genome.results
         if not genome:
             # Get genome from file if not in memory
-            f = open('{}{}/book_genome.json'.format(RESULTS_PATH, book),)
-            genome = json.load(f)
-        update_failed = os.path.exists('{}{}/UPDATE_FAILED_{}'.format(RESULTS_PATH, book, book))
-        isbn_attempted = glob.glob('{}{}/ISBN_*'.format(RESULTS_PATH, book))
-        if update_failed or not isbn_attempted:
+            genome = load_genome(RESULTS_PATH + book)
+            if args.resequence:
+                resequenced = MINIMAL_SEQUENCER.resequence(book, genome)
+                if resequenced.rerun:
+                    resequenced.save(path=RESULTS_PATH)
+                    resequenced.upload()
+                    db_genome_updated(book)
+                    genome = resequenced.results
+        status = STATUS.get(book)
+        # A book without Djvu XML has no page type results to take an ISBN from
+        has_pagetypes = 'copyright_page' in genome or 'backpage_isbn' in genome
+        if has_pagetypes and ('UPDATE_FAILED' in status or 'ISBN' not in status):
             update_isbn(genome)
-        if not glob.glob('{}{}/URLS_*'.format(RESULTS_PATH, book)):
+        if 'URLS' not in status:
             extract_urls(genome)
-        if not os.path.exists('{}{}/GENOME_UPDATED_{}'.format(RESULTS_PATH, book, book)):
-            MINIMAL_SEQUENCER._upload(results=genome)
+        if 'GENOME_UPDATED' not in status:
+            MINIMAL_SEQUENCER.upload(genome)
             db_genome_updated(book)
         db_sequence_success(book)
     except Exception:
@@ -190,6 +309,56 @@ def run_pipeline(book):
         db_sequence_failure(book, e)
 
 
-executor = concurrent.futures.ProcessPoolExecutor(process_count)
-futures = [executor.submit(run_pipeline, book) for book in books]
-concurrent.futures.wait(futures)
+def run_pipeline_batch(batch):
+    """
+    Runs the pipeline over a batch of books, downloading the next books'
+    sources in the background while the current one is sequenced
+    """
+    pending = [book for book in batch
+               if not find_genome(RESULTS_PATH + book)]
+    sequenced = MINIMAL_SEQUENCER.sequence_many(list(pending), prefetch=args.prefetch)
+    for book in batch:
+        if pending and book == pending[0]:
+            pending.pop(0)
+            run_pipeline(book, sequenced=next(sequenced)[1])
+        else:
+            run_pipeline(book)
+    # Exhaust the generator so its prefetch stats get logged
+    next(sequenced, None)
+
+
+def run_record(record):
+    run_pipeline(record['identifier'])
+
+
+def run_record_batch(records):
+    run_pipeline_batch([record['identifier'] for record in records])
+
+
+def iter_batches(records, batch_size):
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+if args.prefetch:
+    batch_size = max(args.prefetch * 4, 1)
+    tasks = iter_batches(iter_records(input_path), batch_size)
+    run_task, task_cost = run_record_batch, lambda batch: sum(map(book_size, batch))
+else:
+    tasks = iter_records(input_path)
+    run_task, task_cost = run_record, book_size
+scheduler = Scheduler(run_task,
+                      processes=process_count,
+                      lookahead=args.lookahead,
+                      cost=task_cost,
+                      max_tasks_per_worker=args.max_tasks_per_process,
+                      max_rss_bytes=args.max_rss_mb and args.max_rss_mb * 1024 * 1024)
+for task, _, error in scheduler.run(tasks):
+    if error:
+        # e.g. its process was killed; other errors are recorded by run_pipeline
+        for record in (task if args.prefetch else [task]):
+            db_sequence_failure(record['identifier'], error)
+logging.info('Scheduler stats - ' + json.dumps(scheduler.stats))